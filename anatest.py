@@ -1,8 +1,7 @@
 import numpy as np
 from utils import *
 
-embedding_arrays = np.load("25000-180000-500-BLK-8.0.vec.npy")
-V, vocab, word2ID, skippedWords_whatever = embedding_arrays
+V, vocab, word2ID, skippedWords_whatever = load_embeddings_cached("25000-180000-500-BLK-8.0.vec")
 model = VecModel(V, vocab, word2ID, vecNormalize=True)
 w1, w2 = predict_ana(model, "fish", "water", "plant", "soil")
 print w1, w2
@@ -1,6 +1,8 @@
 from sklearn import svm, metrics
-from sklearn.datasets import load_svmlight_file
+from sklearn.datasets import load_svmlight_files
 import sys
+import os
+from utils import load_features
 
 def getScores( true_classes, pred_classes, average):
     precision = metrics.precision_score( true_classes, pred_classes, average=average )
@@ -38,15 +40,22 @@ if len(sys.argv) > 3:
 else:
     dims = None
         
+# features are loaded from the binary feature files (.npz) if they exist, otherwise from the svmlight files.
+# sparse features are never densified
 if corpus == '20news':
-    train_file = "20news-train-11314.svm-%s.txt" %filetype
-    test_file = "20news-test-7532.svm-%s.txt" %filetype
+    train_trunk = "20news-train-11314.svm-%s" %filetype
+    test_trunk = "20news-test-7532.svm-%s" %filetype
 else:
-    train_file = "reuters-train-5770.svm-%s.txt" %filetype
-    test_file = "reuters-test-2255.svm-%s.txt" %filetype
+    train_trunk = "reuters-train-5770.svm-%s" %filetype
+    test_trunk = "reuters-test-2255.svm-%s" %filetype
 
-train_features_sparse, true_train_classes = load_svmlight_file(train_file)
-test_features_sparse, true_test_classes = load_svmlight_file(test_file)
+if os.path.isfile(train_trunk + ".npz") and os.path.isfile(test_trunk + ".npz"):
+    train_features, true_train_classes, train_docs_name = load_features(train_trunk + ".npz")
+    test_features, true_test_classes, test_docs_name = load_features(test_trunk + ".npz")
+else:
+    # loaded together to have the same number of features
+    train_features, true_train_classes, test_features, true_test_classes = \
+            load_svmlight_files( [ train_trunk + ".txt", test_trunk + ".txt" ] )
 #nonzeroColIDs = np.union1d( train_features_sparse.nonzero()[1], test_features_sparse.nonzero()[1] )
 #train_features = train_features_sparse[:, nonzeroColIDs].toarray()
 #test_features = test_features_sparse[:, nonzeroColIDs].toarray()
@@ -55,9 +64,6 @@ test_features_sparse, true_test_classes = load_svmlight_file(test_file)
 #print "%dx%d sparse feature matrices reduced to %dx%d" %( tuple(train_features_sparse.shape) +
 #                                                tuple(train_features.shape) )
 
-train_features = train_features_sparse.toarray()
-test_features = test_features_sparse.toarray()
-
 print "Train: %dx%d. Test: %dx%d" %( tuple( train_features.shape + test_features.shape ) )
 
 if dims:
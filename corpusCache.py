@@ -0,0 +1,72 @@
+# the cache of tokenized corpora, shared by corpusLoader.py and the corpus loader of the LDA competitor. 
+# Each loader makes the keys and the file names of its own caches
+import os
+import hashlib
+import numpy as np
+
+# version of the corpus cache. Increase it when the tokenizer or the format changes
+corpusCacheVersion = 1
+
+# key of a cached tokenized corpus: the corpus, the set, and the options of the tokenizer that made it
+def makeCorpusCacheKey(corpusName, setName, tokenizerOptions):
+    return hashlib.md5( "%s %s %s %d" %( corpusName, setName, tokenizerOptions, corpusCacheVersion ) ).hexdigest()
+
+# save the output of a corpus loader in a compact binary format: the distinct words, 
+# the word ids of all tokens, and the ends of the sentences and the docs
+def save_corpus_cache(cacheFilename, key, corpus):
+    setDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, cats_docsWords, \
+            cats_docNames, category_names = corpus
+    word2id = {}
+    tokenIDs = []
+    sentEnds = []
+    docSentEnds = []
+    for wordsInSentences in orig_docs_words:
+        for sentence in wordsInSentences:
+            for w in sentence:
+                tokenIDs.append( word2id.setdefault( w, len(word2id) ) )
+            sentEnds.append( len(tokenIDs) )
+        docSentEnds.append( len(sentEnds) )
+    words = sorted( word2id.keys(), key=lambda w: word2id[w] )
+
+    # words and names never contain '\n'
+    np.savez( cacheFilename, key=key, setDocNum=setDocNum, words="\n".join(words),
+                tokenIDs=np.array( tokenIDs, dtype=np.int32 ), sentEnds=np.array( sentEnds, dtype=np.int64 ),
+                docSentEnds=np.array( docSentEnds, dtype=np.int64 ), docNames="\n".join(orig_docs_name),
+                docCats=np.array( orig_docs_cat, dtype=np.int32 ), categoryNames="\n".join(category_names) )
+    print "Tokenized corpus saved into '%s'" %cacheFilename
+
+def splitCacheStr(s):
+    s = s.item()
+    if s == "":
+        return []
+    return s.split("\n")
+
+# returns the same tuple as the corpus loaders, or None if the cache doesn't exist or is outdated
+def load_corpus_cache(cacheFilename, key):
+    if not os.path.isfile(cacheFilename):
+        return None
+    cache = np.load(cacheFilename)
+    if cache['key'].item() != key:
+        print "Tokenized corpus in '%s' is outdated" %cacheFilename
+        return None
+
+    words = splitCacheStr( cache['words'] )
+    tokens = [ words[i] for i in cache['tokenIDs'].tolist() ]
+    sentEnds = cache['sentEnds'].tolist()
+    sentences = [ tokens[start:end] for start, end in zip( [0] + sentEnds[:-1], sentEnds ) ]
+    docSentEnds = cache['docSentEnds'].tolist()
+    orig_docs_words = [ sentences[start:end] for start, end in zip( [0] + docSentEnds[:-1], docSentEnds ) ]
+    orig_docs_name = splitCacheStr( cache['docNames'] )
+    orig_docs_cat = cache['docCats'].tolist()
+    category_names = splitCacheStr( cache['categoryNames'] )
+
+    # docs of each category are in the same order as in all docs
+    cats_docsWords = [ [] for i in xrange( len(category_names) ) ]
+    cats_docNames = [ [] for i in xrange( len(category_names) ) ]
+    for wordsInSentences, doc_name, catID in zip( orig_docs_words, orig_docs_name, orig_docs_cat ):
+        cats_docsWords[catID].append(wordsInSentences)
+        cats_docNames[catID].append(doc_name)
+
+    print "%d docs loaded from tokenized corpus '%s'" %( len(orig_docs_words), cacheFilename )
+    return int( cache['setDocNum'] ), orig_docs_words, orig_docs_name, orig_docs_cat, \
+                cats_docsWords, cats_docNames, category_names
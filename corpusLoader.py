@@ -6,49 +6,14 @@ import HTMLParser
 import os
 import pdb
 from utils import *
+from corpusCache import *
 
-def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1):
-    if remove_punc:
-        # ensure doc_u is in unicode
-        if not isinstance(doc, unicode):
-            encoding = remove_punc
-            doc_u = doc.decode(encoding)
-        else:
-            doc_u = doc
-        # remove unicode punctuation marks, keep ascii punctuation marks
-        doc_u = doc_u.translate(unicode_punc_tbl)
-        if not isinstance(doc, unicode):
-            doc = doc_u.encode(encoding)
-        else:
-            doc = doc_u
-            
-    if remove_url:
-        re_url = r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
-        doc = re.sub( re_url, "", doc )
-            
-    sentences = re.split( r"\s*[,;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+||", doc ) #"
-    wc = 0
-    wordsInSentences = []
-    
-    for sentence in sentences:
-        if sentence == "":
-            continue
-
-        if not re.search( "[A-Za-z0-9]", sentence ):
-            continue
-
-        words = re.split( r"\s+\+|^\+|\+?[\-*\/&%=<>\[\]~\|\@\$]+\+?|\'\s+|\'s\s+|\'s$|\s+\'|^\'|\'$|\$|\\|\s+", sentence )
-
-        words = filter( lambda w: w, words )
+# the docs are decoded strictly: a doc that isn't utf-8 raises an error, instead of losing its invalid bytes
+def corpusTokenizer():
+    return SentenceTokenizer(decode_errors='strict')
 
-        if len(words) >= min_length:
-            wordsInSentences.append(words)
-            wc += len(words)
-
-    #print "%d words extracted" %wc
-    return wordsInSentences, wc
-    
-def load_20news(setName):
+# processes: number of processes to tokenize the docs
+def load_20news(setName, processes=1):
     newsgroups_subset = fetch_20newsgroups(subset=setName, remove=('headers', 'footers')) #, 'quotes'
     totalLineNum = 0
     readDocNum = 0
@@ -64,6 +29,9 @@ def load_20news(setName):
     cats_docNames = [ [] for i in xrange(catNum) ]
     
     emptyFileNum = 0
+    # texts of the non-empty docs and their indices, tokenized in one batch
+    texts = []
+    docIndices = []
     
     for d, text in enumerate(newsgroups_subset.data):
         if d % 50 == 49 or d == setDocNum - 1:
@@ -76,13 +44,15 @@ def load_20news(setName):
     
         readDocNum += 1
         totalLineNum += len(lines)
+        texts.append( " ".join(lines) )
+        docIndices.append(d)
     
+    tokenizer = corpusTokenizer()
+    docs_tokens = tokenizer.tokenizeDocs( texts, processes )
+    
+    for d, (wordsInSentences, wc) in zip( docIndices, docs_tokens ):
         catID = newsgroups_subset.target[d]
         category = newsgroups_subset.target_names[catID]
-    
-        text = " ".join(lines)
-    
-        wordsInSentences, wc = extractSentenceWords(text)
         filename = newsgroups_subset.filenames[d]
         filename = os.path.basename(filename)
         orig_docs_words.append( wordsInSentences )
@@ -95,7 +65,8 @@ def load_20news(setName):
     return setDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, \
                 cats_docsWords, cats_docNames, newsgroups_subset.target_names
     
-def load_reuters(setName):
+# processes: number of processes to tokenize the docs
+def load_reuters(setName, processes=1):
     html = HTMLParser.HTMLParser()
     doc_ids = reuters.fileids()
     cat2all_ids = {}
@@ -173,6 +144,9 @@ def load_reuters(setName):
     readDocNum = 0
     totalLineNum = 0
     emptyFileNum = 0
+    # texts of the non-empty docs and their ( doc_id, cat_id ), tokenized in one batch
+    texts = []
+    docKeys = []
     
     for cat_id, cat in enumerate(topN_cats):
         for doc_id in cat2set_ids[cat]:
@@ -187,18 +161,40 @@ def load_reuters(setName):
         
             readDocNum += 1
             totalLineNum += len(lines)
-        
-            text = " ".join(lines)
-            wordsInSentences, wc = extractSentenceWords(text)
+            texts.append( " ".join(lines) )
+            docKeys.append( ( doc_id, cat_id ) )
             
-            filename = doc_id
-            orig_docs_words.append( wordsInSentences )
-            orig_docs_name.append(filename)
-            orig_docs_cat.append(cat_id)
-            cats_docsWords[cat_id].append(wordsInSentences)
-            cats_docNames[cat_id].append(filename)
+    tokenizer = corpusTokenizer()
+    docs_tokens = tokenizer.tokenizeDocs( texts, processes )
+    
+    for (doc_id, cat_id), (wordsInSentences, wc) in zip( docKeys, docs_tokens ):
+        filename = doc_id
+        orig_docs_words.append( wordsInSentences )
+        orig_docs_name.append(filename)
+        orig_docs_cat.append(cat_id)
+        cats_docsWords[cat_id].append(wordsInSentences)
+        cats_docNames[cat_id].append(filename)
             
     print "Done. %d docs read, %d empty docs skipped. Totally %d lines" %(readDocNum, emptyFileNum, totalLineNum)
     return setDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, \
                 cats_docsWords, cats_docNames, topN_cats
-    
\ No newline at end of file
+
+# key of a cached tokenized corpus: the corpus, the set, and the tokenizer options
+def corpusCacheKey(corpusName, setName):
+    tokenizer = corpusTokenizer()
+    options = ( tokenizer.remove_url, tokenizer.remove_punc, tokenizer.min_length, tokenizer.decode_errors )
+    return makeCorpusCacheKey( corpusName, setName, options )
+
+corpus2loader = { '20news': load_20news, 'reuters': load_reuters }
+
+# load a corpus from its cache '<corpus>-<set>.corpus.npz'. If not cached, load it with
+# its loader, and save it in the cache
+# processes: number of processes to tokenize the docs
+def load_corpus_cached(corpusName, setName, processes=1):
+    cacheFilename = "%s-%s.corpus.npz" %( corpusName, setName )
+    key = corpusCacheKey(corpusName, setName)
+    corpus = load_corpus_cache(cacheFilename, key)
+    if corpus is None:
+        corpus = corpus2loader[corpusName](setName, processes)
+        save_corpus_cache(cacheFilename, key, corpus)
+    return corpus
@@ -31,6 +31,8 @@ config = dict(  csv_filenames = None,
                 printTopics_iterNum = 10,
                 zero_topic0 = True,
                 useDrdtApprox = False,
+                bow_Estep = True,
+                keep_Pi = False,
                 customStopwords = customStopwords,
                 remove_stop = True,
                 normalize_vecs = False,
@@ -38,6 +40,16 @@ config = dict(  csv_filenames = None,
                 rebase_vecs = True,
                 rebase_norm_thres = 0.2,
                 evalKmeans = False,
+                # resume the EM procedure from the checkpoint
+                resume = False,
+                # number of seeds to run in parallel. The best one is kept
+                restart_num = 1,
+                # the restarts with the best loglikes after 10 iters continue
+                restart_pruneIters = 10,
+                restart_keep = 2,
+                # > 0: online inference on mini-batches of this many rows, without loading all rows
+                online_batchSize = 0,
+                online_passes = 1,
                 verbose = 1,
                 seed = 0
             )
@@ -55,13 +67,21 @@ Options:
   -A:  Append to the old log file.
   -s:  Seed the random number generator to x. Used to repeat experiments
   -n:  Nickname (short name) for the csv_file
+  -b:  Online inference on mini-batches of x rows. Rows are read from the csv files on the fly
+  -p:  Number of passes over the csv files in online inference. Default: 1
+  -T:  Initialize the topics with k-means (-T kmeans), or with the topics in a topic file
+       (.topic.vec or .topic.npz), e.g. of the previous time slice. Default: random
+  -m:  Run the EM procedure with x seeds (from the seed of -s, or 1) in parallel processes, 
+       and keep the topics of the seed with the best lowerbound
+  -R:  Resume the EM procedure from the checkpoint '<nickname or csv_file>.checkpoint.npz'
+       (saved every 10 iterations)
 """
 
 def getOptions():
     global config
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"k:v:i:u:l:s:n:Ah")
+        opts, args = getopt.getopt(sys.argv[1:],"k:v:i:u:l:s:n:b:p:T:m:ARh")
         if len(args) < 1:
             raise getopt.GetoptError("")
         config['csv_filenames'] = args
@@ -85,8 +105,24 @@ def getOptions():
                 config['appendLogfile'] = True
             if opt == '-n':
                 config['short_name'] = arg
+            if opt == '-b':
+                config['online_batchSize'] = int(arg)
+            if opt == '-p':
+                config['online_passes'] = int(arg)
             if opt == '-r':
                 config['useDrdtApprox'] = True
+            if opt == '-R':
+                config['resume'] = True
+            if opt == '-m':
+                config['restart_num'] = int(arg)
+            if opt == '-T':
+                if arg == 'kmeans':
+                    config['init_topics'] = 'kmeans'
+                else:
+                    config['init_topics'] = 'file'
+                    config['topic_vec_file'] = arg
+                # a better docs_theta to start with for the warm-started topics
+                config['init_Estep_iters'] = 3
             if opt == '-h':
                 usage()
                 sys.exit(0)
@@ -105,9 +141,29 @@ def getOptions():
 
     return config
 
+# yields ( wordsInSentences, row_name ) of each row in the csv files
+def csvDocIter(csv_filenames):
+    for csv_filename in csv_filenames:
+        with open(csv_filename) as DOC:
+            docreader = csv.reader(DOC)
+            for rowcount, row in enumerate(docreader):
+                wordsInSentences, wc = extractSentenceWords(row[0], min_length=2)
+                yield wordsInSentences, "%s-row%d" %( csv_filename, rowcount + 1 )
+                
 def main():
     config = getOptions()
 
+    if config['online_batchSize'] > 0:
+        topicvec = topicvecDir(**config)
+        getDocBatches = lambda: docBatchIter( csvDocIter( config['csv_filenames'] ), config['online_batchSize'] )
+        best_last_Ts, Em = topicvec.inferenceOnline( getDocBatches, config['online_passes'] )
+        
+        basename = os.path.basename(config['logfilename'])
+        basetrunk = os.path.splitext(basename)[0]
+        last_it, last_T, last_loglike = best_last_Ts[1]
+        topicvec.saveTopics( basetrunk + "-online%d-last" %last_it, "topic", last_T, last_it )
+        return
+        
     docwords = []
     csvfiles_filecount = 0
     csvfiles_wc = 0
@@ -145,17 +201,20 @@ def main():
         topicvec.printTopWordsInTopic(None, True)
         exit(0)
         
-    best_last_Ts, Em, docs_Em, Pi = topicvec.inference()
-
     basename = os.path.basename(config['logfilename'])
     basetrunk = os.path.splitext(basename)[0]
 
+    if config['restart_num'] > 1:
+        best_last_Ts, Em, docs_Em, Pi = topicvec.inferenceRestarts()
+    else:
+        best_last_Ts, Em, docs_Em, Pi = topicvec.inference( basetrunk + ".checkpoint.npz", config['resume'] )
+
     best_it, best_T, best_loglike = best_last_Ts[0]
-    save_matrix_as_text( basetrunk + "-em%d-best.topic.vec" %best_it, "topic", best_T  )
+    topicvec.saveTopics( basetrunk + "-em%d-best" %best_it, "topic", best_T, best_it )
 
     if best_last_Ts[1]:
         last_it, last_T, last_loglike = best_last_Ts[1]
-        save_matrix_as_text( basetrunk + "-em%d-last.topic.vec" %last_it, "topic", last_T  )
+        topicvec.saveTopics( basetrunk + "-em%d-last" %last_it, "topic", last_T, last_it )
 
 if __name__ == '__main__':
     main()
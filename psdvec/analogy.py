@@ -20,10 +20,9 @@ def pred_ana( model, a, a2, b, maxcands = 10 ):
         
     return b2s
     
-embedding_npyfile = "25000-180000-500-BLK-8.0.vec.npy"
-embedding_arrays = np.load(embedding_npyfile)
-V, vocab, word2ID, skippedWords_whatever = embedding_arrays
-print "%d words loaded from '%s'" %(len(vocab), embedding_npyfile)
+embedding_file = "25000-180000-500-BLK-8.0.vec"
+V, vocab, word2ID, skippedWords_whatever = load_embeddings_cached(embedding_file)
+print "%d words loaded from '%s'" %(len(vocab), embedding_file)
 model = VecModel(V, vocab, word2ID, vecNormalize=True)
 print "Model initialized. Ready for input:"
 
@@ -0,0 +1,159 @@
+# compare the speed and results of the line-by-line embedding loader and the chunked loader
+# usage: python embedbench.py [word_count] [dim] [processes]
+import numpy as np
+import sys
+import os
+from utils import *
+
+# the loader before the chunked parsing, kept as the reference
+def load_embeddings_old( filename, maxWordCount=-1, extraWords={}, record_skipped=False ):
+    FMAT = open(filename)
+    warning( "Load embedding text file '%s'\n" %(filename) )
+    
+    V = []
+    word2id = {}
+    skippedWords = {}
+
+    vocab = []
+    precision = np.float32
+
+    try:
+        header = FMAT.readline()
+        lineno = 1
+        match = re.match( r"(\d+) (\d+)", header)
+        if not match:
+            raise ValueError(lineno, header)
+
+        vocab_size = int(match.group(1))
+        N = int(match.group(2))
+
+        if maxWordCount > 0:
+            maxWordCount = min(maxWordCount, vocab_size)
+        else:
+            maxWordCount = vocab_size
+
+        warning( "Will load embeddings of %d words" %maxWordCount )
+        if len(extraWords) > 0:
+            warning( ", plus %d extra words" %(len(extraWords)) )
+        warning("\n")
+
+        # maxWordCount + len(extraWords) is the maximum num of words.
+        # V may contain extra rows that will be removed at the end
+        V = np.zeros( (maxWordCount + len(extraWords), N), dtype=precision )
+        wid = 0
+        orig_wid = 0
+
+        for line in FMAT:
+            lineno += 1
+            line = line.strip()
+            # end of file
+            if not line:
+                if orig_wid != vocab_size:
+                    raise ValueError( lineno, "%d words declared in header, but %d read" %( vocab_size, orig_wid ) )
+                break
+
+            fields = line.split(' ')
+            # remove empty fields
+            fields = filter( lambda x: x, fields )
+            w = fields[0]
+
+            if w in extraWords:
+                del extraWords[w]
+                isInterested = True
+            elif orig_wid < maxWordCount:
+                isInterested = True
+            elif record_skipped:
+                isInterested = False
+                skippedWords[w] = 1
+            else:
+                break
+							
+            orig_wid += 1
+
+            if isInterested:
+                V[wid] = np.array( [ float(x) for x in fields[1:] ], dtype=precision )
+                word2id[w] = wid
+                vocab.append(w)
+                wid += 1
+
+            if orig_wid % 1000 == 0:
+                warning( "\r%d    %d    %d    \r" %( orig_wid, wid, len(extraWords) ) )
+
+            if orig_wid > vocab_size:
+                raise ValueError( "%d words declared in header, but more are read" %(vocab_size) )
+
+    except ValueError, e:
+        if len( e.args ) == 2:
+            warning( "Unknown line %d:\n%s\n" %( e.args[0], e.args[1] ) )
+        else:
+            exc_type, exc_obj, tb = sys.exc_info()
+            warning( "Source line %d - %s on File line %d:\n%s\n" %( tb.tb_lineno, e, lineno, line ) )
+        exit(2)
+
+    FMAT.close()
+    warning( "\n%d embeddings read, %d kept\n" %(orig_wid, wid) )
+
+    #pdb.set_trace()
+
+    if wid < len(V):
+        V = V[:wid]
+
+    # V: embeddings, vocab: array of words, word2id: dict of word to index in V
+    return V, vocab, word2id, skippedWords
+
+def genEmbeddingFile( filename, wordCount, N ):
+    FVEC = open(filename, "w")
+    FVEC.write( "%d %d\n" %(wordCount, N) )
+    V = np.random.randn(wordCount, N)
+    for i in xrange(wordCount):
+        FVEC.write( "w%d %s\n" %( i, " ".join( "%.6f" %x for x in V[i] ) ) )
+    FVEC.close()
+
+def checkSame( name, old, new ):
+    V, vocab, word2id, skippedWords = old
+    V2, vocab2, word2id2, skippedWords2 = new
+    if V.shape == V2.shape and np.array_equal(V, V2) and vocab == vocab2 \
+            and word2id == word2id2 and skippedWords == skippedWords2:
+        print "%s: same" %name
+    else:
+        print "%s: DIFFERENT" %name
+
+wordCount = 100000
+N = 500
+processes = 4
+if len(sys.argv) > 1:
+    wordCount = int(sys.argv[1])
+if len(sys.argv) > 2:
+    N = int(sys.argv[2])
+if len(sys.argv) > 3:
+    processes = int(sys.argv[3])
+
+filename = "embedbench-%d-%d.vec" %(wordCount, N)
+if not os.path.isfile(filename):
+    print "Generate %d x %d embeddings into '%s'" %(wordCount, N, filename)
+    genEmbeddingFile( filename, wordCount, N )
+
+timer = Timer()
+old = load_embeddings_old(filename)
+print "Old loader:", timer.getElapseTime()
+
+timer = Timer()
+new = load_embeddings(filename)
+print "Chunked loader:", timer.getElapseTime()
+checkSame( "Chunked", old, new )
+
+timer = Timer()
+new = load_embeddings( filename, processes=processes )
+print "Chunked loader, %d processes:" %processes, timer.getElapseTime()
+checkSame( "Chunked, %d processes" %processes, old, new )
+
+# top words plus extra words, with the skipped words recorded
+maxWordCount = wordCount / 3
+extraWords = [ "w%d" %(wordCount - 1), "w%d" %(wordCount / 2), "not-exist" ]
+old = load_embeddings_old( filename, maxWordCount, dict.fromkeys(extraWords, 1), True )
+for p in (1, processes):
+    new = load_embeddings( filename, maxWordCount, dict.fromkeys(extraWords, 1), True, processes=p )
+    checkSame( "Top %d plus extra words, %d processes" %(maxWordCount, p), old, new )
+    new = load_embeddings( filename, maxWordCount, dict.fromkeys(extraWords, 1), processes=p )
+    old2 = load_embeddings_old( filename, maxWordCount, dict.fromkeys(extraWords, 1) )
+    checkSame( "Top %d plus extra words, not recording skipped, %d processes" %(maxWordCount, p), old2, new )
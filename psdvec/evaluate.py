@@ -140,10 +140,10 @@ else:
 if loadwordCutPoint > 0:
     print "Load top %d words" %(loadwordCutPoint)
 
-if isModelBinary:
-    V, vocab2, word2dim, skippedWords = load_embeddings_bin( modelFile, loadwordCutPoint, extraWords )
-elif not isHyperwordsEmbed:
-    V, vocab2, word2dim, skippedWords =     load_embeddings( modelFile, loadwordCutPoint, extraWords )
+if not isHyperwordsEmbed:
+    # the embeddings are cached in an embedding store for faster loading next time
+    V, vocab2, word2dim, skippedWords = load_embeddings_cached( modelFile, loadwordCutPoint, extraWords, 
+                                                                    isBinary=isModelBinary )
 else:
     model = load_embeddings_hyper( modelFile, hyperEmbedType )
     # the interface of hyperwords embedding class is incompatible with analogy tasks
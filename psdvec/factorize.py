@@ -780,7 +780,7 @@ def main():
 
             # here we don't skip words yet
             # skippedWords_whatever is empty and we don't care about it
-            V_pre, vocab_pre, word2preID, skippedWords_whatever = load_embeddings(pre_vec_file)
+            V_pre, vocab_pre, word2preID, skippedWords_whatever = load_embeddings_cached(pre_vec_file)
             N0 = V_pre.shape[1]
 
             prewords_skipped = {}
@@ -0,0 +1,82 @@
+# feature files of docs, written by the topic inference and the competitors, and read by the classifiers.
+# Only numpy and scipy are imported, so it can be imported without changing any global settings
+import numpy as np
+import scipy.sparse
+import zipfile
+import struct
+
+# save a feature matrix (a scipy sparse matrix, or a dense matrix), the labels and the names of the docs
+# into an uncompressed npz file, which can be memory-mapped by load_features()
+def save_features(filename, features, labels, docNames=[]):
+    labels = np.asarray(labels)
+    # doc names never contain '\n'
+    docNames = "\n".join(docNames)
+    if scipy.sparse.issparse(features):
+        features = features.tocsr()
+        np.savez( filename, format="csr", data=features.data, indices=features.indices, indptr=features.indptr,
+                    shape=np.array(features.shape), labels=labels, docNames=docNames )
+    else:
+        np.savez( filename, format="dense", dense=np.asarray(features), labels=labels, docNames=docNames )
+    print "Features of %d docs (%d-d each) saved into '%s'" %( features.shape[0], features.shape[1], filename )
+
+# memory-map the arrays in an uncompressed npz file (saved by np.savez). np.load() ignores mmap_mode 
+# for npz files, so the offset of each array is found in the zip headers
+# returns a dict of name -> array. Small and 0-d arrays are read into memory
+def load_npz_mmap(filename, minMmapBytes=1<<20):
+    ZIP = zipfile.ZipFile(filename)
+    infos = ZIP.infolist()
+    ZIP.close()
+
+    arrays = {}
+    FNPZ = open(filename, "rb")
+    for info in infos:
+        name = info.filename
+        if name.endswith(".npy"):
+            name = name[:-4]
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError( "'%s' in '%s' is compressed, and can't be memory-mapped" %( name, filename ) )
+
+        # local file header: 30 bytes, then the file name and the extra field
+        FNPZ.seek(info.header_offset)
+        localHeader = FNPZ.read(30)
+        nameLen, extraLen = struct.unpack( "<HH", localHeader[26:30] )
+        FNPZ.seek( info.header_offset + 30 + nameLen + extraLen )
+
+        version = np.lib.format.read_magic(FNPZ)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(FNPZ)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(FNPZ)
+        order = 'F' if fortran_order else 'C'
+        count = int( np.prod(shape) )
+
+        if len(shape) > 0 and count * dtype.itemsize >= minMmapBytes:
+            arrays[name] = np.memmap( filename, dtype=dtype, mode='r', offset=FNPZ.tell(), 
+                                        shape=shape, order=order )
+        else:
+            data = np.fromfile( FNPZ, dtype=dtype, count=count )
+            arrays[name] = data.reshape( shape, order=order )
+    FNPZ.close()
+    return arrays
+
+# features, labels and names of docs in a feature file saved by save_features()
+# features: a CSR matrix, or a dense matrix. With mmap=True the arrays are memory-mapped
+def load_features(filename, mmap=True):
+    if mmap:
+        arrays = load_npz_mmap(filename)
+    else:
+        arrays = dict( np.load(filename) )
+
+    if arrays['format'].item() == "csr":
+        features = scipy.sparse.csr_matrix( ( arrays['data'], arrays['indices'], arrays['indptr'] ),
+                                                shape=tuple( arrays['shape'] ), copy=False )
+    else:
+        features = arrays['dense']
+
+    docNames = arrays['docNames'].item()
+    if docNames == "":
+        docNames = []
+    else:
+        docNames = docNames.split("\n")
+    print "Features of %d docs (%d-d each) loaded from '%s'" %( features.shape[0], features.shape[1], filename )
+    return features, arrays['labels'], docNames
@@ -30,6 +30,8 @@ config = dict(  snip_filenames = None,
                 printTopics_iterNum = 10,
                 zero_topic0 = True,
                 useDrdtApprox = False,
+                bow_Estep = True,
+                keep_Pi = False,
                 customStopwords = customStopwords,
                 remove_stop = True,
                 normalize_vecs = False,
@@ -54,13 +56,15 @@ Options:
   -A:  Append to the old log file.
   -s:  Seed the random number generator to x. Used to repeat experiments
   -n:  Nickname (short name) for the snip_file
+  -m:  Use only the top x words in the M-step, and only load the embeddings 
+       of these words and the words in the snippets. Default: all words
 """
 
 def getOptions():
     global config
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"k:v:i:u:l:s:n:Ah")
+        opts, args = getopt.getopt(sys.argv[1:],"k:v:i:u:l:s:n:m:Ah")
         if len(args) != 1:
             raise getopt.GetoptError("")
         config['snip_filename'] = args[0]
@@ -86,6 +90,9 @@ def getOptions():
                 config['short_name'] = arg
             if opt == '-r':
                 config['useDrdtApprox'] = True
+            if opt == '-m':
+                config['Mstep_sample_topwords'] = int(arg)
+                config['subset_embeddings'] = True
             if opt == '-h':
                 usage()
                 sys.exit(0)
@@ -140,11 +147,11 @@ def main():
     basetrunk = os.path.splitext(basename)[0]
 
     best_it, best_T, best_loglike = best_last_Ts[0]
-    save_matrix_as_text( basetrunk + "-em%d-best.topic.vec" %best_it, "topic", best_T  )
+    topicvec.saveTopics( basetrunk + "-em%d-best" %best_it, "topic", best_T, best_it )
 
     if best_last_Ts[1]:
         last_it, last_T, last_loglike = best_last_Ts[1]
-        save_matrix_as_text( basetrunk + "-em%d-last.topic.vec" %last_it, "topic", last_T  )
+        topicvec.saveTopics( basetrunk + "-em%d-last" %last_it, "topic", last_T, last_it )
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,120 @@
+# the active-set E-step skips the docs that are stable, but shouldn't lower the final lowerbound
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from topicvecDir import topicvecDir
+
+# records ( topicDiffNorm of the last M-step, fraction of active docs ) at each full sweep,
+# the loglikes right after the full sweeps, and the number of E-step rows processed
+class sweepRecorder(topicvecDir):
+    def updateActiveSet(self, frozenStats):
+        topicvecDir.updateActiveSet(self, frozenStats)
+        self.sweeps.append( ( self.activeSet_topicDiff, self.activeDocFrac ) )
+
+    def calcLoglikelihood(self):
+        loglike = topicvecDir.calcLoglikelihood(self)
+        # activeSet_age is 0 right after a full sweep
+        if self.activeSet_age == 0:
+            self.sweepLoglikes.append(loglike)
+        return loglike
+
+    def Estep(self, docs_theta, *args, **kwargs):
+        rowSet = kwargs.get('rowSet')
+        self.EstepRowNum += len(self.Estep_wids) if rowSet is None else len(rowSet[0])
+        return topicvecDir.Estep(self, docs_theta, *args, **kwargs)
+
+class ActiveSetTest(unittest.TestCase):
+    # synthetic embeddings of wordNum words around clusterNum cluster centers,
+    # and docs that mostly draw words from two clusters
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        clusterNum, wordNum, N = 5, 200, 20
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        words = [ "zq" + letters[i // 26] + letters[i % 26] for i in xrange(wordNum) ]
+        centers = rng.randn( clusterNum, N )
+        wordClusters = np.arange(wordNum) % clusterNum
+        V = 1.5 * centers[wordClusters] + rng.randn( wordNum, N )
+        # norms close to those of real embeddings
+        V *= 2.8 / np.linalg.norm( V, axis=1, keepdims=True )
+
+        self.vecFilename = os.path.join( self.tmpdir, "synth.vec" )
+        with open(self.vecFilename, "w") as f:
+            f.write( "%d %d\n" %(wordNum, N) )
+            for w, v in zip(words, V):
+                f.write( "%s %s\n" %( w, " ".join( "%.5f" %x for x in v ) ) )
+
+        self.unigramFilename = os.path.join( self.tmpdir, "synth-uni.txt" )
+        with open(self.unigramFilename, "w") as f:
+            f.write("# unigram\n")
+            for w in words:
+                f.write( "%s\t%d\t%f\n" %( w, 100, np.log(1.0 / wordNum) ) )
+
+        self.docs_wordsInSentences = []
+        for d in xrange(60):
+            docClusters = rng.choice( clusterNum, 2, replace=False )
+            sentences = []
+            for s in xrange(10):
+                wids = [ rng.choice( np.flatnonzero( wordClusters == rng.choice(docClusters) ) ) 
+                            if rng.rand() < 0.8 else rng.randint(wordNum) for i in xrange(10) ]
+                sentences.append( [ words[wid] for wid in wids ] )
+            self.docs_wordsInSentences.append(sentences)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # returns the topicvec after inference, and the final loglike
+    def infer(self, **kwargs):
+        config = dict( unigramFilename=self.unigramFilename, word_vec_file=self.vecFilename, K=6,
+                        max_l=5, init_l=1, iniDelta=0.1, alpha0=0.1, alpha1=0.1, MAX_EM_ITERS=100,
+                        seed=1, verbose=0, logfilename=os.path.join( self.tmpdir, "synth" ) )
+        config.update(kwargs)
+        topicvec = sweepRecorder(**config)
+        topicvec.sweeps = []
+        topicvec.sweepLoglikes = []
+        topicvec.EstepRowNum = 0
+        topicvec.setDocs( self.docs_wordsInSentences, [ "doc%d" %d for d in xrange(60) ] )
+        best_last_Ts, Em, docs_Em, Pi = topicvec.inference()
+        return topicvec, best_last_Ts[1][2]
+
+    # docs are only frozen when T moves little, so the E-steps are saved in the long tail of EM 
+    # with a tight topicDiff_tolerance
+    def testLowerboundOfActiveSet(self):
+        fullTopicvec, fullLoglike = self.infer( topicDiff_tolerance=2e-3, MAX_EM_ITERS=150 )
+        topicvec, activeLoglike = self.infer( topicDiff_tolerance=2e-3, MAX_EM_ITERS=150, activeSet_tolerance=0.05 )
+        # most docs were frozen in some sweeps, and fewer rows were processed by the E-steps
+        self.assertLess( min( frac for topicDiff, frac in topicvec.sweeps ), 0.5 )
+        self.assertLess( topicvec.EstepRowNum, 0.9 * fullTopicvec.EstepRowNum )
+        # but the lowerbound is close to that of the full E-steps
+        self.assertLess( abs( activeLoglike - fullLoglike ), 0.01 * abs(fullLoglike) )
+
+    # the M-steps between two full sweeps don't move T away from the frozen docs, 
+    # so the lowerbound doesn't drop from sweep to sweep, and the active run ends no worse than full EM
+    def testLowerboundOfSweeps(self):
+        fullTopicvec, fullLoglike = self.infer()
+        topicvec, activeLoglike = self.infer( activeSet_tolerance=0.05 )
+        # some docs always stay active
+        self.assertGreater( min( frac for topicDiff, frac in topicvec.sweeps ), 
+                                topicvec.activeSet_minActiveFrac - 1e-6 )
+        # full EM itself drops by up to 0.01% between iters
+        for loglike1, loglike2 in zip( topicvec.sweepLoglikes[:-1], topicvec.sweepLoglikes[1:] ):
+            self.assertGreater( loglike2, loglike1 - 0.0002 * abs(loglike1) )
+        self.assertGreater( activeLoglike, fullLoglike - 0.0002 * abs(fullLoglike) )
+
+    # the frozen docs' statistics kept from the sweep are those of a full E-step with the sweep's inputs
+    def testFrozenStatsOfSweep(self):
+        topicvec, activeLoglike = self.infer( activeSet_tolerance=0.05, Estep_chunk_size=97 )
+        T, r, docs_theta = topicvec.Estep_inputs
+        Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em, frozenStats = topicvec.Estep( docs_theta, 
+                                                                    docs_Em2=topicvec.docs_Em, T=T, r=r )
+        docs_frozen, frozen_sum_pi_v, frozen_Pi_entropy = frozenStats
+        self.assertTrue( np.any(docs_frozen) )
+        Pi, docs_Em, sum_pi_v2, Pi_entropy2, words_Em = topicvec.Estep( docs_theta, T=T, r=r, 
+                                                            rowSet=topicvec.makeRowSet(docs_frozen) )
+        self.assertTrue( np.allclose( frozen_sum_pi_v, sum_pi_v2 ) )
+        self.assertAlmostEqual( frozen_Pi_entropy, Pi_entropy2 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding=GBK -*-
+# compare the speed and results of the original extractSentenceWords() and SentenceTokenizer
+# on the docs in test-docs/
+# usage: python tokenbench.py [repeat_times] [processes]
+import sys
+import glob
+from utils import *
+
+# the original function, kept as the reference
+def extractSentenceWords_old(doc, remove_url=True, remove_punc="utf-8", min_length=1):
+    if remove_punc:
+        # ensure doc_u is in unicode
+        if not isinstance(doc, unicode):
+            encoding = remove_punc
+            doc_u = doc.decode(encoding, errors='ignore')
+        else:
+            doc_u = doc
+        # remove unicode punctuation marks, keep ascii punctuation marks
+        doc_u = doc_u.translate(unicode_punc_tbl)
+        if not isinstance(doc, unicode):
+            doc = doc_u.encode(encoding)
+        else:
+            doc = doc_u
+            
+    if remove_url:
+        re_url = r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
+        doc = re.sub( re_url, "", doc )
+            
+    sentences = re.split( r"\s*[,;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+||", doc ) #"
+    wc = 0
+    wordsInSentences = []
+    
+    for sentence in sentences:
+        if sentence == "":
+            continue
+
+        if not re.search( "[A-Za-z0-9]", sentence ):
+            continue
+
+        words = re.split( r"\s+\+|^\+|\+?[\-*\/&%=<>\[\]~\|\@\$]+\+?|\'\s+|\'s\s+|\'s$|\s+\'|^\'|\'$|\$|\\|\s+", sentence )
+
+        words = filter( lambda w: w, words )
+
+        if len(words) >= min_length:
+            wordsInSentences.append(words)
+            wc += len(words)
+
+    #print "%d words extracted" %wc
+    return wordsInSentences, wc
+
+def checkSame( name, old, new ):
+    if old == new:
+        print "%s: same" %name
+    else:
+        diffNum = sum( 1 for r1, r2 in zip(old, new) if r1 != r2 )
+        print "%s: DIFFERENT in %d docs" %( name, diffNum )
+
+repeat = 20
+processes = 4
+if len(sys.argv) > 1:
+    repeat = int(sys.argv[1])
+if len(sys.argv) > 2:
+    processes = int(sys.argv[2])
+
+docs = []
+for filename in sorted( glob.glob("test-docs/*.txt") ):
+    docs.append( open(filename).read() )
+# the docs in unicode, and each line as a doc
+docs_u = [ doc.decode("utf-8", errors='ignore') for doc in docs ]
+docs_lines = [ line for doc in docs for line in doc.split("\n") ]
+print "%d docs, %d lines" %( len(docs), len(docs_lines) )
+
+# different options in the calls of extractSentenceWords()
+for options in [ {}, { 'min_length': 2 }, { 'remove_punc': "iso-8859-1" }, { 'remove_url': False } ]:
+    tokenizer = SentenceTokenizer(**options)
+    for setName, docSet in [ ( "docs", docs ), ( "unicode docs", docs_u ), ( "lines", docs_lines ) ]:
+        old = [ extractSentenceWords_old( doc, **options ) for doc in docSet ]
+        new = tokenizer.tokenizeDocs(docSet)
+        checkSame( "%s %s" %( setName, options ), old, new )
+        new = [ extractSentenceWords( doc, **options ) for doc in docSet ]
+        checkSame( "%s %s, extractSentenceWords" %( setName, options ), old, new )
+
+bigDocs = docs_lines * repeat
+
+timer = Timer()
+old = [ extractSentenceWords_old(doc) for doc in bigDocs ]
+print "Original, %d docs:" %len(bigDocs), timer.getElapseTime()
+
+tokenizer = SentenceTokenizer()
+timer = Timer()
+new = tokenizer.tokenizeDocs(bigDocs)
+print "SentenceTokenizer:", timer.getElapseTime()
+checkSame( "SentenceTokenizer", old, new )
+
+timer = Timer()
+new = tokenizer.tokenizeDocs( bigDocs, processes )
+print "SentenceTokenizer, %d processes:" %processes, timer.getElapseTime()
+checkSame( "SentenceTokenizer, %d processes" %processes, old, new )
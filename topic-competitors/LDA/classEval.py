@@ -1,6 +1,8 @@
 from sklearn import svm, metrics
-from sklearn.datasets import load_svmlight_file
+from sklearn.datasets import load_svmlight_files
+import numpy as np
 import sys
+import os
 
 # precision, recall, f1, accuracy
 def getScores( true_classes, pred_classes, average):
@@ -10,6 +12,10 @@ def getScores( true_classes, pred_classes, average):
     accuracy = metrics.accuracy_score( true_classes, pred_classes )
     return precision, recall, f1, accuracy
 
+# the feature files are read by featureFile.py of the repo root, which also writes them
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", ".." ) )
+from featureFile import load_features
+
 # : python classEval.py  ļ(lda, bowȵ)     
 corpus = sys.argv[1]
 filetype = sys.argv[2]
@@ -23,21 +29,23 @@ if len(sys.argv) > 3:
 else:
     dims = None
 
-# ģ壬õtrainingtestļ        
+# ģ壬õtrainingtestļ
+# features are loaded from the binary feature files (.npz) if they exist, otherwise from the svmlight files.
+# sparse features are never densified
 if corpus == '20news':
-    train_file = "20news-train-11314.svm-%s.txt" %filetype
-    test_file = "20news-test-7532.svm-%s.txt" %filetype
+    train_trunk = "20news-train-11314.svm-%s" %filetype
+    test_trunk = "20news-test-7532.svm-%s" %filetype
 else:
-    train_file = "reuters-train-5770.svm-%s.txt" %filetype
-    test_file = "reuters-test-2255.svm-%s.txt" %filetype
-
-# trainingtestļ
-train_features_sparse, true_train_classes = load_svmlight_file(train_file)
-test_features_sparse, true_test_classes = load_svmlight_file(test_file)
+    train_trunk = "reuters-train-5770.svm-%s" %filetype
+    test_trunk = "reuters-test-2255.svm-%s" %filetype
 
-# ȱʡΪϡתΪͨnumpy array
-train_features = train_features_sparse.toarray()
-test_features = test_features_sparse.toarray()
+if os.path.isfile(train_trunk + ".npz") and os.path.isfile(test_trunk + ".npz"):
+    train_features, true_train_classes, train_docs_name = load_features(train_trunk + ".npz")
+    test_features, true_test_classes, test_docs_name = load_features(test_trunk + ".npz")
+else:
+    # loaded together to have the same number of features
+    train_features, true_train_classes, test_features, true_test_classes = \
+            load_svmlight_files( [ train_trunk + ".txt", test_trunk + ".txt" ] )
 
 print "Train: %dx%d. Test: %dx%d" %( tuple( train_features.shape + test_features.shape ) )
 
@@ -8,6 +8,13 @@ import sys
 import unicodedata
 import re
 import pdb
+import numpy as np
+
+# the feature files are written by featureFile.py of the repo root, and the tokenized corpora 
+# are cached by corpusCache.py there. Neither changes any global settings when imported
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", ".." ) )
+from featureFile import save_features
+from corpusCache import makeCorpusCacheKey, save_corpus_cache, load_corpus_cache
 
 unicode_punc_tbl = dict.fromkeys( i for i in xrange(128, sys.maxunicode)
                       if unicodedata.category(unichr(i)).startswith('P') )
@@ -58,6 +65,9 @@ def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1
 
     #print "%d words extracted" %wc
     return wordsInSentences, wc
+
+# the options of extractSentenceWords() used by the loaders
+tokenizerOptions = dict( remove_url=True, remove_punc="utf-8", min_length=1 )
     
 def load_20news(setName):
     newsgroups_subset = fetch_20newsgroups(subset=setName, remove=('headers', 'footers')) #, 'quotes'
@@ -93,7 +103,7 @@ def load_20news(setName):
     
         text = " ".join(lines)
     
-        wordsInSentences, wc = extractSentenceWords(text)
+        wordsInSentences, wc = extractSentenceWords( text, **tokenizerOptions )
         filename = newsgroups_subset.filenames[d]
         filename = os.path.basename(filename)
         orig_docs_words.append( wordsInSentences )
@@ -202,7 +212,7 @@ def load_reuters(setName):
             totalLineNum += len(lines)
         
             text = " ".join(lines)
-            wordsInSentences, wc = extractSentenceWords(text)
+            wordsInSentences, wc = extractSentenceWords( text, **tokenizerOptions )
             
             filename = doc_id
             orig_docs_words.append( wordsInSentences )
@@ -214,4 +224,22 @@ def load_reuters(setName):
     print "Done. %d docs read, %d empty docs skipped. Totally %d lines" %(readDocNum, emptyFileNum, totalLineNum)
     return setDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, \
                 cats_docsWords, cats_docNames, topN_cats
-    
\ No newline at end of file
+
+# key of a cached tokenized corpus: the corpus, the set, and the tokenizer options
+def corpusCacheKey(corpusName, setName):
+    options = ( tokenizerOptions['remove_url'], tokenizerOptions['remove_punc'], tokenizerOptions['min_length'] )
+    return makeCorpusCacheKey( corpusName, setName, ( "LDA", options ) )
+
+corpus2loader = { '20news': load_20news, 'reuters': load_reuters }
+
+# load a corpus from its cache '<corpus>-<set>.lda-corpus.npz'. If not cached, load it with
+# its loader, and save it in the cache. The cache is not shared with corpusLoader.py of the repo root,
+# whose tokenizer is different
+def load_corpus_cached(corpusName, setName):
+    cacheFilename = "%s-%s.lda-corpus.npz" %( corpusName, setName )
+    key = corpusCacheKey(corpusName, setName)
+    corpus = load_corpus_cache(cacheFilename, key)
+    if corpus is None:
+        corpus = corpus2loader[corpusName](setName)
+        save_corpus_cache(cacheFilename, key, corpus)
+    return corpus
@@ -8,15 +8,10 @@ from sklearn.datasets import load_svmlight_file
 from scipy.sparse import csr_matrix
 from corpusLoader import *
 
-# Ͽӳ䵽غ֮
-corpus2loader = { '20news': load_20news, 'reuters': load_reuters }
-
 def usage():
     print """Usage: ldaExp.py corpus_name"""
 
 corpusName = sys.argv[1]
-# غ
-loader = corpus2loader[corpusName]
 
 # 20newsĵЩһЩ
 if corpusName == "20news":
@@ -38,7 +33,7 @@ for setName in setNames:
     
     # ϵtraintestӼԾΪλ orig_docs_wordsȷ orig_docs_cat
     setDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, cats_docsWords, \
-            cats_docNames, category_names = loader(setName)
+            cats_docNames, category_names = load_corpus_cached(corpusName, setName)
     # ļǰ׺
     basename = "%s-%s-%d" %( corpusName, setName, setDocNum )
     basenames.append(basename)
@@ -112,6 +107,8 @@ for i in xrange(2):
     
     # óһӼ (traintest)
     subcorpus, labels = subcorpora[i]
+    # the same topic proportions in the binary format read by classEval.py. Column k is feature k
+    docs_topicprop = np.zeros( ( len(subcorpus), topicNum ) )
 
     # Ӽÿĵ
     for d, doc_pairs in enumerate(subcorpus):
@@ -122,6 +119,8 @@ for i in xrange(2):
         # KKsvmlightʽ
         for k, prop in topic_props:
             LDA.write(" %d:%.3f" %(k, prop) )
+            docs_topicprop[d, k] = prop
         LDA.write("\n")
     LDA.close()
     print "%d docs saved" %len(subcorpus)
+    save_features( "%s.svm-lda.npz" %basenames[i], docs_topicprop, labels )
@@ -4,7 +4,7 @@ import pdb
 from utils import *
 
 topic_vec_file = sys.argv[1]
-T = load_matrix_from_text( topic_vec_file, "topic" )
+T = load_matrix( topic_vec_file, "topic" )
 K = T.shape[0]
 cosine_mat = []
 for x in xrange(K):
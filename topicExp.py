@@ -2,6 +2,9 @@ import sys
 import pdb
 import os
 import getopt
+import itertools
+import multiprocessing
+from scipy.sparse import csr_matrix, hstack
 from corpusLoader import *
 from utils import *
 from topicvecDir import topicvecDir
@@ -39,6 +42,10 @@ config = dict(  unigramFilename = "top1grams-wiki.txt",
                 zero_topic0 = True,
                 remove_stop = True,
                 useDrdtApprox = False,
+                bow_Estep = True,
+                keep_Pi = False,
+                # number of worker processes in the E-step
+                Estep_processes = 1,
                 verbose = 0,
                 seed = 0,
                 printTopics_iterNum = 10,
@@ -46,20 +53,57 @@ config = dict(  unigramFilename = "top1grams-wiki.txt",
                 VStep_iterNum = 5
             )
 
+# " idx:count" features of row i of the CSR matrix M, formatted in one go
+def sparseRowFeats( M, i, idxOffset=0 ):
+    start, end = M.indptr[i], M.indptr[i+1]
+    feats = [0] * ( 2 * (end - start) )
+    feats[0::2] = ( M.indices[start:end] + idxOffset ).tolist()
+    feats[1::2] = M.data[start:end].tolist()
+    return ( " %d:%d" * (end - start) ) %tuple(feats)
+
+# format string of the " idx:value" features of a dense row, with the indices filled in
+def denseFeatsFormat( dim, idxOffset=0 ):
+    return "".join( " %d:%%.3f" %( n + 1 + idxOffset ) for n in xrange(dim) )
+
+# inference on the documents of a category, in separate category training.
+# With -p, it's run in the worker processes forked after topicvec is set up, so the embeddings
+# are shared (copy-on-write) by all the workers
+# With -p, each category is seeded by its ID, so the topics don't depend on which process runs it, 
+# or on the categories run before it in that process. Without -p, the seed option is used as is
+# returns ( number of docs, best_last_Ts, Em )
+def inferCategory(catID):
+    out("")
+    out( "Inference on category %d:" %( catID+1 ) )
+    if catProcesses > 1:
+        # seed 0 means no seeding, and forked workers would draw the same random topics
+        topicvec.seed = ( config['seed'] or 1 ) + catID
+    # no topics of the previous category are carried over
+    topicvec.T = None
+    cat_docs_idx = topicvec.setDocs( cats_docsWords[catID], cats_docNames[catID], 
+                            docsWidsFile = basename + "-cat%d.wids.npz" %( catID+1 ), 
+                            docsKey = docsKey + " cat %d" %catID )
+    cat_best_last_Ts, cat_Em, cat_docs_Em, cat_Pi = topicvec.inference( 
+                            basename + "-cat%d.checkpoint.npz" %( catID+1 ), resumeTraining )
+    return len(cat_docs_idx), cat_best_last_Ts, cat_Em
+
 def usage():
     print """Usage: topicExp.py -s                corpus_name set_name(s)
                    -i topic_vec_file corpus_name set_name(s)
                    [ -w ]            corpus_name set_name(s)
                    (Optional) -t max_iter_num ...
+                   (Optional) -R ...
+                   (Optional) -s -p process_num ...
   corpus_name: '20news' or  'reuters'
   set_name(s): 'train', 'test' or 'train,test' (will save in separate files)
   -s:          Train on separate categories
   -i:          Do inference on a corpus given a topic vec file
   -w:          Dump words only (no inference of topics)
-  -t:          Specify the maximum number of iterations"""
+  -t:          Specify the maximum number of iterations
+  -p:          Train the categories in parallel in this number of processes (not on Windows).
+               Each category is seeded by its ID, added to the seed (1 if seeding is off)
+  -R:          Resume training from the checkpoints (saved in '<corpus>-<set>-<docnum>[-cat<id>].checkpoint.npz')"""
   
 corpusName = None
-corpus2loader = { '20news': load_20news, 'reuters': load_reuters }
     
 subsetNames = [ ]
 topic_vec_file = None
@@ -69,9 +113,11 @@ separateCatTraining = False
 onlyInferTopicProp = False
 topicTraitStr = ""
 onlyGetOriginalText = False
+resumeTraining = False
+catProcesses = 1
 
 try:
-    opts, args = getopt.getopt( sys.argv[1:], "i:t:wso" )
+    opts, args = getopt.getopt( sys.argv[1:], "i:t:wsoRp:" )
 
     if len(args) == 0:
         raise getopt.GetoptError("Not enough free arguments")
@@ -99,12 +145,25 @@ try:
             separateCatTraining = True
         if opt == '-o':
             onlyGetOriginalText = True
+        if opt == '-R':
+            resumeTraining = True
+        if opt == '-p':
+            catProcesses = int(arg)
             
 except getopt.GetoptError, e:
     print e.msg
     usage()
     sys.exit(2)
 
+if catProcesses > 1:
+    if os.name == 'nt':
+        # the workers need fork() to share topicvec
+        print "Categories are trained in one process on Windows"
+        catProcesses = 1
+    else:
+        # the category workers are daemonic processes, which can't start E-step workers
+        config['Estep_processes'] = 1
+
 if not onlyGetOriginalText:
 # The leading 'all-mapping' is only to get word mappings from the original IDs in 
 # the embedding file to a compact word ID list, to speed up computation of sLDA
@@ -117,7 +176,6 @@ if MAX_ITERS > 0:
     else:
         config['MAX_EM_ITERS'] = MAX_ITERS
 
-loader = corpus2loader[corpusName]
 wid2compactId = {}
 compactId_words = []
 hasIdMapping = False
@@ -126,7 +184,8 @@ if onlyInferTopicProp:
     topicfile_trunk = topic_vec_file.split(".")[0]
     topicTraits = topicfile_trunk.split("-")[3:]
     topicTraitStr = "-".join(topicTraits)
-    T = load_matrix_from_text( topic_vec_file, "topic" )
+    # topics in the text format (.topic.vec) or the binary format (.topic.npz)
+    T = load_matrix( topic_vec_file, "topic" )
     config['K'] = T.shape[0]
 
 config['logfilename'] = corpusName
@@ -141,8 +200,10 @@ for si, subsetName in enumerate(subsetNames):
     else:
         onlyGetWidMapping = False
         
+    # the tokenized corpus and the word ids of the docs are cached, and reused in later runs
     subsetDocNum, orig_docs_words, orig_docs_name, orig_docs_cat, cats_docsWords, \
-            cats_docNames, category_names = loader(subsetName)
+            cats_docNames, category_names = load_corpus_cached(corpusName, subsetName)
+    docsKey = corpusCacheKey(corpusName, subsetName)
     catNum = len(category_names)
     basename = "%s-%s-%d" %( corpusName, subsetName, subsetDocNum )
 
@@ -161,7 +222,8 @@ for si, subsetName in enumerate(subsetNames):
     if onlyGetOriginalText:
         continue
         
-    docs_idx = topicvec.setDocs( orig_docs_words, orig_docs_name )
+    docs_idx = topicvec.setDocs( orig_docs_words, orig_docs_name, 
+                                    docsWidsFile = basename + ".wids.npz", docsKey = docsKey )
     docs_name = [ orig_docs_name[i] for i in docs_idx ]
     docs_cat = [ orig_docs_cat[i] for i in docs_idx ]
     readDocNum = len(docs_idx)
@@ -172,11 +234,11 @@ for si, subsetName in enumerate(subsetNames):
     if onlyGetWidMapping:
         sorted_wids = sorted( topicvec.wid2freq.keys() )
         uniq_wid_num = len(sorted_wids)
-        for i, wid in enumerate(sorted_wids):
-            # svm feature index cannot be 0
-            # +1 to avoid 0 being used as a feature index
-            wid2compactId[wid] = i + 1
-            compactId_words.append( topicvec.vocab[wid] )
+        # svm feature index cannot be 0
+        # +1 to avoid 0 being used as a feature index
+        wid2compactId = np.zeros( topicvec.vocab_size, dtype=np.int32 )
+        wid2compactId[sorted_wids] = np.arange( 1, uniq_wid_num + 1 )
+        compactId_words = [ topicvec.vocab[wid] for wid in sorted_wids ]
             
         hasIdMapping = True
         onlyGetWidMapping = False
@@ -188,134 +250,80 @@ for si, subsetName in enumerate(subsetNames):
         ID2WORD.close()
         continue
             
-    # dump words in stanford classifier format
-    stanford_filename = "%s.stanford-bow.txt" %basename
-    STANFORD = open( stanford_filename, "w" )
-    for i in xrange(readDocNum):
-        wids = topicvec.docs_wids[i]
-        words = [ topicvec.vocab[j] for j in wids ]
-        text = " ".join(words)
-        catID = docs_cat[i]
-        category = category_names[catID]
-        doc_name = docs_name[i]
-        STANFORD.write( "%s\t%s\t%s\n" %( category, doc_name, text ) )
-    
-    STANFORD.close()
-    print "%d docs saved in '%s' in stanford bow format" %( readDocNum, stanford_filename )
+    # load topics from a file, infer the topic proportions, and save the proportions
+    # the topic features are exported below, together with the BOW features
+    if onlyInferTopicProp:
+        # the score table of the topics is saved next to the topic file, and reused in later runs
+        docs_Em, docs_Pi = topicvec.inferTopicProps( T, config['MAX_TopicProp_ITERS'], 
+                                                        topic_vec_file + ".score.npz" )
+        # dump the topic proportions in my own matrix formats
+        topicvec.saveTopicProps( basename + "-%s-i%d" %(topicTraitStr, config['MAX_TopicProp_ITERS']), 
+                                    docs_Em, config['MAX_TopicProp_ITERS'], docs_cat, docs_name )
+
+    # doc x compact word id counts, from which all BOW formats are written
+    docs_cwids = wid2compactId[topicvec.corpus_wids]
+    docs_bow = csr_matrix( ( np.ones(topicvec.totalL), ( topicvec.corpus_docIDs, docs_cwids ) ), 
+                                shape=( readDocNum, uniq_wid_num + 1 ) )
+    docs_bow.sum_duplicates()
 
-    # dump words in sLDA format
+    # stanford classifier format
+    stanford_filename = "%s.stanford-bow.txt" %basename
+    # sLDA format
     slda_bow_filename = "%s.slda-bow.txt" %basename
     slda_label_filename = "%s.slda-label.txt" %basename
+    # libsvm/svmlight format
+    svmbow_filename = "%s.svm-bow.txt" %basename
+    STANFORD = open( stanford_filename, "w" )
     SLDA_BOW = open( slda_bow_filename, "w" )
     SLDA_LABEL = open( slda_label_filename, "w" )
+    SVMBOW = open( svmbow_filename, "w" )
+    
+    if onlyInferTopicProp:
+        # topic proportions in SVMTOPIC_PROP, the mix of word freqs and topic proportions in SVMTOPIC_BOW,
+        # topic props + average of word vectors in SVMTOPIC_WVAVG, all in libsvm/svmlight format
+        svmtopicprop_filename = "%s.svm-topicprop.txt" %basename
+        svmtopicbow_filename = "%s.svm-topicbow.txt" %basename
+        svmtopic_wvavg_filename = "%s.svm-topic-wvavg.txt" %basename
+        SVMTOPIC_PROP = open( svmtopicprop_filename, "w" )
+        SVMTOPIC_BOW = open( svmtopicbow_filename, "w" )
+        SVMTOPIC_WVAVG = open( svmtopic_wvavg_filename, "w" )
+        
+        # average of the word vectors of each doc
+        docs_wordvec_avg = csr_matrix( ( np.ones(topicvec.totalL), ( topicvec.corpus_docIDs, topicvec.corpus_wids ) ),
+                                        shape=( readDocNum, topicvec.vocab_size ) ).dot(topicvec.V)
+        docs_wordvec_avg /= topicvec.docs_L[:, None]
+        topicFeatsFormat = denseFeatsFormat(topicvec.K)
+        # first K indices are reserved for topic features
+        wordvecFeatsFormat = denseFeatsFormat( topicvec.N0, topicvec.K )
     
     for i in xrange(readDocNum):
-        wids = topicvec.docs_wids[i]
-        # compact wid to freq
-        cwid2freq = {}
-        for wid in wids:
-            cwid = wid2compactId[wid]
-            if cwid in cwid2freq:
-                cwid2freq[cwid] += 1
-            else:
-                cwid2freq[cwid] = 1
         catID = docs_cat[i]
-        sorted_cwids = sorted( cwid2freq.keys() )
-        uniq_wid_num = len(sorted_cwids)
+        words = [ topicvec.vocab[j] for j in topicvec.docs_wids[i] ]
+        STANFORD.write( "%s\t%s\t%s\n" %( category_names[catID], docs_name[i], " ".join(words) ) )
+
+        bowFeats = sparseRowFeats( docs_bow, i )
         # sLDA requires class lables to start from 0
         SLDA_LABEL.write( "%d\n" %catID )
-        SLDA_BOW.write( "%d" %uniq_wid_num )
-        for cwid in sorted_cwids:
-            SLDA_BOW.write( " %d:%d" %( cwid, cwid2freq[cwid] ) )
-        SLDA_BOW.write("\n")
-            
+        SLDA_BOW.write( "%d%s\n" %( docs_bow.indptr[i+1] - docs_bow.indptr[i], bowFeats ) )
+        SVMBOW.write( "%d%s\n" %( catID+1, bowFeats ) )
+
+        if onlyInferTopicProp:
+            topicFeats = topicFeatsFormat %tuple( docs_Em[i] )
+            SVMTOPIC_PROP.write( "%d%s\n" %( catID+1, topicFeats ) )
+            SVMTOPIC_BOW.write( "%d%s%s\n" %( catID+1, topicFeats, sparseRowFeats( docs_bow, i, topicvec.K ) ) )
+            SVMTOPIC_WVAVG.write( "%d%s%s\n" %( catID+1, topicFeats, 
+                                                    wordvecFeatsFormat %tuple( docs_wordvec_avg[i] ) ) )
+
+    STANFORD.close()
     SLDA_BOW.close()
     SLDA_LABEL.close()
-    
+    SVMBOW.close()
+    print "%d docs saved in '%s' in stanford bow format" %( readDocNum, stanford_filename )
     print "%d docs saved in '%s' and '%s' in sLDA bow format" %( readDocNum, 
                 slda_bow_filename, slda_label_filename )
-        
-    # dump words in libsvm/svmlight format
-    svmbow_filename = "%s.svm-bow.txt" %basename
-    SVMBOW = open( svmbow_filename, "w" )
-    for i in xrange(readDocNum):
-        wids = topicvec.docs_wids[i]
-        cwid2freq = {}
-        for wid in wids:
-            cwid = wid2compactId[wid]
-            if cwid in cwid2freq:
-                cwid2freq[cwid] += 1
-            else:
-                cwid2freq[cwid] = 1
-        catID = docs_cat[i]
-        sorted_cwids = sorted( cwid2freq.keys() )
-        SVMBOW.write( "%d" %(catID+1) )
-        for cwid in sorted_cwids:
-            SVMBOW.write( " %d:%d" %( cwid, cwid2freq[cwid] ) )
-        SVMBOW.write("\n")
-    
-    SVMBOW.close()
     print "%d docs saved in '%s' in svm bow format" %( readDocNum, svmbow_filename )
-        
-    if onlyDumpWords:
-        continue
-    
-    # load topics from a file, infer the topic proportions, and save the proportions
+
     if onlyInferTopicProp:
-        docs_Em, docs_Pi = topicvec.inferTopicProps(T, config['MAX_TopicProp_ITERS'])
-        # dump the topic proportions in my own matrix format
-        save_matrix_as_text( basename + "-%s-i%d.topic.prop" %(topicTraitStr, config['MAX_TopicProp_ITERS']), 
-                                "topic proportion", docs_Em, docs_cat, docs_name, colSep="\t" )
-        
-        # dump the topic proportions into SVMTOPIC_PROP in libsvm/svmlight format
-        # dump the mix of word freqs and topic proportions into SVMTOPIC_BOW in libsvm/svmlight format   
-        svmtopicprop_filename = "%s.svm-topicprop.txt" %basename
-        # topic props + weighted sum of topic vectors
-        svmtopicbow_filename = "%s.svm-topicbow.txt" %basename
-        svmtopic_wvavg_filename = "%s.svm-topic-wvavg.txt" %basename
-        
-        SVMTOPIC_PROP = open( svmtopicprop_filename, "w" )
-        SVMTOPIC_BOW = open( svmtopicbow_filename, "w" )
-        SVMTOPIC_WVAVG = open( svmtopic_wvavg_filename, "w" )
-        
-        wordvec_avg = np.zeros( topicvec.N0 )
-        
-        for i in xrange(readDocNum):
-            wids = topicvec.docs_wids[i]
-            cwid2freq = {}
-            for wid in wids:
-                cwid = wid2compactId[wid]
-                if cwid in cwid2freq:
-                    cwid2freq[cwid] += 1
-                else:
-                    cwid2freq[cwid] = 1
-                
-                wordvec_avg += topicvec.V[wid]
-                    
-            catID = docs_cat[i]
-            sorted_cwids = sorted( cwid2freq.keys() )
-            
-            SVMTOPIC_PROP.write( "%d" %(catID+1) )
-            SVMTOPIC_BOW.write( "%d" %(catID+1) )
-            SVMTOPIC_WVAVG.write( "%d" %(catID+1) )
-            
-            for k in xrange(topicvec.K):
-                SVMTOPIC_PROP.write( " %d:%.3f" %( k+1, docs_Em[i][k] ) )
-                SVMTOPIC_BOW.write( " %d:%.3f" %( k+1, docs_Em[i][k] ) )
-                SVMTOPIC_WVAVG.write( " %d:%.3f" %( k+1, docs_Em[i][k] ) )
-            
-            for cwid in sorted_cwids:
-                # first K indices are reserved for topic features, so add topicvec.K here
-                SVMTOPIC_BOW.write( " %d:%d" %( cwid + topicvec.K, cwid2freq[cwid] ) )
-            
-            wordvec_avg /= topicvec.docs_L[i]
-            for n in xrange(topicvec.N0):
-                SVMTOPIC_WVAVG.write( " %d:%.3f" %( n + 1 + topicvec.K, wordvec_avg[n] ) )
-                
-            SVMTOPIC_PROP.write("\n")    
-            SVMTOPIC_BOW.write("\n")
-            SVMTOPIC_WVAVG.write("\n")
-            
         SVMTOPIC_PROP.close()
         SVMTOPIC_BOW.close()
         SVMTOPIC_WVAVG.close()
@@ -323,97 +331,119 @@ for si, subsetName in enumerate(subsetNames):
         print "%d docs saved in '%s' in svm topicProp format" %( readDocNum, svmtopicprop_filename )
         print "%d docs saved in '%s' in svm topicProp-BOW format" %( readDocNum, svmtopicbow_filename )
         print "%d docs saved in '%s' in svm topicProp-WordvecAvg format" %( readDocNum, svmtopic_wvavg_filename )
+
+    # the svm features also in the binary format, which is read by classEval.py
+    # svm feature indices start from 1, so column j of the matrices is feature j+1
+    docs_label = np.array(docs_cat) + 1
+    save_features( "%s.svm-bow.npz" %basename, docs_bow[:, 1:], docs_label, docs_name )
+    if onlyInferTopicProp:
+        save_features( "%s.svm-topicprop.npz" %basename, docs_Em, docs_label, docs_name )
+        save_features( "%s.svm-topicbow.npz" %basename, hstack( [ csr_matrix(docs_Em), docs_bow[:, 1:] ] ), 
+                        docs_label, docs_name )
+        save_features( "%s.svm-topic-wvavg.npz" %basename, np.hstack( [ docs_Em, docs_wordvec_avg ] ), 
+                        docs_label, docs_name )
         
+    if onlyDumpWords or onlyInferTopicProp:
+        continue
+    
     # infer topics from docs, and save topics and their proportions in each doc
-    else:
-        if not separateCatTraining:
-            best_last_Ts, Em, docs_Em, Pi = topicvec.inference()
+    if not separateCatTraining:
+        best_last_Ts, Em, docs_Em, Pi = topicvec.inference( basename + ".checkpoint.npz", resumeTraining )
 
-            best_it, best_T, best_loglike = best_last_Ts[0]
-            last_it, last_T, last_loglike = best_last_Ts[1]
+        best_it, best_T, best_loglike = best_last_Ts[0]
+        last_it, last_T, last_loglike = best_last_Ts[1]
+        
+        topicvec.saveTopics( basename + "-em%d-best" %best_it, "best topics", best_T, best_it )
+        topicvec.saveTopics( basename + "-em%d-last" %last_it, "last topics", last_T, last_it )
             
-            save_matrix_as_text( basename + "-em%d-best.topic.vec" %best_it, "best topics", best_T  )
-            save_matrix_as_text( basename + "-em%d-last.topic.vec" %last_it, "last topics", last_T  )
-                
-            save_matrix_as_text( basename + "-em%d.topic.prop" %config['MAX_EM_ITERS'], "topic proportion", docs_Em, docs_cat, docs_name, colSep="\t" )
+        topicvec.saveTopicProps( basename + "-em%d" %config['MAX_EM_ITERS'], docs_Em, config['MAX_EM_ITERS'], 
+                                    docs_cat, docs_name )
 
+    else:
+        # infer topics for each category, combine them and save in one file
+        if corpusName == "20news":
+            topicvec.setK( config['sepK_20news'] )
+        else:
+            topicvec.setK( config['sepK_reuters'] )
+            
+        best_T = []
+        last_T = []
+        slim_T = []
+        totalDocNum = 0
+        #pdb.set_trace()
+        
+        if catProcesses > 1:
+            # forked here, after topicvec and the category docs are ready
+            catPool = multiprocessing.Pool( min(catProcesses, catNum) )
+            # results are returned in the order of categories
+            catResults = catPool.imap( inferCategory, xrange(catNum), chunksize=1 )
         else:
-            # infer topics for each category, combine them and save in one file
-            if corpusName == "20news":
-                topicvec.setK( config['sepK_20news'] )
+            catResults = itertools.imap( inferCategory, xrange(catNum) )
+
+        for catID, catResult in enumerate(catResults):
+            cat_docNum, cat_best_last_Ts, cat_Em = catResult
+            totalDocNum += cat_docNum
+            cat_best_it, cat_best_T, cat_best_loglike = cat_best_last_Ts[0]
+            if cat_best_last_Ts[1]:
+                cat_last_it, cat_last_T, cat_last_loglike = cat_best_last_Ts[1]
             else:
-                topicvec.setK( config['sepK_reuters'] )
+                cat_last_it, cat_last_T, cat_last_loglike = cat_best_last_Ts[0]
                 
-            best_T = []
-            last_T = []
-            slim_T = []
-            totalDocNum = 0
-            #pdb.set_trace()
+            # normalize by the number of documents 
+            cat_Em2 = cat_Em / cat_docNum
             
-            for catID in xrange(catNum):
-                out("")
-                out( "Inference on category %d:" %( catID+1 ) )
-                cat_docs_idx = topicvec.setDocs( cats_docsWords[catID], cats_docNames[catID] )
-                totalDocNum += len(cat_docs_idx)
-                cat_best_last_Ts, cat_Em, cat_docs_Em, cat_Pi = topicvec.inference()
-                cat_best_it, cat_best_T, cat_best_loglike = cat_best_last_Ts[0]
-                if cat_best_last_Ts[1]:
-                    cat_last_it, cat_last_T, cat_last_loglike = cat_best_last_Ts[1]
-                else:
-                    cat_last_it, cat_last_T, cat_last_loglike = cat_best_last_Ts[0]
-                    
-                # normalize by the number of documents 
-                cat_Em2 = cat_Em / len(cat_docs_Em)
-                
-                if catID > 0 and config['zero_topic0']:
-                    # remove the redundant null topic
-                    removeNullTopic = True
-                    best_T.append( cat_best_T[1:] )
-                    last_T.append( cat_last_T[1:] )
-                else:
-                    # keep null topic
-                    removeNullTopic = False
-                    best_T.append( cat_best_T )
-                    last_T.append( cat_last_T )
+            if catID > 0 and config['zero_topic0']:
+                # remove the redundant null topic
+                removeNullTopic = True
+                best_T.append( cat_best_T[1:] )
+                last_T.append( cat_last_T[1:] )
+            else:
+                # keep null topic
+                removeNullTopic = False
+                best_T.append( cat_best_T )
+                last_T.append( cat_last_T )
  
-                sorted_tids = sorted( range(topicvec.K), key=lambda k: cat_Em[k], reverse=True )
-                out("Topic normalized mass:")
+            sorted_tids = sorted( range(topicvec.K), key=lambda k: cat_Em[k], reverse=True )
+            out("Topic normalized mass:")
+            s = ""
+            for tid in sorted_tids:
+                s += "%d: %.3f " %( tid, cat_Em2[tid] )
+            out(s)
+            
+            if config['topTopicMassFracThres'] > 0:
+                cat_Em2_thres = np.sum(cat_Em2) / topicvec.K * config['topTopicMassFracThres']
+                out( "Topic normalized mass thres: %.3f" %cat_Em2_thres )
+                top_tids = []
+                for i,tid in enumerate(sorted_tids):
+                    if cat_Em2[tid] <= cat_Em2_thres:
+                        break
+                    if removeNullTopic and tid == 0:
+                        continue
+                    top_tids.append(tid)
+                    
+                out( "Keep top %d topics:" %len(top_tids) )
                 s = ""
-                for tid in sorted_tids:
+                for tid in top_tids:
                     s += "%d: %.3f " %( tid, cat_Em2[tid] )
                 out(s)
                 
-                if config['topTopicMassFracThres'] > 0:
-                    cat_Em2_thres = np.sum(cat_Em2) / topicvec.K * config['topTopicMassFracThres']
-                    out( "Topic normalized mass thres: %.3f" %cat_Em2_thres )
-                    top_tids = []
-                    for i,tid in enumerate(sorted_tids):
-                        if cat_Em2[tid] <= cat_Em2_thres:
-                            break
-                        if removeNullTopic and tid == 0:
-                            continue
-                        top_tids.append(tid)
-                        
-                    out( "Keep top %d topics:" %len(top_tids) )
-                    s = ""
-                    for tid in top_tids:
-                        s += "%d: %.3f " %( tid, cat_Em2[tid] )
-                    out(s)
-                    
-                    slim_cat_T = cat_last_T[top_tids]
-                    slim_T.append(slim_cat_T)
-                
-            out( "Done inference on %d docs in %d categories" %(totalDocNum, catNum) )
+                slim_cat_T = cat_last_T[top_tids]
+                slim_T.append(slim_cat_T)
+            
+        if catProcesses > 1:
+            catPool.close()
+            catPool.join()
+        out( "Done inference on %d docs in %d categories" %(totalDocNum, catNum) )
 
-            best_T = np.concatenate(best_T)
-            last_T = np.concatenate(last_T)
-            save_matrix_as_text( "%s-sep%d-em%d-best.topic.vec" %( basename, best_T.shape[0], 
-                                            topicvec.MAX_EM_ITERS ), "best topics", best_T )
-            save_matrix_as_text( "%s-sep%d-em%d-last.topic.vec" %( basename, last_T.shape[0], 
-                                            topicvec.MAX_EM_ITERS ), "last topics", last_T )
+        best_T = np.concatenate(best_T)
+        last_T = np.concatenate(last_T)
+        topicvec.saveTopics( "%s-sep%d-em%d-best" %( basename, best_T.shape[0], topicvec.MAX_EM_ITERS ), 
+                                        "best topics", best_T, topicvec.MAX_EM_ITERS )
+        topicvec.saveTopics( "%s-sep%d-em%d-last" %( basename, last_T.shape[0], topicvec.MAX_EM_ITERS ), 
+                                        "last topics", last_T, topicvec.MAX_EM_ITERS )
 
-            if config['topTopicMassFracThres'] > 0:
-                slim_T = np.concatenate(slim_T)
-                save_matrix_as_text( "%s-sep%d-em%d-slim.topic.vec" %( basename, slim_T.shape[0], topicvec.MAX_EM_ITERS ), 
-                                            "slim topics", slim_T )
-            
\ No newline at end of file
+        if config['topTopicMassFracThres'] > 0:
+            slim_T = np.concatenate(slim_T)
+            topicvec.saveTopics( "%s-sep%d-em%d-slim" %( basename, slim_T.shape[0], topicvec.MAX_EM_ITERS ), 
+                                        "slim topics", slim_T, topicvec.MAX_EM_ITERS )
+        
\ No newline at end of file
@@ -9,6 +9,15 @@ import pdb
 import time
 import re
 import os
+import itertools
+import multiprocessing
+import multiprocessing.sharedctypes
+import logging
+import ctypes
+import hashlib
+import tempfile
+import shutil
+import scipy.optimize
 from scipy.spatial.distance import cdist
 
 # V: W x N0
@@ -16,9 +25,250 @@ from scipy.spatial.distance import cdist
 # VT: W x K
 # u: W x 1
 # r: K x 1
-# Pi: L x K
+# Pi: (number of E-step rows) x K, the rows are in the order of Estep_wids
 # sum_pi_v: K x N0
 # X = Evv
+# VT_r: W x K, the score table v_w' t_k + r_k, used when T is fixed
+# corpus_wids: totalL x 1, all tokens of all documents concatenated
+# docs_offsets: (D+1) x 1, tokens of doc d are corpus_wids[ docs_offsets[d] : docs_offsets[d+1] ]
+# Estep_wids, Estep_counts: the rows of the E-step. They are the tokens in corpus_wids (counts are all 1),
+#   or in the bag-of-words mode, the unique words of each doc and their counts in the doc
+# Estep_offsets: (D+1) x 1, E-step rows of doc d are Estep_wids[ Estep_offsets[d] : Estep_offsets[d+1] ]
+
+# allocate a numpy array in shared memory. The underlying RawArray is passed 
+# to worker processes when they are created, so the array is never pickled
+def sharedArray(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = int( np.prod(shape) )
+    raw = multiprocessing.sharedctypes.RawArray( ctypes.c_byte, max( size * dtype.itemsize, 1 ) )
+    return raw, np.frombuffer( raw, dtype=dtype, count=size ).reshape(shape)
+
+# add the per-document sums of the rows of M to docs_M
+# docIDs: the document (row index of docs_M) of each row of M. Rows of a document are contiguous
+def addDocsSum(docs_M, M, docIDs):
+    # positions where a new document starts
+    segStarts = np.flatnonzero( np.r_[ True, docIDs[1:] != docIDs[:-1] ] )
+    docs_M[ docIDs[segStarts] ] += np.add.reduceat( M, segStarts, axis=0 )
+
+# E-step on the E-step rows [start, end), in chunks of chunkSize rows.
+# Pi of the rows is written into Pi_out (end-start rows), unless Pi_out is None
+# returns the sums over the rows needed by the M-step and the lowerbound:
+# firstDocID: the document of row 'start'
+# docs_Em: Em of the documents firstDocID, firstDocID+1, ..., the document of row 'end'-1
+#          (partial sums if a document is split across two ranges)
+# sum_pi_v: None if getSum_pi_v is False
+# Pi_entropy: - sum counts * Pi * log(Pi)
+# words_Em: ( words_wids, words_Em ), the unique words of the rows, and words_Em[i][k] = sum counts * Pi[k] 
+#   over the rows of word words_wids[i]. None if getWords_Em is False
+# VT_r: if not None, the scores of the words are looked up in it instead of computed from V and T
+# docs_Em2: if not None, docs_Em of the last E-step (of all docs), and the rows are all E-step rows.
+#   The docs whose topic mass moved by less than freezeTolerance (fraction of the doc length) are frozen, 
+#   and frozenStats = ( docs_frozen, frozen_sum_pi_v, frozen_Pi_entropy ) of these docs is also returned. 
+#   Docs with rows outside [start, end) are never frozen. At least minActiveFrac of the docs stay active, 
+#   the docs that moved the most
+def EstepRows( V, T, r, psiDocs_theta, wids, docIDs, counts, start, end, chunkSize, Pi_out, 
+                    getSum_pi_v, getWords_Em=False, VT_r=None, docs_Em2=None, freezeTolerance=0, minActiveFrac=0 ):
+    firstDocID = docIDs[start]
+    docs_Em = np.zeros( ( docIDs[end-1] - firstDocID + 1, T.shape[0] ) )
+    if getSum_pi_v:
+        sum_pi_v = np.zeros( T.shape )
+    else:
+        sum_pi_v = None
+    if getWords_Em:
+        # only the words in the rows are kept, so that a worker sends back little more than its rows
+        words_wids = np.unique( wids[start:end] )
+        words_Em = np.zeros( ( len(words_wids), T.shape[0] ) )
+    Pi_entropy = 0
+
+    freezing = docs_Em2 is not None
+    if freezing:
+        docs_frozen = np.zeros( len(docs_Em), dtype=bool )
+        docs_entropy = np.zeros( len(docs_Em) )
+        # the docs at the ends of the range may have rows in the neighbouring ranges
+        firstDocSplit = start > 0 and docIDs[start-1] == firstDocID
+        lastDocSplit = end < len(docIDs) and docIDs[end] == docIDs[end-1]
+        if getSum_pi_v:
+            frozen_sum_pi_v = np.zeros( T.shape )
+            # sum_pi_v of the doc that goes on in the next chunk, added when it's known to be frozen or not
+            open_sum_pi_v = np.zeros( T.shape )
+        else:
+            frozen_sum_pi_v = None
+        openDoc = -1
+        # numbers of the docs decided so far, and of the active ones among them
+        doneNum = activeNum = 0
+
+    for cstart in xrange( start, end, chunkSize ):
+        cend = min( cstart + chunkSize, end )
+        if VT_r is None:
+            # Vd: chunk x N0
+            Vd = V[ wids[cstart:cend] ]
+            TV = np.dot( Vd, T.T )
+            Pi = normalize( np.exp( psiDocs_theta[ docIDs[cstart:cend] ] + TV + r ) )
+        else:
+            Pi = normalize( np.exp( psiDocs_theta[ docIDs[cstart:cend] ] + VT_r[ wids[cstart:cend] ] ) )
+            if getSum_pi_v:
+                Vd = V[ wids[cstart:cend] ]
+        if Pi_out is not None:
+            Pi_out[ cstart - start : cend - start ] = Pi
+
+        chunk_counts = counts[cstart:cend]
+        weighted_Pi = Pi * chunk_counts[:, None]
+        chunkDocIDs = docIDs[cstart:cend] - firstDocID
+        addDocsSum( docs_Em, weighted_Pi, chunkDocIDs )
+        if getWords_Em:
+            # row index of each word in words_Em
+            chunkWordIdx = np.searchsorted( words_wids, wids[cstart:cend] )
+            for k in xrange( T.shape[0] ):
+                words_Em[:, k] += np.bincount( chunkWordIdx, weights=weighted_Pi[:, k], 
+                                                minlength=len(words_wids) )
+        rows_entropy = - chunk_counts * np.sum( Pi * np.log(Pi), axis=1 )
+        Pi_entropy += np.sum(rows_entropy)
+
+        if not freezing:
+            if getSum_pi_v:
+                sum_pi_v += np.dot( weighted_Pi.T, Vd )
+            continue
+
+        docs_entropy += np.bincount( chunkDocIDs, weights=rows_entropy, minlength=len(docs_Em) )
+        # docs_Em of the docs before the last doc of the chunk are complete.
+        # So is that of the last doc, unless it goes on in the next chunk
+        lastDoc = chunkDocIDs[-1]
+        lastDocOpen = cend < end and docIDs[cend] == docIDs[cend-1]
+        doneDocs = np.arange( chunkDocIDs[0], lastDoc if lastDocOpen else lastDoc + 1 )
+        if len(doneDocs) > 0:
+            done_Em = docs_Em[doneDocs]
+            # fraction of the topic mass of each doc that moved
+            docs_change = np.sum( np.abs( done_Em - docs_Em2[ doneDocs + firstDocID ] ), axis=1 ) / \
+                                np.maximum( np.sum( done_Em, axis=1 ), 1 )
+            frozen = docs_change < freezeTolerance
+            if firstDocSplit:
+                frozen[ doneDocs == 0 ] = False
+            if lastDocSplit:
+                frozen[ doneDocs == len(docs_Em) - 1 ] = False
+            # at least minActiveFrac of the docs so far stay active. The docs that changed the most are kept
+            doneNum += len(doneDocs)
+            lackNum = int( np.ceil( minActiveFrac * doneNum ) ) - activeNum - np.sum(~frozen)
+            if lackNum > 0:
+                frozenIdx = np.flatnonzero(frozen)
+                frozen[ frozenIdx[ np.argsort( -docs_change[frozenIdx] )[:lackNum] ] ] = False
+            activeNum += np.sum(~frozen)
+            docs_frozen[doneDocs] = frozen
+
+        if getSum_pi_v:
+            rowsOpen = chunkDocIDs == lastDoc if lastDocOpen else np.zeros( cend - cstart, dtype=bool )
+            # the doc left open by the last chunk is done in this chunk, or goes on being open
+            if openDoc >= 0 and not ( lastDocOpen and lastDoc == openDoc ):
+                if docs_frozen[openDoc]:
+                    frozen_sum_pi_v += open_sum_pi_v
+                else:
+                    sum_pi_v += open_sum_pi_v
+                open_sum_pi_v[:] = 0
+            rowsFrozen = docs_frozen[chunkDocIDs] & ~rowsOpen
+            rowsActive = ~( rowsFrozen | rowsOpen )
+            sum_pi_v += np.dot( weighted_Pi[rowsActive].T, Vd[rowsActive] )
+            frozen_sum_pi_v += np.dot( weighted_Pi[rowsFrozen].T, Vd[rowsFrozen] )
+            if lastDocOpen:
+                open_sum_pi_v += np.dot( weighted_Pi[rowsOpen].T, Vd[rowsOpen] )
+        openDoc = lastDoc if lastDocOpen else -1
+
+    if getWords_Em:
+        words_Em = ( words_wids, words_Em )
+    else:
+        words_Em = None
+
+    if freezing:
+        if getSum_pi_v:
+            # sum_pi_v is of all rows
+            sum_pi_v += frozen_sum_pi_v
+        frozenStats = ( docs_frozen, frozen_sum_pi_v, np.sum( docs_entropy[docs_frozen] ) )
+        return firstDocID, docs_Em, sum_pi_v, Pi_entropy, words_Em, frozenStats
+
+    return firstDocID, docs_Em, sum_pi_v, Pi_entropy, words_Em
+
+# arrays shared by the parent process, set up in each worker process of the E-step pool
+EstepWorkerArrays = {}
+
+# sharedArrays: name -> ( raw, shape, dtype ), or name -> array for arrays already shared,
+# e.g. memory-mapped V
+def initEstepWorker(sharedArrays):
+    for name, spec in sharedArrays.iteritems():
+        if isinstance( spec, np.ndarray ):
+            EstepWorkerArrays[name] = spec
+            continue
+        raw, shape, dtype = spec
+        size = int( np.prod(shape) )
+        EstepWorkerArrays[name] = np.frombuffer( raw, dtype=dtype, count=size ).reshape(shape)
+
+# useRowSet: the shard [start, end) is of the row set, whose row indices are in A['rowIdx']
+# useScoreTable: look up the scores in the shared score table A['VT_r']
+# freezeTolerance, minActiveFrac: if freezeTolerance > 0, freeze the docs that moved little since A['docs_Em2'], 
+# as EstepRows()
+def EstepWorker(args):
+    start, end, chunkSize, getSum_pi_v, keepPi, getWords_Em, useRowSet, useScoreTable, freezeTolerance, \
+            minActiveFrac = args
+    A = EstepWorkerArrays
+    if keepPi:
+        Pi_out = A['Pi'][start:end]
+    else:
+        Pi_out = None
+    if useScoreTable:
+        VT_r = A['VT_r']
+    else:
+        VT_r = None
+    if useRowSet:
+        rowIdx = A['rowIdx'][start:end]
+        return EstepRows( A['V'], A['T'], A['r'], A['psiDocs_theta'], A['wids'][rowIdx], A['docIDs'][rowIdx], 
+                            A['counts'][rowIdx], 0, end - start, chunkSize, Pi_out, getSum_pi_v, getWords_Em, VT_r )
+    if freezeTolerance > 0:
+        docs_Em2 = A['docs_Em2']
+    else:
+        docs_Em2 = None
+    return EstepRows( A['V'], A['T'], A['r'], A['psiDocs_theta'], A['wids'], A['docIDs'], A['counts'],
+                        start, end, chunkSize, Pi_out, getSum_pi_v, getWords_Em, VT_r, docs_Em2, freezeTolerance, 
+                        minActiveFrac )
+
+# the topicvecDir object of the parent process, set up in each worker process of the restart pool.
+# The workers are forked, so the object (with the corpus and the embeddings) is shared copy-on-write
+restartWorkerTopicvec = None
+
+def initRestartWorker(topicvec):
+    global restartWorkerTopicvec
+    restartWorkerTopicvec = topicvec
+    # the workers are daemonic processes, which can't start E-step workers
+    topicvec.Estep_processes = 1
+
+def restartWorker(args):
+    return restartWorkerTopicvec.runRestart(*args)
+
+# the EM state returned by each restart. inferenceRestarts() loads the state of the best restart into the object
+restartStateNames = ( 'it', 'T', 'r', 'docs_theta', 'docs_Em', 'Pi_entropy', 'sum_pi_v', 'sum_pi_v_stale', 
+                      'Estep_inputs', 'activeRows', 'activeSet_age', 'docs_frozen', 'frozen_sum_pi_v', 
+                      'frozen_Pi_entropy', 'activeSet_sweepInputs', 'activeDocFrac', 'activeSet_topicDiff' )
+
+# prefixes the log records of a restart, so that the logs of parallel restarts can be told apart
+class restartLogger(logging.LoggerAdapter):
+    def process( self, msg, kwargs ):
+        return "%s%s" %( self.extra['prefix'], msg ), kwargs
+
+# prefixes each line written to the stream, for the screen output of a restart. 
+# A "\r" also starts a line, as the progress lines are overwritten with it
+class linePrefixer(object):
+    def __init__( self, stream, prefix ):
+        self.stream = stream
+        self.prefix = prefix
+        self.atLineStart = True
+
+    def write( self, s ):
+        for piece in re.split( r"([\r\n])", s ):
+            if not piece:
+                continue
+            if self.atLineStart and piece not in ( "\r", "\n" ):
+                self.stream.write(self.prefix)
+            self.stream.write(piece)
+            self.atLineStart = piece in ( "\r", "\n" )
+
+    def flush(self):
+        self.stream.flush()
 
 class topicvecDir:
     def __init__(self, **kwargs):
@@ -59,14 +309,99 @@ class topicvecDir:
         self.calcSum_pi_v_iterNum = kwargs.get( 'calcSum_pi_v_iterNum', 1 )
         # do V-step every few M-steps to speed up. Default: 1 (each M-step)
         self.VStep_iterNum = kwargs.get( 'VStep_iterNum', 1 )
+        # compute the loglike every few iters. It's always computed in the last iter
+        # only the Ts with a loglike are candidates of the best T
         self.calcLike_iterNum = kwargs.get( 'calcLike_iterNum', 1 )
-
+        # number of tokens processed in one batch in the E-step
+        # bounds the memory of the gathered embeddings (Estep_chunk_size x N0)
+        self.Estep_chunk_size = kwargs.get( 'Estep_chunk_size', 100000 )
+        # do the E-step on each unique word of a doc instead of each token, weighted by the word counts.
+        # all occurrences of a word in a doc have the same Pi, so the results are the same
+        self.bow_Estep = kwargs.get( 'bow_Estep', False )
+        # keep the Pi of all E-step rows after each E-step. If False, the E-step only keeps 
+        # the sufficient statistics (docs_Em, sum_pi_v, Pi_entropy), and Pi is recomputed 
+        # from the saved E-step inputs when needed (getDocsPi(), a stale sum_pi_v)
+        self.keep_Pi = kwargs.get( 'keep_Pi', True )
+        # active-set E-step: at a full sweep, documents whose topic mass changed by less than 
+        # activeSet_tolerance (fraction of the doc length) are frozen, and skipped by the E-steps
+        # until the next full sweep. Their statistics are kept from the full sweep.
+        # a full sweep is done every activeSet_sweep_iterNum E-steps. 0: disabled
+        self.activeSet_tolerance = kwargs.get( 'activeSet_tolerance', 0 )
+        self.activeSet_sweep_iterNum = kwargs.get( 'activeSet_sweep_iterNum', 5 )
+        # docs are only frozen while the last M-step moved T by at most activeSet_topicDiffRatio * topicDiff_tolerance,
+        # as a doc that changed little in one E-step keeps changing while T moves fast. 
+        # If T moves faster again, the next E-step is a full sweep
+        self.activeSet_topicDiffRatio = kwargs.get( 'activeSet_topicDiffRatio', 5 )
+        # at least this fraction of the docs stay active after a sweep: the docs that changed the most
+        self.activeSet_minActiveFrac = kwargs.get( 'activeSet_minActiveFrac', 0.1 )
+        # in inferTopicProps(), T and r are fixed. Precompute the scores v_w' t_k + r_k of all words
+        # in a W x K float32 table, so that the E-step only looks up the scores of the words
+        self.useScoreTable = kwargs.get( 'useScoreTable', True )
+        # number of worker processes in the E-step. 1: do the E-step in the main process
+        self.Estep_processes = kwargs.get( 'Estep_processes', 1 )
+        # online inference: the step size of the i-th mini-batch is iniDelta * (online_tau0 + i)^(-online_kappa)
+        # 0.5 < online_kappa <= 1 ensures convergence. online_tau0=1, online_kappa=1 is the schedule of inference()
+        self.online_tau0 = kwargs.get( 'online_tau0', 1 )
+        self.online_kappa = kwargs.get( 'online_kappa', 0.7 )
+        # number of E-step iterations on each mini-batch
+        self.online_localIters = kwargs.get( 'online_localIters', 3 )
+        # (estimated) total number of documents. Statistics of a mini-batch are scaled up to this size.
+        # 0: no scaling
+        self.online_corpusSize = kwargs.get( 'online_corpusSize', 0 )
+
+        # optimizer of T in the M-step, a key of Mstep_optimizers:
+        # 'gd':    one clipped gradient step of size delta = iniDelta/(it+1)
+        # 'lbfgs': Mstep_inner_iters L-BFGS steps on the exact M-step objective sum_pi_v.T + Em.r(T).
+        #          Each step costs one pass over V2, and the E-steps needed to converge are fewer
+        self.Mstep_optimizer = kwargs.get( 'Mstep_optimizer', 'gd' )
+        self.Mstep_inner_iters = kwargs.get( 'Mstep_inner_iters', 5 )
+        self.Mstep_optimizers = { 'gd': self.gdTopicEmbeddings, 'lbfgs': self.lbfgsTopicEmbeddings }
+        if self.Mstep_optimizer not in self.Mstep_optimizers:
+            raise ValueError( "Unknown M-step optimizer '%s'. Choose from: %s" %( self.Mstep_optimizer, 
+                                ", ".join( sorted(self.Mstep_optimizers) ) ) )
         self.useDrdtApprox = kwargs.get( 'useDrdtApprox', False )
         self.Mstep_sample_topwords = kwargs.get( 'Mstep_sample_topwords', 0 )
+        # keep only the embeddings of the top Mstep_sample_topwords words and the words in the documents, 
+        # in a compact matrix built in setDocs(). Needs Mstep_sample_topwords > 0
+        self.subset_embeddings = kwargs.get( 'subset_embeddings', False )
+        # number of words processed in one block when computing r and its gradient
+        # bounds the memory of the block's exp(VT) (Mstep_chunk_size x K)
+        self.Mstep_chunk_size = kwargs.get( 'Mstep_chunk_size', 20000 )
+        # approximate the partition function of r by importance sampling:
+        # the top Mstep_Z_headwords words of V2 are summed exactly, 
+        # and the tail is estimated by Mstep_Z_samples words drawn from u. 0: exact
+        self.Mstep_Z_samples = kwargs.get( 'Mstep_Z_samples', 0 )
+        self.Mstep_Z_headwords = kwargs.get( 'Mstep_Z_headwords', 5000 )
+        # if the estimated relative error of the partition function of any topic is above it,
+        # r is computed exactly
+        self.Mstep_Z_max_relerr = kwargs.get( 'Mstep_Z_max_relerr', 0.05 )
         self.normalize_vecs = kwargs.get( 'normalize_vecs', False )
         self.rebase_vecs = kwargs.get( 'rebase_vecs', False )
         self.rebase_norm_thres = kwargs.get( 'rebase_norm_thres', 0 )
         self.evalKmeans = kwargs.get( 'evalKmeans', False )
+        # initialization of the topics in inference():
+        # 'random':   random directions of magnitude init_l
+        # 'kmeans':   k-means (seeded by k-means++) centers of the corpus words, weighted by frequencies, 
+        #             of magnitude init_l. Runs init_kmeans_iters iterations
+        # 'file':     topics in topic_vec_file (.topic.vec or .topic.npz), e.g. of a previous model or another corpus
+        # 'previous': topics of the previous inference() on this object, e.g. of the previous time slice
+        # the topics missing in the file (or of the previous run) are initialized randomly
+        self.init_topics = kwargs.get( 'init_topics', 'random' )
+        self.init_kmeans_iters = kwargs.get( 'init_kmeans_iters', 10 )
+        # number of E-steps with the initial topics before the first M-step.
+        # With warm-started topics, more E-steps give a better docs_theta to start with
+        self.init_Estep_iters = kwargs.get( 'init_Estep_iters', 1 )
+        # inferenceRestarts(): run inference() with restart_num seeds in restart_processes worker processes
+        # (default: restart_num), and return the restart with the best lowerbound.
+        # if restart_pruneIters > 0, only the restart_keep restarts with the best loglikes 
+        # after restart_pruneIters iters continue
+        self.restart_num = kwargs.get( 'restart_num', 1 )
+        self.restart_processes = kwargs.get( 'restart_processes', 0 )
+        self.restart_pruneIters = kwargs.get( 'restart_pruneIters', 0 )
+        self.restart_keep = kwargs.get( 'restart_keep', 2 )
+        # if a checkpoint file is given to inference(), save the EM state into it every so many iters.
+        # It's always saved in the last iter
+        self.checkpoint_iterNum = kwargs.get( 'checkpoint_iterNum', 10 )
         
         self.D = 0
         self.docsName = "Uninitialized"
@@ -77,16 +412,9 @@ class topicvecDir:
 
         self.vocab_dict = loadUnigramFile(self.unigramFilename)
         
-        embedding_npyfile = self.word_vec_file + ".npy"
-        if os.path.isfile(embedding_npyfile):
-            print "Load embeddings from npy file '%s'" %embedding_npyfile
-            embedding_arrays = np.load(embedding_npyfile)
-            self.V, self.vocab, self.word2ID, skippedWords_whatever = embedding_arrays
-        else:
-            self.V, self.vocab, self.word2ID, skippedWords_whatever = load_embeddings(self.word_vec_file, self.W)
-            embedding_arrays = np.array( [ self.V, self.vocab, self.word2ID, skippedWords_whatever ] )
-            print "Save embeddings to npy file '%s'" %embedding_npyfile
-            np.save( embedding_npyfile, embedding_arrays )
+        # V is memory-mapped from the embedding store, and shared by the E-step workers.
+        # it's never changed in place
+        self.V, self.vocab, self.word2ID, skippedWords_whatever = load_embeddings_cached(self.word_vec_file, self.W)
             
         # map of word -> id of all words with embeddings
         vocab_dict2 = {}
@@ -121,6 +449,16 @@ class topicvecDir:
         # now vocab_dict is only w->id
         self.vocab_dict = vocab_dict2
 
+        # the full vocabulary. In the subset mode, V, vocab, vocab_dict and u are replaced 
+        # by those of the subset in setDocs()
+        self.fullV, self.fullVocab, self.fullVocab_dict, self.fullU = self.V, self.vocab, self.vocab_dict, self.u
+        # fullWids[i]: the id in the full vocabulary of the i-th word in the subset. None: no subset
+        self.fullWids = None
+        self.fullWid2subset = None
+        if self.subset_embeddings and self.Mstep_sample_topwords == 0:
+            print "All words are used in the M-step. subset_embeddings is disabled"
+            self.subset_embeddings = False
+
         # u2 is the top "Mstep_sample_topwords" words of u, 
         # used for a sampling inference (i.e. only the most 
         # important "Mstep_sample_topwords" words are used) in the M-step
@@ -154,11 +492,37 @@ class topicvecDir:
         self.docs_wids = []
         self.wid2freq = []
         self.wids_freq = []
-        self.expVT = None
+        self.corpus_wids = np.zeros( 0, dtype=np.int32 )
+        self.corpus_docIDs = np.zeros( 0, dtype=np.int32 )
+        self.docs_offsets = np.zeros( 1, dtype=np.int64 )
+        self.Estep_wids = self.corpus_wids
+        self.Estep_docIDs = self.corpus_docIDs
+        self.Estep_counts = np.zeros(0)
+        self.Estep_offsets = self.docs_offsets
+        # ( T, Ev_T ) computed by the last calcTopicResiduals()
+        self.Ev_T = None
+        # ( T, r, VT_r ) built by buildScoreTable()
+        self.scoreTable = None
+        # estimated relative error of the partition function in the last calcTopicResiduals()
+        self.Z_relerr = 0
+        self.Z_fallbackCount = 0
+        # ( T, r ) with the exact partition function, computed by exactTopicResiduals()
+        self.exact_r = None
         self.T = self.r = self.sum_pi_v = None
         self.docs_L = []
-        self.docs_Pi = []
+        self.Pi = None
+        # T, r, docs_theta used by the last E-step of updatePiTheta()
+        self.Estep_inputs = None
+        self.resetActiveSet()
         self.docs_theta = []
+        self.docs_Em = None
+        self.Pi_entropy = 0
+        # whether sum_pi_v is older than Pi
+        self.sum_pi_v_stale = False
+        self.Estep_pool = None
+        self.Estep_sharedArrays = None
+        # shared copy of V, kept across inference runs until V changes
+        self.sharedV = None
         self.totalL = 0
         self.kmeans_xtoc = self.kmeans_distances = None
         # current iteration number
@@ -175,10 +539,19 @@ class topicvecDir:
             self.EV = np.tile( self.Ev, (self.K, 1) )
 
     def precompute(self):
-        print "Precompute matrix u_V"
-        # each elem of u multiplies each row of V
-        # Pw_V: Mstep_sample_topwords x N0
-        self.Pw_V = self.u2[:, None] * self.V2
+        headNum = self.Mstep_Z_headwords
+        if self.Mstep_Z_samples > 0 and len(self.V2) > headNum:
+            print "Sample %d tail words for the partition function" %self.Mstep_Z_samples
+            # proposal: u of the tail words. The samples are drawn once and reused in every M-step,
+            # so that r is a smooth function of T
+            tail_u = self.u2[headNum:]
+            self.Z_tailMass = np.sum(tail_u)
+            rng = np.random.RandomState(self.seed)
+            samples = rng.choice( len(tail_u), self.Mstep_Z_samples, p = tail_u / self.Z_tailMass )
+            tailWids, self.Z_tailCounts = np.unique( samples, return_counts=True )
+            self.Z_tailWids = tailWids + headNum
+        else:
+            self.Z_tailWids = None
 
         if self.useDrdtApprox:
             print "Precompute vector Ev"
@@ -189,105 +562,497 @@ class topicvecDir:
                 self.Evv += self.u[wid] * np.outer( self.V[wid], self.V[wid] )
             print "Done."
                     
-    def calcEm(self, docs_Pi):
-        Em = np.zeros(self.K)
-        for d in xrange( len(docs_Pi) ):
-            Em += np.sum( docs_Pi[d], axis=0 )
-        return Em
+    # row ranges [start, end) of the E-step rows, each covering at most Estep_chunk_size rows
+    # rowNum: number of rows, default all E-step rows
+    def chunkRanges(self, rowNum=None):
+        if rowNum is None:
+            rowNum = len(self.Estep_wids)
+        for start in xrange( 0, rowNum, self.Estep_chunk_size ):
+            yield start, min( start + self.Estep_chunk_size, rowNum )
+
+    # split a matrix into per-document views. 
+    # offsets: docs_offsets for rows in the order of corpus_wids, 
+    # Estep_offsets for rows in the order of Estep_wids (e.g. Pi)
+    def splitByDocs(self, M, offsets):
+        return np.split( M, offsets[1:-1] )
+
+    # Em[k] = sum_d sum_j Pi_d[j][k] over all tokens
+    def calcEm(self, Pi):
+        return np.dot( self.Estep_counts, Pi )
+
+    # docs_Em: D x K. docs_Em[d][k] = sum_j Pi_d[j][k] over the tokens of doc d
+    def calcDocsEm(self, Pi):
+        docs_Em = np.zeros( (self.D, Pi.shape[1]) )
+        for start, end in self.chunkRanges():
+            addDocsSum( docs_Em, Pi[start:end] * self.Estep_counts[start:end, None], self.Estep_docIDs[start:end] )
+        return docs_Em
 
     # this actually computes the variational lowerbound, as an approximation of the (intractable) data log-likelihood
+    # computed on all documents at once:
+    # docs_theta, docs_Em: D x K
     def calcLoglikelihood(self):
-        totalLoglike = 0
-
-        for d in xrange(self.D):
-            theta = self.docs_theta[d]
-            Pi = self.docs_Pi[d]
-
-            theta0 = np.sum(theta)
-            entropy = np.sum( gammaln(theta) ) - gammaln(theta0)
-            entropy += (theta0 - self.K) * psi(theta0) - np.sum( (theta - 1) * psi(theta) )
-            entropy -= np.sum( Pi * np.log(Pi) )
-            # this Em is not the total Em calculated by calcEm()
-            # Em[k] = sum_j Pi[j][k]
-            Em = np.sum( Pi, axis=0 )
-            Em_Ephi = ( Em + self.alpha - 1 ) * ( psi(theta) - psi(theta0) )
-            sum_r_pi = np.dot( Em, self.r )
-            loglike = entropy + np.sum(Em_Ephi) + np.trace( np.dot( self.T, self.sum_pi_v.T ) ) + sum_r_pi
-
-            totalLoglike += loglike
-        return totalLoglike
+        # docs_Em and the entropy of Pi are computed with Pi in the E-step
+        docs_Em = self.docs_Em
+        docs_theta = self.docs_theta
+
+        # theta0: D
+        theta0 = np.sum( docs_theta, axis=1 )
+        psi_theta = psi(docs_theta)
+        psi_theta0 = psi(theta0)
+
+        # entropy of the variational Dirichlet of each doc, summed over all docs
+        entropy = np.sum( gammaln(docs_theta) ) - np.sum( gammaln(theta0) )
+        entropy += np.dot( theta0 - self.K, psi_theta0 ) - np.sum( (docs_theta - 1) * psi_theta )
+        # docs_Em[d][k] = sum_j Pi_d[j][k]
+        Em_Ephi = np.sum( ( docs_Em + self.alpha - 1 ) * ( psi_theta - psi_theta0[:, None] ) )
+        sum_r_pi = np.dot( np.sum( docs_Em, axis=0 ), self.exactTopicResiduals() )
+        # sum over all tokens of sum_k Pi[k] * v' t_k. It's a corpus-wide term, added once
+        sum_pi_vt = np.sum( self.T * self.sum_pi_v )
+
+        return entropy + Em_Ephi + sum_pi_vt + sum_r_pi + self.Pi_entropy
 
     def updateTheta(self):
-        for d in xrange(self.D):
-            self.docs_theta[d] = np.sum( self.docs_Pi[d], axis=0 ) + self.alpha
-            
-    def updatePi(self, docs_theta):
-        docs_Pi = []
+        self.docs_theta = self.docs_Em + self.alpha
+
+    # the whole corpus is processed in chunks of E-step rows.
+    # each row looks up psi(theta) of its document by Estep_docIDs,
+    # so a chunk may span several documents.
+    # if the E-step pool is started, the chunks are distributed to the worker processes
+    # T, r: default to self.T, self.r
+    # rowSet: only do the E-step on a subset of rows, made by makeRowSet(). 
+    # Then Pi only has the rows in the set, and docs_Em of the docs not in the set are 0
+    # returns Pi (None if keepPi is False), docs_Em, sum_pi_v (None if getSum_pi_v is False), 
+    # Pi_entropy, words_Em (vocab_size x K, None if getWords_Em is False)
+    # docs_Em2: docs_Em of the last E-step. If given (rowSet must be None), the docs that moved by less than 
+    # activeSet_tolerance are frozen in the same pass, and ( docs_frozen, frozen_sum_pi_v, frozen_Pi_entropy )
+    # of them is appended to the returned tuple
+    def Estep(self, docs_theta, getSum_pi_v=True, keepPi=True, getWords_Em=False, T=None, r=None, rowSet=None,
+                docs_Em2=None):
+        if T is None:
+            T, r = self.T, self.r
         psiDocs_theta = psi(docs_theta)
+        if rowSet is None:
+            wids, docIDs, counts = self.Estep_wids, self.Estep_docIDs, self.Estep_counts
+        else:
+            rowIdx, wids, docIDs, counts = rowSet
+        rowNum = len(wids)
+        # the score table is only valid for the T it's built for
+        if self.scoreTable is not None and self.scoreTable[0] is T:
+            VT_r = self.scoreTable[2]
+        else:
+            VT_r = None
+        docs_Em = np.zeros( (self.D, self.K) )
+        sum_pi_v = np.zeros( (self.K, self.N0) )
+        if getWords_Em:
+            words_Em = np.zeros( (self.vocab_size, self.K) )
+        else:
+            words_Em = None
+        Pi_entropy = 0
+        if docs_Em2 is not None:
+            freezeTolerance = self.activeSet_tolerance
+            minActiveFrac = self.activeSet_minActiveFrac
+            docs_frozen = np.zeros( self.D, dtype=bool )
+            frozen_sum_pi_v = np.zeros( (self.K, self.N0) )
+            frozen_Pi_entropy = 0
+        else:
+            freezeTolerance = minActiveFrac = 0
+        # whether Pi is in the shared buffer
+        sharedPi = False
+
+        # without the shared Pi buffer (keep_Pi is False), an E-step that keeps Pi is done in this process
+        if self.Estep_pool and ( not keepPi or 'Pi' in self.Estep_sharedArrays ):
+            A = self.Estep_sharedArrays
+            A['T'][:] = T
+            A['r'][:] = r
+            A['psiDocs_theta'][:] = psiDocs_theta
+            if rowSet is not None:
+                A['rowIdx'][:rowNum] = rowIdx
+            if docs_Em2 is not None:
+                A['docs_Em2'][:] = docs_Em2
+            # a few shards for each worker to balance the load
+            shardSize = max( rowNum // ( self.Estep_processes * 4 ) + 1, self.Estep_chunk_size )
+            shards = [ ( start, min( start + shardSize, rowNum ), self.Estep_chunk_size, getSum_pi_v, 
+                            keepPi, getWords_Em, rowSet is not None, VT_r is not None and 'VT_r' in A,
+                            freezeTolerance, minActiveFrac ) 
+                                for start in xrange( 0, rowNum, shardSize ) ]
+            shardNum = len(shards)
+            results = self.Estep_pool.imap_unordered( EstepWorker, shards )
+            if keepPi:
+                Pi = A['Pi']
+                sharedPi = True
+            else:
+                Pi = None
+        else:
+            if keepPi:
+                Pi = np.zeros( ( rowNum, self.K ) )
+            else:
+                Pi = None
+            if docs_Em2 is None:
+                ranges = list( self.chunkRanges(rowNum) )
+            else:
+                # docs split across two ranges are never frozen. EstepRows() follows the docs across its chunks
+                ranges = [ ( 0, rowNum ) ]
+            shardNum = len(ranges)
+            results = ( EstepRows( self.V, T, r, psiDocs_theta, wids, docIDs, counts, 
+                                    start, end, self.Estep_chunk_size, 
+                                    Pi[start:end] if keepPi else None, getSum_pi_v, getWords_Em, VT_r, 
+                                    docs_Em2, freezeTolerance, minActiveFrac ) 
+                                for start, end in ranges )
+
+        for i, result in enumerate(results):
+            firstDocID, shard_docs_Em, shard_sum_pi_v, shard_Pi_entropy, shard_words_Em = result[:5]
+            docs_Em[ firstDocID : firstDocID + len(shard_docs_Em) ] += shard_docs_Em
+            if docs_Em2 is not None:
+                shard_docs_frozen, shard_frozen_sum_pi_v, shard_frozen_Pi_entropy = result[5]
+                # a doc split across two shards is never frozen in either
+                docs_frozen[ firstDocID : firstDocID + len(shard_docs_frozen) ] |= shard_docs_frozen
+                if getSum_pi_v:
+                    frozen_sum_pi_v += shard_frozen_sum_pi_v
+                frozen_Pi_entropy += shard_frozen_Pi_entropy
+            if getSum_pi_v:
+                sum_pi_v += shard_sum_pi_v
+            if getWords_Em:
+                shard_wids, shard_words_Em = shard_words_Em
+                words_Em[shard_wids] += shard_words_Em
+            Pi_entropy += shard_Pi_entropy
+            print "\r%d/%d" %( i + 1, shardNum ),
+
+        if sharedPi:
+            # the shared buffer will be overwritten by the next E-step
+            Pi = np.array( Pi[:rowNum] )
+        if not getSum_pi_v:
+            sum_pi_v = None
+            if docs_Em2 is not None:
+                frozen_sum_pi_v = None
+
+        if docs_Em2 is not None:
+            return Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em, ( docs_frozen, frozen_sum_pi_v, frozen_Pi_entropy )
+        return Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em
 
-        for d in xrange(self.D):
-            if d % 50 == 49 or d == self.D - 1:
-                print "\r%d" %(d+1),
+    def updatePi(self, docs_theta):
+        Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, False )
+        return Pi
+
+    # E-step with the current docs_theta, then update docs_theta
+    # sum_pi_v is updated only if getSum_pi_v. Otherwise it's left stale, to save time
+    # Pi is kept in self.Pi only if keep_Pi. The E-step inputs are saved to recompute it
+    # if the active set is enabled, only the active docs are updated, except in a full sweep.
+    # fullSweep: force a full sweep, e.g. in the last iteration
+    def updatePiTheta(self, getSum_pi_v=True, fullSweep=False):
+        self.Estep_inputs = ( self.T, self.r, self.docs_theta )
+
+        canFreeze = self.activeSet_topicDiff <= self.activeSet_topicDiffRatio * self.topicDiff_tolerance
+        # without sum_pi_v of the frozen docs from the sweep, an E-step that needs sum_pi_v is a sweep.
+        # So is an E-step after T moved fast, as the frozen docs would be stale
+        if self.activeRows is not None and not fullSweep and canFreeze and \
+                self.activeSet_age < self.activeSet_sweep_iterNum and \
+                ( not getSum_pi_v or self.frozen_sum_pi_v is not None ):
+            self.activeSet_age += 1
+            self.Pi, self.docs_Em, sum_pi_v, self.Pi_entropy = self.activeEstep( self.docs_theta, getSum_pi_v )
+        elif self.activeSet_tolerance > 0 and self.activeSet_age is not None and canFreeze:
+            # the frozen docs are found in the sweep, and their statistics are kept from it
+            self.Pi, self.docs_Em, sum_pi_v, self.Pi_entropy, words_Em, frozenStats = self.Estep( self.docs_theta, 
+                                                                getSum_pi_v, self.keep_Pi, docs_Em2=self.docs_Em )
+            self.updateActiveSet(frozenStats)
+        else:
+            self.Pi, self.docs_Em, sum_pi_v, self.Pi_entropy, words_Em = self.Estep( self.docs_theta, 
+                                                                                getSum_pi_v, self.keep_Pi )
+            if self.activeSet_tolerance > 0:
+                self.updateActiveSet(None)
 
-            wids = self.docs_wids[d]
-            L = self.docs_L[d]
-            
-            # faster computation, more memory
-            if L <= 20000:
-                # Vd: L x N0
-                Vd = self.V[wids]
-                TV = np.dot( Vd, self.T.T )
-                Pi = np.exp( psiDocs_theta[d] + TV + self.r )
-            # slower but avoids using up memory    
+        self.updateTheta()
+        if getSum_pi_v:
+            self.sum_pi_v = sum_pi_v
+            self.sum_pi_v_stale = False
+        else:
+            self.sum_pi_v_stale = True
+
+    # per-document Pi of the last E-step of updatePiTheta(), in the order of Estep_offsets
+    # if Pi is not kept, it's recomputed from the saved E-step inputs
+    def getDocsPi(self):
+        if self.Pi is not None:
+            Pi = self.Pi
+        elif self.Estep_inputs is not None:
+            if self.activeRows is not None and self.activeSet_age > 0:
+                # Pi of the frozen docs is of the last full sweep
+                T, r, docs_theta = self.activeSet_sweepInputs
+                Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, False, T=T, r=r )
+                T, r, docs_theta = self.Estep_inputs
+                Pi[ self.activeRows[0] ] = self.Estep( docs_theta, False, T=T, r=r, rowSet=self.activeRows )[0]
             else:
-                Pi = np.zeros( (L, self.K) )
-    
-                for i,wid in enumerate(wids):
-                    v = self.V[wid]
-                    Tv = np.dot( self.T, v )
-                    Pi[i] = np.exp( psiDocs_theta[d] + Tv + self.r )
+                T, r, docs_theta = self.Estep_inputs
+                Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, False, T=T, r=r )
+        else:
+            return None
+        return self.splitByDocs( Pi, self.Estep_offsets )
+
+    # all documents are active until the next full sweep
+    def resetActiveSet(self):
+        # row set of the active docs. None: all docs are active
+        self.activeRows = None
+        # number of E-steps since the last full sweep. None: no full sweep yet
+        self.activeSet_age = None
+        self.docs_frozen = None
+        # statistics of the frozen docs, computed with the inputs of the last full sweep
+        self.frozen_sum_pi_v = None
+        self.frozen_Pi_entropy = 0
+        self.activeSet_sweepInputs = None
+        self.activeDocFrac = 1.0
+        # topicDiffNorm of the last M-step. 0: T is fixed, as in inferTopicProps()
+        self.activeSet_topicDiff = 0
+
+    # the E-step rows of the docs in docsMask (a boolean mask over docs)
+    # returns ( row indices, wids, docIDs, counts of the rows )
+    def makeRowSet(self, docsMask):
+        rowIdx = np.flatnonzero( docsMask[self.Estep_docIDs] )
+        return rowIdx, self.Estep_wids[rowIdx], self.Estep_docIDs[rowIdx], self.Estep_counts[rowIdx]
+
+    # after a full sweep, freeze the docs found by it
+    # frozenStats: ( docs_frozen, frozen_sum_pi_v, frozen_Pi_entropy ) returned by the sweep. 
+    # None: no docs are frozen
+    def updateActiveSet(self, frozenStats):
+        self.activeSet_age = 0
+        if frozenStats is None or not np.any( frozenStats[0] ):
+            self.docs_frozen = None
+            self.activeDocFrac = 1.0
+            self.activeRows = None
+            return
+
+        # the frozen docs don't change until the next full sweep. Keep their part of the statistics
+        self.docs_frozen, self.frozen_sum_pi_v, self.frozen_Pi_entropy = frozenStats
+        self.activeDocFrac = 1 - np.sum(self.docs_frozen) * 1.0 / self.D
+        self.activeRows = self.makeRowSet( ~self.docs_frozen )
+        self.activeSet_sweepInputs = self.Estep_inputs
+
+    # E-step on the active docs. The statistics of the frozen docs are added
+    # returns Pi, docs_Em, sum_pi_v, Pi_entropy of all docs, as Estep()
+    def activeEstep(self, docs_theta, getSum_pi_v):
+        Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, getSum_pi_v, self.keep_Pi, 
+                                                                    rowSet=self.activeRows )
+        docs_Em[self.docs_frozen] = self.docs_Em[self.docs_frozen]
+        if getSum_pi_v:
+            sum_pi_v += self.frozen_sum_pi_v
+        Pi_entropy += self.frozen_Pi_entropy
+        if self.keep_Pi:
+            Pi2 = np.array(self.Pi)
+            Pi2[ self.activeRows[0] ] = Pi
+            Pi = Pi2
+        return Pi, docs_Em, sum_pi_v, Pi_entropy
+
+    # the score table VT_r = V T' + r of the current T and r, in float32
+    # scoreTableFile: if given, the table is loaded from it when it's built for the same T, r and vocab,
+    # otherwise the table is built and saved to it
+    def buildScoreTable(self, scoreTableFile=None):
+        # the table is identified by T, r, and the (possibly rebased) embeddings
+        key = hashlib.md5( self.T.tobytes() + self.r.tobytes() + str(self.V.shape) + 
+                                np.sum( self.V, axis=0 ).tobytes() ).hexdigest()
+
+        if scoreTableFile and os.path.isfile(scoreTableFile):
+            tableFile = np.load(scoreTableFile)
+            if str( tableFile['key'] ) == key:
+                self.scoreTable = ( self.T, self.r, tableFile['VT_r'] )
+                print "Score table loaded from '%s'" %scoreTableFile
+                return
+            print "Score table in '%s' is of different topics, rebuild it" %scoreTableFile
+
+        VT_r = np.zeros( ( self.vocab_size, self.K ), dtype=np.float32 )
+        for start in xrange( 0, self.vocab_size, self.Mstep_chunk_size ):
+            end = min( start + self.Mstep_chunk_size, self.vocab_size )
+            VT_r[start:end] = np.dot( self.V[start:end], self.T.T ) + self.r
+        self.scoreTable = ( self.T, self.r, VT_r )
+        print "Score table of %d words built" %self.vocab_size
+
+        if scoreTableFile:
+            np.savez( scoreTableFile, VT_r=VT_r, key=key )
+            print "Score table saved to '%s'" %scoreTableFile
+
+    # worker processes are forked with the shared arrays, which are then updated in each E-step
+    def startEstepPool(self):
+        if self.Estep_processes <= 1 or self.D == 0:
+            return
+
+        if isinstance( self.V, np.memmap ):
+            # the workers map the same pages of the embedding store
+            sharedArrays = { 'V': self.V }
+            self.Estep_sharedArrays = { 'V': self.V }
+        else:
+            if self.sharedV is None or self.sharedV[2] is not self.V:
+                rawV, V = sharedArray( self.V.shape, self.V.dtype )
+                V[:] = self.V
+                self.sharedV = ( rawV, V, self.V )
+
+            sharedArrays = { 'V': ( self.sharedV[0], self.V.shape, self.V.dtype ) }
+            self.Estep_sharedArrays = { 'V': self.sharedV[1] }
+        rowNum = len(self.Estep_wids)
+        sharedSpecs = [ ( 'T', (self.K, self.N0), np.float64, None ), 
+                        ( 'r', (self.K,), np.float64, None ),
+                        ( 'psiDocs_theta', (self.D, self.K), np.float64, None ),
+                        ( 'wids', (rowNum,), np.int32, self.Estep_wids ),
+                        ( 'docIDs', (rowNum,), np.int32, self.Estep_docIDs ),
+                        ( 'counts', (rowNum,), np.float64, self.Estep_counts ) ]
+        if self.keep_Pi:
+            sharedSpecs.append( ( 'Pi', (rowNum, self.K), np.float64, None ) )
+        if self.activeSet_tolerance > 0:
+            sharedSpecs.append( ( 'rowIdx', (rowNum,), np.int64, None ) )
+            sharedSpecs.append( ( 'docs_Em2', (self.D, self.K), np.float64, None ) )
+        if self.scoreTable is not None:
+            VT_r = self.scoreTable[2]
+            sharedSpecs.append( ( 'VT_r', VT_r.shape, VT_r.dtype, VT_r ) )
+        for name, shape, dtype, value in sharedSpecs:
+            raw, M = sharedArray(shape, dtype)
+            if value is not None:
+                M[:] = value
+            sharedArrays[name] = ( raw, shape, dtype )
+            self.Estep_sharedArrays[name] = M
+
+        self.Estep_pool = multiprocessing.Pool( self.Estep_processes, initEstepWorker, (sharedArrays,) )
+        print "E-step on %d processes" %self.Estep_processes
+
+    def stopEstepPool(self):
+        if self.Estep_pool:
+            self.Estep_pool.close()
+            self.Estep_pool.join()
+            self.Estep_pool = None
+            self.Estep_sharedArrays = None
+
+    # sums over the words in V (weighted by u), streamed in blocks of Mstep_chunk_size words,
+    # with the log-sum-exp trick. Returns:
+    # maxVT: the max of v_w' t_k
+    # sumExpVT: sum_w u_w exp(v_w' t_k - maxVT_k)
+    # sumExpVT_V: sum_w u_w exp(v_w' t_k - maxVT_k) v_w
+    def sumExpVT( self, T, V, u ):
+        K = T.shape[0]
+        maxVT = np.full( K, -np.inf )
+        sumExpVT = np.zeros(K)
+        sumExpVT_V = np.zeros( ( K, self.N0 ) )
+
+        for start in xrange( 0, len(V), self.Mstep_chunk_size ):
+            end = min( start + self.Mstep_chunk_size, len(V) )
+            V_chunk = V[start:end]
+            # VT_{i,j} = v_wi' t_j
+            # VT: chunk x K
+            VT = np.dot(V_chunk, T.T)
+            maxVT2 = np.maximum( maxVT, np.max(VT, axis=0) )
+            with np.errstate(under='ignore'):
+                # rescale the sums of the previous blocks to the new max
+                scale = np.exp(maxVT - maxVT2)
+                u_expVT = u[start:end, None] * np.exp( VT - maxVT2 )
+            sumExpVT = sumExpVT * scale + np.sum( u_expVT, axis=0 )
+            sumExpVT_V = sumExpVT_V * scale[:, None] + np.dot( u_expVT.T, V_chunk )
+            maxVT = maxVT2
+
+        return maxVT, sumExpVT, sumExpVT_V
+
+    # the head words are summed exactly, and the tail is estimated with the sampled words.
+    # returns the same sums as sumExpVT(), and the estimated relative error of each topic's sum
+    def sampleSumExpVT( self, T ):
+        headNum = self.Mstep_Z_headwords
+        maxVT, sumExpVT, sumExpVT_V = self.sumExpVT( T, self.V2[:headNum], self.u2[:headNum] )
+
+        sampleNum = self.Mstep_Z_samples
+        tailV = self.V2[self.Z_tailWids]
+        # VT: unique sampled words x K
+        VT = np.dot(tailV, T.T)
+        maxVT2 = np.maximum( maxVT, np.max(VT, axis=0) )
+        with np.errstate(under='ignore'):
+            scale = np.exp(maxVT - maxVT2)
+            expVT = np.exp( VT - maxVT2 )
+        # importance weight of each sample: u_w / ( u_w / Z_tailMass ) = Z_tailMass
+        # mean & variance of the weighted samples
+        tailMean = np.dot( self.Z_tailCounts, expVT ) / sampleNum
+        tailMean2 = np.dot( self.Z_tailCounts, expVT ** 2 ) / sampleNum
+        tailStd = np.sqrt( np.maximum( tailMean2 - tailMean ** 2, 0 ) / sampleNum )
+
+        sumExpVT = sumExpVT * scale + self.Z_tailMass * tailMean
+        sumExpVT_V = sumExpVT_V * scale[:, None] + \
+                        np.dot( ( expVT * self.Z_tailCounts[:, None] ).T, tailV ) * ( self.Z_tailMass / sampleNum )
+        relerr = self.Z_tailMass * tailStd / sumExpVT
+        return maxVT2, sumExpVT, sumExpVT_V, relerr
 
-            Pi = normalize(Pi)
-            docs_Pi.append(Pi)
+    # T is fed as an argument to provide more flexibility
+    # r_k = -log sum_w u_w exp(v_w' t_k), over the words in V2.
+    # In the same pass, Ev_T_k = sum_w u_w exp(v_w' t_k + r_k) v_w is computed for drdT,
+    # and kept in self.Ev_T with T
+    # Zestimator: how the partition function is computed, if the tail is sampled:
+    # 'auto': the sampled estimate, or the exact sums if its relative error is above Mstep_Z_max_relerr
+    # 'sampled' / 'exact': always the sampled estimate / the exact sums
+    def calcTopicResiduals(self, T, Zestimator='auto'):
+        if self.Z_tailWids is not None and Zestimator == 'sampled':
+            maxVT, sumExpVT, sumExpVT_V, relerr = self.sampleSumExpVT(T)
+        elif self.Z_tailWids is not None and Zestimator == 'auto':
+            maxVT, sumExpVT, sumExpVT_V, relerr = self.sampleSumExpVT(T)
+            self.Z_relerr = np.max(relerr)
+            # the estimate is unstable. Fall back to the exact sums
+            if self.Z_relerr > self.Mstep_Z_max_relerr:
+                self.Z_fallbackCount += 1
+                self.fileLogger.debug( "Sampled partition function rel err %.4f > %.4f, computed exactly", 
+                                        self.Z_relerr, self.Mstep_Z_max_relerr )
+                maxVT, sumExpVT, sumExpVT_V = self.sumExpVT( T, self.V2, self.u2 )
+        else:
+            maxVT, sumExpVT, sumExpVT_V = self.sumExpVT( T, self.V2, self.u2 )
 
-        return docs_Pi
+        r = -( maxVT + np.log(sumExpVT) )
+        # Ev_T: K x N0. The expectation of v under p(w|t_k) = u_w exp(v_w' t_k + r_k)
+        self.Ev_T = ( T, sumExpVT_V / sumExpVT[:, None] )
 
-    # T is fed as an argument to provide more flexibility
-    def calcTopicResiduals(self, T):
-        # VT_{i,j} = v_wi' t_j
-        VT = np.dot(self.V2, T.T)
+        return r
 
-        # expVT_{i,j} = exp(v_wi' t_j)
-        # used in the computation of drdt
-        # expVT: Mstep_sample_topwords x K
-        self.expVT = np.exp(VT)
+    # r of self.T with the exact partition function. The sampled estimate of log Z is biased low, 
+    # which would inflate the lowerbound, and make it incomparable to that of an exact run. 
+    # So the lowerbound always uses the exact r. It's kept with T, as T is fixed in inferTopicProps()
+    def exactTopicResiduals(self):
+        if self.Z_tailWids is None:
+            return self.r
+        if self.exact_r is None or self.exact_r[0] is not self.T:
+            self.exact_r = ( self.T, self.calcTopicResiduals( self.T, 'exact' ) )
+        return self.exact_r[1]
+
+    # statScale: scale Em and sum_pi_v, when they are computed on a sample of the corpus
+    # optimizer: a key of Mstep_optimizers. Default: self.Mstep_optimizer
+    def updateTopicEmbeddings(self, statScale=1, optimizer=None):
+        Em = np.sum( self.docs_Em, axis=0 ) * statScale
+        sum_pi_v = self.sum_pi_v * statScale
+        if optimizer is None:
+            optimizer = self.Mstep_optimizer
+
+        T2 = self.Mstep_optimizers[optimizer]( Em, sum_pi_v )
+        maxTStep = np.max( np.linalg.norm( T2 - self.T, axis=1 ) )
 
-        r = -np.log( np.dot(self.u2, self.expVT) )
+        # self.max_l == 0: do not do normalization
+        if self.max_l > 0:
+            for k in xrange( self.K ):
+                # do normalization only if the magnitude > self.max_l
+                if np.linalg.norm( T2[k] ) > self.max_l:
+                    T2[k] = self.max_l * normalizeF( T2[k] )
 
-        return r
+        if self.zero_topic0:
+            T2[0] = np.zeros(self.N0)
+
+        r2 = self.calcTopicResiduals(T2)
+        topicDiffNorm = np.linalg.norm( self.T - T2 )
+        return T2, r2, topicDiffNorm, maxTStep
 
-    def updateTopicEmbeddings(self):
-        Em = self.calcEm( self.docs_Pi )
+    # M-step optimizers. Each takes Em (K) and sum_pi_v (K x N0), and returns the new T,
+    # before the normalization in updateTopicEmbeddings()
+
+    # one gradient step of size self.delta, clipped by max_grad_norm_fraction and max_grad_norm
+    def gdTopicEmbeddings( self, Em, sum_pi_v ):
         if self.grad_scale_Em_base > 0 and np.sum(Em) > self.grad_scale_Em_base:
             grad_scale = self.grad_scale_Em_base / np.sum(Em)
         else:
             grad_scale = 1
                                 
-        # Em: 1 x K vector
-        # r: 1 x K vector
-        # Em_exp_r: 1 x K vector
-        Em_exp_r = Em * np.exp(self.r)
-
-        # d_EwVT_dT: K x N0
-        d_EwVT_dT = np.dot( self.expVT.T, self.Pw_V )
-        # Em_drdT_exact: N0 x K
-        Em_drdT_exact = d_EwVT_dT.T * Em_exp_r
+        # Ev_T is computed together with r. Recompute if T has been changed since then
+        if self.Ev_T is None or self.Ev_T[0] is not self.T:
+            self.calcTopicResiduals(self.T)
 
+        # Em: 1 x K vector
+        # drdT_k = - Ev_T_k
         # Em_drdT: K x N0
-        Em_drdT = Em_drdT_exact.T
+        Em_drdT = Em[:, None] * self.Ev_T[1]
 
         # dLdT, gradT: K x N0
-        dLdT = self.sum_pi_v - Em_drdT
+        dLdT = sum_pi_v - Em_drdT
         gradT = dLdT * self.delta * grad_scale
         
         gradTNorms = np.linalg.norm( gradT, axis=1 )
@@ -303,36 +1068,73 @@ class topicvecDir:
                 gradTScale[k] = min( gradTScale[k], self.max_grad_norm / TNorms[k] )
                     
         gradT *= gradTScale[:, None]
-        T2 = self.T + gradT
-
-        maxTStep = np.max( np.linalg.norm( gradT, axis=1 ) )
-
-        # self.max_l == 0: do not do normalization
-        if self.max_l > 0:
-            for k in xrange( self.K ):
-                # do normalization only if the magnitude > self.max_l
-                if np.linalg.norm( T2[k] ) > self.max_l:
-                    T2[k] = self.max_l * normalizeF( T2[k] )
-
-        if self.zero_topic0:
-            T2[0] = np.zeros(self.N0)
-
-        r2 = self.calcTopicResiduals(T2)
-        topicDiffNorm = np.linalg.norm( self.T - T2 )
-        return T2, r2, topicDiffNorm, maxTStep
+        return self.T + gradT
+
+    # Mstep_inner_iters L-BFGS iterations maximizing sum_k sum_pi_v_k.t_k + Em_k r_k(T), 
+    # i.e. the terms of the lowerbound depending on T, with Pi fixed. 
+    # The objective and the gradient are computed in one calcTopicResiduals() pass
+    def lbfgsTopicEmbeddings( self, Em, sum_pi_v ):
+        # topic 0 is fixed at 0 if zero_topic0
+        k0 = 1 if self.zero_topic0 else 0
+        shape = ( self.K - k0, self.N0 )
+        Em = Em[k0:]
+        sum_pi_v = sum_pi_v[k0:]
+
+        # the partition function is computed the same way in all the evaluations, so that the objective 
+        # stays smooth in the line searches. The sampled estimate is used if it's accurate at the starting T
+        Zestimator = 'exact'
+        if self.Z_tailWids is not None:
+            self.Z_relerr = np.max( self.sampleSumExpVT(self.T)[3] )
+            if self.Z_relerr > self.Mstep_Z_max_relerr:
+                self.Z_fallbackCount += 1
+                self.fileLogger.debug( "Sampled partition function rel err %.4f > %.4f, L-BFGS uses the exact sums", 
+                                        self.Z_relerr, self.Mstep_Z_max_relerr )
+            else:
+                Zestimator = 'sampled'
+
+        def negObjGrad(x):
+            T = x.reshape(shape)
+            r = self.calcTopicResiduals(T, Zestimator)
+            obj = np.sum( T * sum_pi_v ) + np.dot( Em, r )
+            # drdT_k = - Ev_T_k
+            grad = sum_pi_v - Em[:, None] * self.Ev_T[1]
+            return -obj, -grad.ravel()
+
+        x, negObj, info = scipy.optimize.fmin_l_bfgs_b( negObjGrad, self.T[k0:].ravel(), 
+                                                        maxiter=self.Mstep_inner_iters )
+        self.fileLogger.debug( "L-BFGS M-step: objective %.2f, %d iters, %d evaluations", 
+                                -negObj, info['nit'], info['funcalls'] )
+        T2 = self.T.copy()
+        T2[k0:] = x.reshape(shape)
+        return T2
 
     # Pi: L x K
     # sum_pi_v: K x N0
     def calcSum_pi_v(self):
+        if self.Pi is None:
+            # Pi is recomputed chunk by chunk from the inputs of the last E-step
+            T, r, docs_theta = self.Estep_inputs
+            if self.activeRows is not None and self.activeSet_age > 0:
+                Pi, docs_Em, self.sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, True, False, 
+                                                                    T=T, r=r, rowSet=self.activeRows )
+                if self.frozen_sum_pi_v is None:
+                    # the sweep didn't compute sum_pi_v. Compute that of the frozen docs with the sweep's inputs
+                    T, r, docs_theta = self.activeSet_sweepInputs
+                    self.frozen_sum_pi_v = self.Estep( docs_theta, True, False, T=T, r=r, 
+                                                        rowSet=self.makeRowSet(self.docs_frozen) )[2]
+                self.sum_pi_v += self.frozen_sum_pi_v
+            else:
+                Pi, docs_Em, self.sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, True, False, T=T, r=r )
+            self.sum_pi_v_stale = False
+            return
+
         self.sum_pi_v = np.zeros( (self.K, self.N0) )
 
-        for d in xrange(self.D):
-            Pi = self.docs_Pi[d]
-            wids = self.docs_wids[d]
-            #L = self.docs_L[d]
-            #for i in xrange(L):
-            #    self.sum_pi_v += np.outer( Pi[i], self.V[ wids[i] ] )
-            self.sum_pi_v += np.dot( Pi.T, self.V[wids] )
+        for start, end in self.chunkRanges():
+            wids = self.Estep_wids[start:end]
+            weighted_Pi = self.Pi[start:end] * self.Estep_counts[start:end, None]
+            self.sum_pi_v += np.dot( weighted_Pi.T, self.V[wids] )
+        self.sum_pi_v_stale = False
             
     # the returned outputter always output to the log file
     # screenVerboseThres controls when the generated outputter will output to screen
@@ -362,6 +1164,28 @@ class topicvecDir:
                 print s
         return screen_log_progress
 
+    # provenance of the topics learned (or the topic proportions inferred) after iterNum iterations,
+    # saved in the binary topic files
+    def genTopicMeta(self, iterNum):
+        return { 'word_vec_file': self.word_vec_file, 'unigramFilename': self.unigramFilename,
+                 'alpha0': self.alpha0, 'alpha1': self.alpha1, 'iniDelta': self.iniDelta, 
+                 'iterations': iterNum, 'savedTime': time.strftime("%Y-%m-%d %H:%M:%S") }
+
+    # save topics into filetrunk + ".topic.vec" (text) and filetrunk + ".topic.npz" (binary, with the provenance)
+    def saveTopics( self, filetrunk, rowTypeName, T, iterNum ):
+        save_matrix_as_text( filetrunk + ".topic.vec", rowTypeName, T )
+        meta = self.genTopicMeta(iterNum)
+        meta['K'], meta['N0'] = T.shape
+        save_matrix_as_npz( filetrunk + ".topic.npz", rowTypeName, T, meta=meta )
+
+    # save topic proportions of docs into filetrunk + ".topic.prop" (text) and filetrunk + ".topic.prop.npz" (binary)
+    # extraCols are typically the categories and names of the docs
+    def saveTopicProps( self, filetrunk, docs_Em, iterNum, *extraCols ):
+        save_matrix_as_text( filetrunk + ".topic.prop", "topic proportion", docs_Em, *extraCols, colSep="\t" )
+        meta = self.genTopicMeta(iterNum)
+        meta['K'] = docs_Em.shape[1]
+        save_matrix_as_npz( filetrunk + ".topic.prop.npz", "topic proportion", docs_Em, *extraCols, meta=meta )
+
     # topTopicMassFracPrintThres: when a topic's fraction Em[k]/L > topTopicMassFracPrintThres/K, print it
     def printTopWordsInTopics( self, docs_theta, outputToScreen=False ):
         wids2 = self.wid2freq.keys()
@@ -370,10 +1194,6 @@ class topicvecDir:
 
         # row ID: de-duplicated id, also the row idx in the 
         # matrices wids_topics_sim and wids_topics_dot
-        wid2rowID = {}
-        for i, wid in enumerate(wids2):
-            wid2rowID[wid] = i
-
         # the topic prop of each word, indexed by the row ID
         row_topicsProp = np.zeros( wids_topics_sim.shape )
         # word occurrences, indexed bythe row ID
@@ -382,8 +1202,9 @@ class topicvecDir:
         if self.evalKmeans:
             Em = np.bincount(self.kmeans_xtoc)
         else:
-            docs_Pi = self.updatePi(docs_theta)
-            Em = self.calcEm(docs_Pi)
+            # the topic props of words are summed up in the E-step, without keeping Pi
+            Pi, docs_Em, sum_pi_v, Pi_entropy, words_Em = self.Estep( docs_theta, False, False, True )
+            Em = np.sum( docs_Em, axis=0 )
 
         # tids is sorted topic IDs from most frequent to least frequent
         tids = sorted( range(self.K), key=lambda k: Em[k], reverse=True )
@@ -400,15 +1221,11 @@ class topicvecDir:
         else:
             cut_i = i
 
-        for d in xrange(self.D):
-            for i in xrange(self.docs_L[d]):
-                wid = self.docs_wids[d][i]
-                rowID = wid2rowID[wid]
-                if self.evalKmeans:
-                    k = self.kmeans_xtoc[rowID]
-                    row_topicsProp[rowID][k] += 1
-                else:
-                    row_topicsProp[rowID] += docs_Pi[d][i]
+        if self.evalKmeans:
+            # all occurrences of a word go to the cluster of the word
+            row_topicsProp[ np.arange( len(wids2) ), self.kmeans_xtoc ] = row_wordOccur
+        else:
+            row_topicsProp = words_Em[wids2]
             
         # the topic prop of each word, indexed by the row ID
         # take account of the word freq, but dampen it with sqrt
@@ -458,7 +1275,7 @@ class topicvecDir:
                 sim = wids_topics_sim[rowID, k]
                 dotprod = wids_topics_dot[rowID, k]
 
-                line += "%s (%d,%d): %.2f/%.2f/%.2f/%.2f " %( self.vocab[wid], wid, self.wid2freq[wid],
+                line += "%s (%d,%d): %.2f/%.2f/%.2f/%.2f " %( self.vocab[wid], self.fullWid(wid), self.wid2freq[wid],
                                     topicDampedProp, topicProp, sim, dotprod )
 
             out(line)
@@ -483,41 +1300,74 @@ class topicvecDir:
             out(line)
             out("")
 
+    # replace V, vocab, vocab_dict and u by those of the top Mstep_sample_topwords words (used in the M-step)
+    # and the words in the documents. The top words keep their ids, so that V2, u2 and T are unchanged. 
+    # The other words get the ids after them, in the order of their full ids
+    # docWids: the sorted unique ids (in the full vocabulary) of the words in the documents
+    def subsetEmbeddings( self, docWids ):
+        M = self.Mstep_sample_topwords
+        extraWids = docWids[ docWids >= M ]
+
+        self.fullWids = np.concatenate( [ np.arange(M), extraWids ] ).astype(np.int64)
+        # fullWid2subset[wid]: the id in the subset of the word with full id wid. -1: not in the subset
+        self.fullWid2subset = np.full( len(self.fullVocab), -1, dtype=np.int32 )
+        self.fullWid2subset[self.fullWids] = np.arange( len(self.fullWids) )
+        # copied into memory, as a contiguous matrix
+        self.V = np.array( self.fullV[self.fullWids] )
+        self.V2 = self.V[:M]
+        self.vocab = [ self.fullVocab[wid] for wid in self.fullWids ]
+        self.vocab_dict = {}
+        for wid, w in enumerate(self.vocab):
+            # words without unigram probs are not in fullVocab_dict, and are not mapped
+            if self.fullVocab_dict.get(w, -1) == self.fullWids[wid]:
+                self.vocab_dict[w] = wid
+        self.u = self.fullU[self.fullWids]
+        self.vocab_size = len(self.V)
+        print "Embeddings of %d words kept: top %d words, %d other words in docs" %( self.vocab_size, M, 
+                                                                                            len(extraWids) )
+
+    # id of the word in the full vocabulary, for output
+    def fullWid(self, wid):
+        if self.fullWids is None:
+            return wid
+        return self.fullWids[wid]
+
+    # map the words of the docs to word ids. Each distinct word form is looked up once,
+    # and the tokens are mapped as arrays
+    # returns the indices of the non-empty docs, the word ids of all their tokens, the lengths of the docs,
+    # and the word frequencies. The word ids are in the full vocabulary, even if V is a subset
     def docSentences2wids( self, docs_wordsInSentences ):
-        docs_wids = []
-        docs_idx = []
-        countedWC = 0
-        outvocWC = 0
-        stopwordWC = 0
-        wid2freq = {}
-        wids_freq = np.zeros(self.vocab_size)
-
-        for d, wordsInSentences in enumerate(docs_wordsInSentences):
-            wids = []
-            for sentence in wordsInSentences:
-                for w in sentence:
-                    w = w.lower()
-                    if self.remove_stop and w in stopwordDict:
-                        stopwordWC += 1
-                        continue
-
-                    if w in self.vocab_dict:
-                        wid = self.vocab_dict[w]
-                        wids.append(wid)
-                        wids_freq[wid] += 1
-
-                        if wid not in wid2freq:
-                            wid2freq[wid] = 1
-                        else:
-                            wid2freq[wid] += 1
-                        countedWC += 1
-                    else:
-                        outvocWC += 1
-
-            # skip empty documents
-            if len(wids) > 0:
-                docs_wids.append(wids)
-                docs_idx.append(d)
+        # code of each distinct word form: word id, or OOV_CODE / STOP_CODE
+        OOV_CODE = -1
+        STOP_CODE = -2
+        form2id = {}
+        # formIDs: the form id of each token of all docs
+        formIDs = np.fromiter( ( form2id.setdefault( w, len(form2id) ) for wordsInSentences in docs_wordsInSentences
+                                    for sentence in wordsInSentences for w in sentence ), dtype=np.int32 )
+        orig_docs_L = np.array( [ sum( len(sentence) for sentence in wordsInSentences ) 
+                                    for wordsInSentences in docs_wordsInSentences ], dtype=np.int64 )
+
+        formCodes = np.zeros( len(form2id), dtype=np.int32 )
+        for form, formID in form2id.iteritems():
+            w = form.lower()
+            if self.remove_stop and w in stopwordDict:
+                formCodes[formID] = STOP_CODE
+            else:
+                formCodes[formID] = self.fullVocab_dict.get( w, OOV_CODE )
+
+        tokenCodes = formCodes[formIDs]
+        isKept = tokenCodes >= 0
+        stopwordWC = np.count_nonzero( tokenCodes == STOP_CODE )
+        outvocWC = np.count_nonzero( tokenCodes == OOV_CODE )
+        corpus_wids = tokenCodes[isKept]
+        countedWC = len(corpus_wids)
+
+        tokens_docID = np.repeat( np.arange( len(docs_wordsInSentences) ), orig_docs_L )
+        docs_L = np.bincount( tokens_docID[isKept], minlength=len(docs_wordsInSentences) )
+        # skip empty documents
+        docs_idx = np.flatnonzero( docs_L > 0 ).tolist()
+        docs_L = docs_L[docs_idx].astype(np.int64)
+        wid2freq, wids_freq = self.countWids( corpus_wids, len(self.fullVocab) )
 
         # out0 prints both to screen and to log file, regardless of the verbose level
         out0 = self.genOutputter(0)
@@ -530,34 +1380,126 @@ class topicvecDir:
         out1("Top words:")
         line = ""
         for wid, freq in wid_freqs[:30]:
-            line += "%s(%d): %d " %( self.vocab[wid], wid, freq )
+            line += "%s(%d): %d " %( self.fullVocab[wid], wid, freq )
         out1(line)
-        return docs_idx, docs_wids, wid2freq, wids_freq
-
-    def setDocs( self, docs_wordsInSentences, docs_name ):
-        self.totalL = 0
-        self.docs_L = []
+        return docs_idx, corpus_wids, docs_L, wid2freq, wids_freq
+
+    # word frequencies of the tokens in corpus_wids: a dict wid -> freq, and an array of W (default vocab_size)
+    def countWids( self, corpus_wids, W=None ):
+        if W is None:
+            W = self.vocab_size
+        wids_freq = np.bincount( corpus_wids, minlength=W ).astype(np.float64)
+        wids = np.flatnonzero(wids_freq)
+        wid2freq = dict( zip( wids.tolist(), wids_freq[wids].astype(int).tolist() ) )
+        return wid2freq, wids_freq
+
+    # key of the cached word ids of documents. docsKey identifies the documents, 
+    # e.g. the key of a cached corpus. The word ids also depend on the vocabulary and the stop words
+    def docsWidsKey( self, docsKey ):
+        if self.remove_stop:
+            stopwords = "\n".join( sorted(stopwordDict) )
+        else:
+            stopwords = ""
+        return hashlib.md5( "\n".join( [ docsKey, file_md5(self.unigramFilename), "\n".join(self.fullVocab),
+                                            stopwords ] ) ).hexdigest()
+
+    # returns ( docs_idx, corpus_wids, docs_L ) saved by saveDocsWids(), or None if the file 
+    # doesn't exist or is of other documents/vocabulary
+    def loadDocsWids( self, filename, key ):
+        if not os.path.isfile(filename):
+            return None
+        cache = np.load(filename)
+        if cache['key'].item() != key:
+            print "Cached word ids in '%s' are outdated" %filename
+            return None
+        print "Word ids of %d docs loaded from '%s'" %( len( cache['docs_L'] ), filename )
+        return cache['docs_idx'].tolist(), cache['corpus_wids'], cache['docs_L']
+
+    # save the word ids (in the full vocabulary) of the documents, to skip docSentences2wids() next time
+    def saveDocsWids( self, filename, key, docs_idx, corpus_wids, docs_L ):
+        np.savez( filename, key=key, docs_idx=np.array( docs_idx, dtype=np.int32 ), 
+                    corpus_wids=corpus_wids, docs_L=docs_L )
+        print "Word ids of %d docs saved into '%s'" %( len(docs_L), filename )
+
+    # build the compact token store from the word IDs of all tokens, and the lengths of the documents
+    # docs_wids are views into corpus_wids
+    def setTokenStore( self, corpus_wids, docs_L ):
+        self.docs_L = docs_L
+        self.docs_offsets = np.zeros( len(docs_L) + 1, dtype=np.int64 )
+        np.cumsum( self.docs_L, out=self.docs_offsets[1:] )
+        self.totalL = int( self.docs_offsets[-1] )
+        self.corpus_wids = corpus_wids
+        # corpus_docIDs[i]: the document the i-th token belongs to
+        self.corpus_docIDs = np.repeat( np.arange( len(docs_L), dtype=np.int32 ), self.docs_L )
+        self.docs_wids = self.splitByDocs( self.corpus_wids, self.docs_offsets )
+
+        if not self.bow_Estep:
+            self.Estep_wids = self.corpus_wids
+            self.Estep_docIDs = self.corpus_docIDs
+            self.Estep_counts = np.ones(self.totalL)
+            self.Estep_offsets = self.docs_offsets
+        else:
+            # a (doc, word) pair is encoded as doc * vocab_size + wid, 
+            # so that np.unique() sorts the pairs by docs and collapses repeated words within each doc
+            docWordKeys = self.corpus_docIDs.astype(np.int64) * self.vocab_size + self.corpus_wids
+            uniqKeys, counts = np.unique( docWordKeys, return_counts=True )
+            self.Estep_docIDs = ( uniqKeys // self.vocab_size ).astype(np.int32)
+            self.Estep_wids = ( uniqKeys % self.vocab_size ).astype(np.int32)
+            self.Estep_counts = counts.astype(np.float64)
+            self.Estep_offsets = np.zeros( len(docs_L) + 1, dtype=np.int64 )
+            np.cumsum( np.bincount( self.Estep_docIDs, minlength=len(docs_L) ), out=self.Estep_offsets[1:] )
+            print "Bag-of-words E-step: %d tokens -> %d unique words in docs" %( self.totalL, len(self.Estep_wids) )
+
+    # rebaseVecs: False to disable rebasing of vecs even if self.rebase_vecs is True
+    # docsWidsFile: if given, the word ids of the docs are loaded from it if they are cached 
+    # for the same docsKey, vocabulary and stop words. Otherwise they are saved into it
+    # docsKey: identifies docs_wordsInSentences
+    def setDocs( self, docs_wordsInSentences, docs_name, rebaseVecs=True, docsWidsFile=None, docsKey="" ):
         self.docs_name = []
 
-        self.docs_idx, self.docs_wids, self.wid2freq, self.wids_freq = \
-                                    self.docSentences2wids(docs_wordsInSentences)
+        cached = None
+        if docsWidsFile:
+            key = self.docsWidsKey(docsKey)
+            cached = self.loadDocsWids(docsWidsFile, key)
+
+        if cached:
+            self.docs_idx, corpus_wids, docs_L = cached
+            wid2freq = None
+        else:
+            self.docs_idx, corpus_wids, docs_L, wid2freq, wids_freq = self.docSentences2wids(docs_wordsInSentences)
+            if docsWidsFile:
+                self.saveDocsWids( docsWidsFile, key, self.docs_idx, corpus_wids, docs_L )
+
+        if self.subset_embeddings:
+            self.subsetEmbeddings( np.unique(corpus_wids) )
+            corpus_wids = self.fullWid2subset[corpus_wids]
+            wid2freq = None
+            
+        if wid2freq is None:
+            wid2freq, wids_freq = self.countWids(corpus_wids)
+        self.wid2freq, self.wids_freq = wid2freq, wids_freq
 
         for doc_idx in self.docs_idx:
             self.docs_name.append( docs_name[doc_idx] )
-        for wids in self.docs_wids:
-            self.docs_L.append( len(wids) )
-        self.totalL = sum(self.docs_L)
-
-        avgV = np.zeros(self.N0)
-        sum_freq = 0
-        for wid, freq in self.wid2freq.iteritems():
-            avgV += self.V[wid] * freq
-            sum_freq += freq
-        avgV /= sum_freq
+        self.setTokenStore( corpus_wids, docs_L )
+        self.Pi = None
+        self.Estep_inputs = None
+        self.resetActiveSet()
+        # V may be rebased below
+        self.scoreTable = None
+
+        if self.totalL > 0:
+            avgV = np.dot( self.wids_freq, self.V ) / self.totalL
+        else:
+            avgV = np.zeros(self.N0)
         norm_avgV = np.linalg.norm(avgV)
         print "Norm of avg vector: %.2f" %norm_avgV
-        if self.rebase_vecs and norm_avgV >= self.rebase_norm_thres:
-            self.V -= avgV
+        if self.rebase_vecs and rebaseVecs and norm_avgV >= self.rebase_norm_thres:
+            # not in place, as V may be shared with other processes
+            V = np.array(self.V)
+            V -= avgV
+            self.V = V
+            self.V2 = self.V[:self.Mstep_sample_topwords]
             # update the precomputed matrices/vectors
             self.precompute()
             
@@ -576,11 +1518,13 @@ class topicvecDir:
 
         return self.docs_idx
         
-    def kmeans( self, maxiter=10 ):
+    def kmeans( self, maxiter=10, K=None, plusplus=False ):
         """ centers, Xtocentre, distances = topicvec.kmeans( ... )
         in:
             X: M x N0
-            centers K x N0: initial centers, e.g. random.sample( X, K )
+            K: number of centers. Default: self.K
+            centers K x N0: initial centers, random.sample( X, K ), 
+                or k-means++ seeding if plusplus
             iterate until the change of the average distance to centers
                 is within topicDiff_tolerance of the previous average distance
             maxiter
@@ -596,7 +1540,12 @@ class topicvecDir:
         weights = np.array( self.wid2freq.values() )
         
         X = normalizeF( self.V[wids2] )
-        centers = randomsample( X, self.K )
+        if K is None:
+            K = self.K
+        if plusplus:
+            centers = kmeansppSample( X, weights, K )
+        else:
+            centers = randomsample( X, K )
         
         if self.verbose:
             print "kmeans: X %s  centers %s  tolerance=%.2g  maxiter=%d" %(
@@ -622,7 +1571,7 @@ class topicvecDir:
                 
             prevdist = avdist
             
-            for jc in range(self.K):  # (1 pass in C)
+            for jc in range(K):  # (1 pass in C)
                 c = np.where( xtoc == jc )[0]
                 if len(c) > 0:
                     centers[jc] = ( X[c] * weights[c, None] ).mean( axis=0 )
@@ -631,9 +1580,9 @@ class topicvecDir:
             print "kmeans: %d iterations  cluster sizes:" % jiter, np.bincount(xtoc)
             
         if self.verbose >= 2:
-            r50 = np.zeros(self.K)
-            r90 = np.zeros(self.K)
-            for j in range(self.K):
+            r50 = np.zeros(K)
+            r90 = np.zeros(K)
+            for j in range(K):
                 dist = distances[ xtoc == j ]
                 if len(dist) > 0:
                     r50[j], r90[j] = np.percentile( dist, (50, 90) )
@@ -643,26 +1592,37 @@ class topicvecDir:
         self.T = centers
         self.kmeans_xtoc = xtoc
         self.kmeans_distances = distances    
+        return centers, xtoc, distances
     
-    def inferTopicProps( self, T, MAX_ITERS=5 ):
+    # scoreTableFile: where the score table is saved, if useScoreTable
+    def inferTopicProps( self, T, MAX_ITERS=5, scoreTableFile=None ):
 
         self.T = T
         self.r = self.calcTopicResiduals(T)
         # uniform prior
         self.docs_theta = np.ones( (self.D, self.K) )
         loglike = 0
+        self.resetActiveSet()
+        if self.useScoreTable:
+            self.buildScoreTable(scoreTableFile)
+        self.startEstepPool()
 
         for i in xrange(MAX_ITERS):
             iterStartTime = time.time()
-            docs_Pi2 = self.docs_Pi
-            self.docs_Pi = self.updatePi( self.docs_theta )
-            self.updateTheta()
-            self.calcSum_pi_v()
+            Pi2 = self.Pi
+            docs_Em2 = self.docs_Em
+            # sum_pi_v needs the embeddings of all words, which the score table saves.
+            # with the table, it's only computed for the loglike of the last iter
+            getSum_pi_v = ( not self.useScoreTable or i == MAX_ITERS - 1 )
+            self.updatePiTheta( getSum_pi_v, fullSweep = ( i == MAX_ITERS - 1 ) )
             
             if i > 0:
-                docs_Pi_diff = np.zeros(self.D)
-                for d in xrange(self.D):
-                    docs_Pi_diff[d] = np.linalg.norm( self.docs_Pi[d] - docs_Pi2[d] )
+                if self.keep_Pi:
+                    # F-norm of the change of each document's Pi
+                    docs_Pi_diff = np.sqrt( self.calcDocsEm( ( self.Pi - Pi2 ) ** 2 ).sum(axis=1) )
+                else:
+                    # without Pi, measure the change of each document's Em
+                    docs_Pi_diff = np.linalg.norm( self.docs_Em - docs_Em2, axis=1 )
                 max_Pi_diff = np.max(docs_Pi_diff)
                 total_Pi_diff = np.sum(docs_Pi_diff)
             else:
@@ -670,17 +1630,324 @@ class topicvecDir:
                 total_Pi_diff = 0
 
             iterDur = time.time() - iterStartTime
-            loglike = self.calcLoglikelihood()
-            print "Iter %d loglike %.2f, Pi diff total %.3f, max %.3f. %.1fs" %( i, 
-                                 loglike, total_Pi_diff, max_Pi_diff, iterDur )
+            if getSum_pi_v:
+                loglike = self.calcLoglikelihood()
+                loglikeStr = "%.2f" %loglike
+            else:
+                loglikeStr = "-"
+            print "Iter %d loglike %s, %s diff total %.3f, max %.3f, active %.3f. %.1fs" %( i, loglikeStr, 
+                                 "Pi" if self.keep_Pi else "Em", total_Pi_diff, max_Pi_diff, 
+                                 self.activeDocFrac, iterDur )
 
-        docs_Em = np.zeros( (self.D, self.K) )
-        for d, Pi in enumerate(self.docs_Pi):
-            docs_Em[d] = np.sum( Pi, axis=0 )
+        self.stopEstepPool()
+
+        # docs_Pi is None if Pi is not kept. Call getDocsPi() to recompute it
+        if self.keep_Pi:
+            return self.docs_Em, self.getDocsPi()
+        return self.docs_Em, None
+
+    # random topic embeddings of magnitude init_l
+    # the topics are initialized as specified by init_topics
+    def initTopics(self):
+        out0 = self.genOutputter(0)
+        prev_T = self.T
+        self.T = np.zeros( ( self.K, self.N0 ) )
+
+        if self.seed != 0:
+            np.random.seed(self.seed)
+            out0( "Seed: %d" %self.seed )
+
+        for k in xrange(0, self.K):
+            self.T[k] = np.random.randn(self.N0)
+            if self.init_l > 0:
+                self.T[k] = self.init_l * normalizeF(self.T[k])
+
+        # topic 0 is not initialized if zero_topic0
+        k0 = 1 if self.zero_topic0 else 0
+        if self.init_topics == 'kmeans':
+            random_T = self.T
+            # kmeans() sets self.T to the centers
+            centers, xtoc, distances = self.kmeans( self.init_kmeans_iters, self.K - k0, plusplus=True )
+            self.T = random_T
+            # clusters of similar words, of all frequencies, weighted by frequencies
+            for k in xrange( self.K - k0 ):
+                if self.init_l > 0:
+                    self.T[k0 + k] = self.init_l * normalizeF( centers[k] )
+                else:
+                    self.T[k0 + k] = centers[k]
+            out0( "Topics initialized by k-means on %d words" %len(xtoc) )
+        elif self.init_topics == 'file':
+            if not self.topic_vec_file:
+                raise ValueError("topic_vec_file is needed to initialize the topics from a file")
+            init_T = load_matrix( self.topic_vec_file, "initial topic" )
+            if init_T.shape[1] != self.N0:
+                raise ValueError( "Topics in '%s' are %d-d, but the embeddings are %d-d" %( self.topic_vec_file, 
+                                    init_T.shape[1], self.N0 ) )
+            initK = min( len(init_T), self.K )
+            self.T[k0:initK] = init_T[k0:initK]
+            out0( "%d topics initialized from '%s'" %( initK, self.topic_vec_file ) )
+        elif self.init_topics == 'previous':
+            if prev_T is not None and prev_T.shape[1] == self.N0:
+                initK = min( len(prev_T), self.K )
+                self.T[k0:initK] = prev_T[k0:initK]
+                out0( "%d topics initialized from the previous run" %initK )
+            else:
+                out0( "No topics of the previous run. Initialized randomly" )
+        elif self.init_topics != 'random':
+            raise ValueError( "Unknown topic initialization '%s'" %self.init_topics )
+
+        if self.zero_topic0:
+            self.T[0] = np.zeros(self.N0)
+
+    # online (stochastic) variational EM on a stream of documents
+    # getDocBatches(): returns an iterator of mini-batches ( docs_wordsInSentences, docs_name ).
+    # It's called once in each pass, so it can be a generator function reading from files.
+    # Only one mini-batch, and its Pi, is in memory at any time.
+    # On each mini-batch, the E-step is done with the current topics, 
+    # then T is updated by one gradient step computed on the mini-batch
+    def inferenceOnline( self, getDocBatches, passes=1 ):
+        startTime = time.time()
+        out0 = self.genOutputter(0)
+        out0( "%d topics." %(self.K) )
+        out0( "Online inference starts at %s" %timeToStr(startTime) )
+        if self.rebase_vecs:
+            out0( "rebase_vecs is disabled in online inference" )
+
+        self.initTopics()
+        self.r = self.calcTopicResiduals(self.T)
+        self.it = 0
+        loglike = 0
+        totalDocNum = 0
+
+        for p in xrange(passes):
+            # Em accumulated on all mini-batches in the current pass
+            Em = np.zeros(self.K)
+
+            for docs_wordsInSentences, docs_name in getDocBatches():
+                lastIterEndTime = time.time()
+                self.setDocs( docs_wordsInSentences, docs_name, rebaseVecs=False )
+                if self.D == 0:
+                    continue
+
+                # E-step on the mini-batch, starting from uniform theta
+                self.docs_theta = np.ones( (self.D, self.K) )
+                self.startEstepPool()
+                for i in xrange(self.online_localIters):
+                    self.updatePiTheta( i == self.online_localIters - 1 )
+                self.stopEstepPool()
+                loglike = self.calcLoglikelihood()
+                Em += np.sum( self.docs_Em, axis=0 )
+                totalDocNum += self.D
+
+                if self.online_corpusSize > 0:
+                    statScale = self.online_corpusSize * 1.0 / self.D
+                else:
+                    statScale = 1
+
+                self.it += 1
+                self.delta = self.iniDelta * ( self.online_tau0 + self.it ) ** (-self.online_kappa)
+                # the updates on mini-batches need the decaying step size of gradient descent
+                self.T, self.r, topicDiffNorm, maxTStep = self.updateTopicEmbeddings(statScale, 'gd')
+
+                iterDur = time.time() - lastIterEndTime
+                iterStatusMsg = "Pass %d batch %d: %d docs, loglike/token %.3f, step %.4f, topicDiffNorm %.4f, %.1fs" %( 
+                                    p + 1, self.it, self.D, loglike / self.totalL, self.delta, topicDiffNorm, iterDur )
+
+                if self.it % self.printTopics_iterNum == 0:
+                    out0(iterStatusMsg)
+                    self.printTopWordsInTopics(self.docs_theta, False)
+                else:
+                    print "%s  \r" %iterStatusMsg,
+                    self.fileLogger.debug(iterStatusMsg)
+
+        if self.verbose >= 1 and self.D > 0 and self.it % self.printTopics_iterNum != 0:
+            self.printTopWordsInTopics(self.docs_theta, False)
 
-        return docs_Em, self.docs_Pi
+        endTime = time.time()
+        print
+        out0( "Online inference ends at %s. %d docs in %d batches, %d seconds." %( timeToStr(endTime), 
+                                totalDocNum, self.it, int(endTime - startTime) ) )
+
+        # there's no lowerbound on the whole corpus to select the best T, so only the last T is returned.
+        # loglike is of the last mini-batch
+        last_T = [ self.it, self.T, loglike ]
+        return [ last_T, last_T ], Em
+
+    # identifies the config and the documents of a run, so that a checkpoint is only resumed by the same run
+    def checkpointKey(self):
+        config = [ self.K, self.N0, self.alpha0, self.alpha1, self.iniDelta, self.max_l, self.zero_topic0, 
+                    self.seed, self.Mstep_optimizer, self.Mstep_sample_topwords, self.word_vec_file, 
+                    self.unigramFilename ]
+        return hashlib.md5( str(config) + self.corpus_wids.tobytes() + self.docs_offsets.tobytes() ).hexdigest()
+
+    # save the EM state of the current iter: T, r, the inputs of the last E-step, 
+    # the best and the last topics, and the state of the random number generator.
+    # Written into a temporary file first, then renamed, so a crash never leaves a partial checkpoint
+    def saveCheckpoint( self, checkpointFile, best_T_loglike, last_T_loglike, topicDiffNorm ):
+        Estep_T, Estep_r, docs_theta = self.Estep_inputs
+        T, r = self.T, self.r
+        # it == -1: no topics with a loglike yet
+        best_it, best_T, best_loglike = best_T_loglike or [ -1, T, 0 ]
+        last_it, last_T, last_loglike = last_T_loglike or [ -1, T, 0 ]
+        rngName, rngKeys, rngPos, rngHasGauss, rngCachedGaussian = np.random.get_state()
+
+        # np.savez() appends ".npz" to the file name if it doesn't end with it
+        tmpFilename = checkpointFile + ".tmp.npz"
+        np.savez( tmpFilename, key=self.checkpointKey(), it=self.it, T=T, r=r, Estep_T=Estep_T, Estep_r=Estep_r, 
+                    docs_theta=docs_theta, 
+                    topicDiffNorm=topicDiffNorm, best_it=best_it, best_T=best_T, best_loglike=best_loglike, 
+                    last_it=last_it, last_T=last_T, last_loglike=last_loglike, rngKeys=rngKeys, rngPos=rngPos, 
+                    rngHasGauss=rngHasGauss, rngCachedGaussian=rngCachedGaussian )
+        try:
+            os.rename( tmpFilename, checkpointFile )
+        except OSError:
+            # on Windows, rename() fails if the destination exists
+            os.remove(checkpointFile)
+            os.rename( tmpFilename, checkpointFile )
+        self.fileLogger.debug( "Iter %d: checkpoint saved into '%s'", self.it, checkpointFile )
+
+    # restore the EM state saved by saveCheckpoint(). self.T, self.r and self.docs_theta are set to 
+    # the inputs of the last E-step, so that redoing the E-step gives the same Pi and docs_theta. 
+    # Returns ( best_T_loglike, last_T_loglike, topicDiffNorm, T, r ), where T, r are the topics to continue with,
+    # or None if the file doesn't exist or is of another run
+    def loadCheckpoint( self, checkpointFile ):
+        out0 = self.genOutputter(0)
+        if not os.path.isfile(checkpointFile):
+            out0( "Checkpoint '%s' doesn't exist. Start from scratch" %checkpointFile )
+            return None
+        ckpt = np.load(checkpointFile)
+        if ckpt['key'].item() != self.checkpointKey():
+            out0( "Checkpoint '%s' is of another config or other documents. Start from scratch" %checkpointFile )
+            return None
+
+        self.it = int( ckpt['it'] )
+        self.T = ckpt['Estep_T']
+        self.r = ckpt['Estep_r']
+        self.docs_theta = ckpt['docs_theta']
+        np.random.set_state( ( 'MT19937', ckpt['rngKeys'], int( ckpt['rngPos'] ), int( ckpt['rngHasGauss'] ), 
+                                float( ckpt['rngCachedGaussian'] ) ) )
+        T_loglikes = []
+        for name in ( 'best', 'last' ):
+            it = int( ckpt[ name + '_it' ] )
+            if it >= 0:
+                T_loglikes.append( [ it, ckpt[ name + '_T' ], float( ckpt[ name + '_loglike' ] ) ] )
+            else:
+                T_loglikes.append(None)
+
+        out0( "Resume from iter %d in checkpoint '%s'" %( self.it, checkpointFile ) )
+        return T_loglikes[0], T_loglikes[1], float( ckpt['topicDiffNorm'] ), ckpt['T'], ckpt['r']
+
+    # one restart of inferenceRestarts(): inference() with the seed, and at most maxIters iters.
+    # Its log records and screen lines are prefixed with the seed
+    # returns ( seed, best_last_Ts, Em, docs_Em, state ), state: { name: value } of restartStateNames
+    def runRestart( self, seed, maxIters, checkpointFile=None, resume=False ):
+        # loadCheckpoint() would quietly start from scratch
+        if resume and not os.path.isfile(checkpointFile):
+            raise IOError( "Checkpoint '%s' of seed %d doesn't exist" %( checkpointFile, seed ) )
+
+        self.seed = seed
+        self.MAX_EM_ITERS = maxIters
+        fileLogger, stdout = self.fileLogger, sys.stdout
+        prefix = "[seed %d] " %seed
+        self.fileLogger = restartLogger( fileLogger, { 'prefix': prefix } )
+        sys.stdout = linePrefixer( stdout, prefix )
+        try:
+            best_last_Ts, Em, docs_Em, Pi = self.inference( checkpointFile, resume )
+        finally:
+            self.fileLogger, sys.stdout = fileLogger, stdout
+
+        state = dict( ( name, getattr( self, name ) ) for name in restartStateNames )
+        return seed, best_last_Ts, Em, docs_Em, state
+
+    # run the restarts [ ( seed, maxIters, checkpointFile, resume ), ... ] in a pool forked now, 
+    # or one by one on Windows (no fork) or with one process
+    def runRestarts( self, restarts, processes ):
+        if processes > 1 and os.name != 'nt':
+            pool = multiprocessing.Pool( min( processes, len(restarts) ), initRestartWorker, (self,) )
+            try:
+                results = pool.map( restartWorker, restarts, chunksize=1 )
+                pool.close()
+            finally:
+                # terminate() stops the other restarts if one fails
+                pool.terminate()
+                pool.join()
+        else:
+            results = [ self.runRestart(*restart) for restart in restarts ]
+        return results
+
+    # inference() with restart_num different seeds, on the docs set by setDocs().
+    # If restart_pruneIters > 0, each restart is checkpointed after restart_pruneIters iters, 
+    # and the restart_keep restarts with the best loglikes are resumed from their checkpoints.
+    # The EM state of the restart with the best lowerbound is loaded into the object, 
+    # and the same as inference() of this restart is returned
+    def inferenceRestarts(self):
+        if self.D == 0:
+            print "document set is empty or uninitialized"
+            return None, None, None, None
 
-    def inference(self):
+        out0 = self.genOutputter(0)
+        # seed 0 means no seeding, so the seeds start from 1
+        seed0 = max( self.seed, 1 )
+        seeds = range( seed0, seed0 + self.restart_num )
+        processes = self.restart_processes or self.restart_num
+        MAX_EM_ITERS = self.MAX_EM_ITERS
+        seed = self.seed
+        checkpoint_iterNum = self.checkpoint_iterNum
+        checkpointDir = None
+
+        # the checkpoints are removed, and the settings restored, even if a restart raises
+        try:
+            if 0 < self.restart_pruneIters < MAX_EM_ITERS and self.restart_keep < self.restart_num:
+                checkpointDir = tempfile.mkdtemp( prefix="topicvec-restarts-" )
+                checkpointFiles = dict( ( s, os.path.join( checkpointDir, "seed%d.checkpoint.npz" %s ) ) for s in seeds )
+                # the kept restarts are resumed from their checkpoints, so they are always saved. 
+                # inference() also saves one at the last iter
+                if self.checkpoint_iterNum <= 0:
+                    self.checkpoint_iterNum = self.restart_pruneIters
+                out0( "%d restarts for %d iters on %d processes" %( len(seeds), self.restart_pruneIters, 
+                                                                        min( processes, len(seeds) ) ) )
+                results = self.runRestarts( [ ( s, self.restart_pruneIters, checkpointFiles[s], False ) for s in seeds ], 
+                                            processes )
+                self.checkpoint_iterNum = checkpoint_iterNum
+                # the last loglike is always computed
+                results = sorted( results, key=lambda result: result[1][1][2], reverse=True )
+                for s, best_last_Ts, Em, docs_Em, state in results:
+                    out0( "Seed %d: loglike %.2f after %d iters" %( s, best_last_Ts[1][2], best_last_Ts[1][0] ) )
+                keptSeeds = [ result[0] for result in results[:self.restart_keep] ]
+                out0( "Continue the restarts of seeds %s" %( ", ".join( map(str, keptSeeds) ) ) )
+                restarts = [ ( s, MAX_EM_ITERS, checkpointFiles[s], True ) for s in keptSeeds ]
+            else:
+                restarts = [ ( s, MAX_EM_ITERS, None, False ) for s in seeds ]
+
+            out0( "%d restarts for %d iters on %d processes" %( len(restarts), MAX_EM_ITERS, 
+                                                                    min( processes, len(restarts) ) ) )
+            results = self.runRestarts( restarts, processes )
+        finally:
+            if checkpointDir:
+                shutil.rmtree( checkpointDir, ignore_errors=True )
+            # runRestarts() in this process changes them
+            self.seed = seed
+            self.MAX_EM_ITERS = MAX_EM_ITERS
+            self.checkpoint_iterNum = checkpoint_iterNum
+
+        # the restarts are compared by their last loglikes, as in pruning. The state 
+        # returned by a restart is the one at its last iter, so it agrees with the selection
+        for s, best_last_Ts, Em, docs_Em, state in results:
+            out0( "Seed %d: loglike %.2f after %d iters" %( s, best_last_Ts[1][2], best_last_Ts[1][0] ) )
+        bestSeed, best_last_Ts, Em, docs_Em, state = max( results, key=lambda result: result[1][1][2] )
+        out0( "Best restart: seed %d" %bestSeed )
+
+        for name in restartStateNames:
+            setattr( self, name, state[name] )
+        # Pi of the best restart is not passed back. getDocsPi() recomputes it from Estep_inputs
+        self.Pi = None
+        if self.keep_Pi:
+            return best_last_Ts, Em, docs_Em, self.getDocsPi()
+        return best_last_Ts, Em, docs_Em, None
+
+    # checkpointFile: save checkpoints into this file every checkpoint_iterNum iters
+    # resume: restore the EM state from checkpointFile if it's saved by the same run
+    def inference( self, checkpointFile=None, resume=False ):
         if self.D == 0:
             print "document set is empty or uninitialized"
             return None, None, None, None
@@ -695,19 +1962,22 @@ class topicvecDir:
         out0( "%d topics." %(self.K) )
         out0( "%s inference starts at %s" %( self.docsName, startTimeStr ) )
 
-        self.T = np.zeros( ( self.K, self.N0 ) )
-
-        if self.seed != 0:
-            np.random.seed(self.seed)
-            out0( "Seed: %d" %self.seed )
-
-        for k in xrange(0, self.K):
-            self.T[k] = np.random.randn(self.N0)
-            if self.init_l > 0:
-                self.T[k] = self.init_l * normalizeF(self.T[k])
+        checkpoint = None
+        if checkpointFile and resume:
+            checkpoint = self.loadCheckpoint(checkpointFile)
 
-        if self.zero_topic0:
-            self.T[0] = np.zeros(self.N0)
+        if checkpoint:
+            best_T_loglike, last_T_loglike, topicDiffNorm, T, r = checkpoint
+        else:
+            self.initTopics()
+            self.r = self.calcTopicResiduals(self.T)
+            # initialized as uniform over topics
+            self.docs_theta = np.ones( (self.D, self.K) )
+            self.it = 0
+            # only the best and the last topics (with a loglike) are kept, as [ it, T, loglike ]
+            best_T_loglike = last_T_loglike = None
+            # an arbitrary number to satisfy pylint
+            topicDiffNorm = 100000
 
     #    sum_v = np.zeros(N0)
     #    for wid in wids:
@@ -717,33 +1987,30 @@ class topicvecDir:
         #self.fileLogger.debug("avg_v:")
         #self.fileLogger.debug(T[0])
 
-        self.r = self.calcTopicResiduals(self.T)
-        # initialized as uniform over topics
-        self.docs_theta = np.ones( (self.D, self.K) )
-
         lastIterEndTime = time.time()
         print "Initial learning rate: %.2f" %(self.iniDelta)
 
-        self.docs_Pi = self.updatePi( self.docs_theta )
-        self.updateTheta()
-
-        self.calcSum_pi_v()
+        self.resetActiveSet()
+        self.activeSet_topicDiff = topicDiffNorm
+        self.startEstepPool()
+        self.updatePiTheta()
+        if not checkpoint:
+            for i in xrange( self.init_Estep_iters - 1 ):
+                self.updatePiTheta()
         loglike = self.calcLoglikelihood()
-
-        self.it = 0
+        # the E-step of the checkpoint is redone. Continue with the topics after it
+        if checkpoint:
+            self.T, self.r = T, r
 
         iterDur = time.time() - lastIterEndTime
         lastIterEndTime = time.time()
 
         print "Iter %d: loglike %.2f, %.1fs" %( self.it, loglike, iterDur )
 
-        # an arbitrary number to satisfy pylint
-        topicDiffNorm = 100000
-
         unif_docs_theta = np.ones( (self.D, self.K) )
-        Ts_loglikes = []
 
-        while self.it == 0 or ( self.it < self.MAX_EM_ITERS and topicDiffNorm > self.topicDiff_tolerance ):
+        isLastIter = ( topicDiffNorm <= self.topicDiff_tolerance )
+        while self.it == 0 or ( self.it < self.MAX_EM_ITERS and not isLastIter ):
             self.it += 1
             self.fileLogger.debug( "EM Iter %d:", self.it )
 
@@ -751,25 +2018,42 @@ class topicvecDir:
             # T, r not updated inside updateTopicEmbeddings()
             # because sometimes we want to keep the original T, r
             self.T, self.r, topicDiffNorm, maxTStep = self.updateTopicEmbeddings()
+            self.activeSet_topicDiff = topicDiffNorm
             
-            if self.it % self.VStep_iterNum == 0:
-                # does it matter to swap updatePi() & updateTheta()?
-                self.docs_Pi = self.updatePi( self.docs_theta )
-                self.updateTheta()
-
             # calcSum_pi_v() takes a long time on a large corpus
             # so it can be done once every a few iters, with slight loss of performance
             # on 20news and reuters, calcSum_pi_v() is fast enough and this acceleration is unnecessary
-            if self.it <= 5 or self.it == self.MAX_EM_ITERS or self.it % self.calcSum_pi_v_iterNum == 0:
+            getSum_pi_v = ( self.it <= 5 or self.it == self.MAX_EM_ITERS or self.it % self.calcSum_pi_v_iterNum == 0 )
+            # EM also stops early when T converges. The statistics of the last iter are returned,
+            # so its E-step updates all docs. After an active E-step, the frozen docs' statistics are stale,
+            # and a small step of T isn't convergence. T only converges on the statistics of a full sweep
+            isConverged = topicDiffNorm <= self.topicDiff_tolerance and \
+                                ( self.activeRows is None or self.activeSet_age == 0 )
+            isLastIter = ( self.it >= self.MAX_EM_ITERS or isConverged )
+
+            if self.it % self.VStep_iterNum == 0:
+                # does it matter to swap updatePi() & updateTheta()?
+                # sum_pi_v is computed together with Pi
+                self.updatePiTheta( getSum_pi_v, fullSweep=isLastIter )
+            elif getSum_pi_v and self.sum_pi_v_stale:
                 self.calcSum_pi_v()
 
-            loglike = self.calcLoglikelihood()
+            if isLastIter or self.it % self.calcLike_iterNum == 0:
+                loglike = self.calcLoglikelihood()
+                loglikeStr = "%.2f" %loglike
+            else:
+                loglike = None
+                loglikeStr = "-"
 
             iterDur = time.time() - lastIterEndTime
             lastIterEndTime = time.time()
 
-            iterStatusMsg = "Iter %d: loglike %.2f, topicDiffNorm %.4f, maxTStep %.3f, %.1fs" %( self.it,
-                                           loglike, topicDiffNorm, maxTStep, iterDur )
+            iterStatusMsg = "Iter %d: loglike %s, topicDiffNorm %.4f, maxTStep %.3f, %.1fs" %( self.it,
+                                           loglikeStr, topicDiffNorm, maxTStep, iterDur )
+            if self.Z_tailWids is not None:
+                iterStatusMsg += ", Z rel err %.4f (%d exact)" %( self.Z_relerr, self.Z_fallbackCount )
+            if self.activeSet_tolerance > 0:
+                iterStatusMsg += ", active %.3f" %self.activeDocFrac
 
             if self.it % self.printTopics_iterNum == 0:
                 out0(iterStatusMsg)
@@ -786,10 +2070,18 @@ class topicvecDir:
                 # not using out0 because the "\r" in the console output shouldn't be in the log file
                 print "%s  \r" %iterStatusMsg,
                 self.fileLogger.debug(iterStatusMsg)
-                Em = self.calcEm( self.docs_Pi )
+                Em = np.sum( self.docs_Em, axis=0 )
                 self.fileLogger.debug( "Em:\n%s\n", Em )
                 
-            Ts_loglikes.append( [ self.it, self.T, loglike ] )
+            if loglike is not None:
+                last_T_loglike = [ self.it, self.T, loglike ]
+                # the earliest T is kept if there are ties
+                if best_T_loglike is None or loglike > best_T_loglike[2]:
+                    best_T_loglike = last_T_loglike
+
+            if checkpointFile and self.checkpoint_iterNum > 0 and \
+                    ( self.it % self.checkpoint_iterNum == 0 or isLastIter ):
+                self.saveCheckpoint( checkpointFile, best_T_loglike, last_T_loglike, topicDiffNorm )
             
         if self.verbose >= 1:
             # if == 0, topics has just been printed in the while loop
@@ -797,6 +2089,8 @@ class topicvecDir:
                 #self.printTopWordsInTopics(unif_docs_theta, False)
                 self.printTopWordsInTopics(self.docs_theta, False)
 
+        self.stopEstepPool()
+
         endTime = time.time()
         endTimeStr = timeToStr(endTime)
         inferDur = int(endTime - startTime)
@@ -805,17 +2099,16 @@ class topicvecDir:
         out0( "%s inference ends at %s. %d iters, %d seconds." %( self.docsName, endTimeStr, self.it, inferDur ) )
 
         # Em: the global (all documents) distribution of topic mass 
-        Em = self.calcEm( self.docs_Pi )
+        Em = np.sum( self.docs_Em, axis=0 )
         # docs_Em: the document-wise distribution of topic mass 
-        docs_Em = np.zeros( (self.D, self.K) )
-        for d, Pi in enumerate(self.docs_Pi):
-            docs_Em[d] = np.sum( Pi, axis=0 )
+        docs_Em = self.docs_Em
 
-        # sort according to loglike
-        Ts_loglikes_sorted = sorted( Ts_loglikes, key=lambda T_loglike: T_loglike[2], reverse=True )
         # best T could be the last T. 
         # In that case, the two elements in best_last_Ts are the same
-        best_last_Ts = [ Ts_loglikes_sorted[0], Ts_loglikes[-1] ]
+        best_last_Ts = [ best_T_loglike, last_T_loglike ]
 
-        return best_last_Ts, Em, docs_Em, self.docs_Pi
+        # Pi is None if it's not kept. Call getDocsPi() to recompute it
+        if self.keep_Pi:
+            return best_last_Ts, Em, docs_Em, self.getDocsPi()
+        return best_last_Ts, Em, docs_Em, None
 
@@ -2,6 +2,7 @@
 
 import numpy as np
 import scipy.linalg
+import scipy.sparse
 from scipy.stats.stats import spearmanr
 import time
 import re
@@ -15,6 +16,11 @@ import os.path
 import random
 import unicodedata
 import sys
+import json
+import hashlib
+import multiprocessing
+import mmap
+import itertools
 
 unicode_punc_tbl = dict.fromkeys( i for i in xrange(128, sys.maxunicode)
                       if unicodedata.category(unichr(i)).startswith('P') )
@@ -315,16 +321,15 @@ def save_matrix_as_text( filename, rowTypeName, T, *extraCols, **kwargs ):
     extraColNum = len(extraCols)
     
     FMAT.write( "%d %d %d\n" %( K, N, extraColNum ) )
+    # the format of a whole row is built once, and each row is formatted in one go
+    rowFormat = " ".join( [ "%.5f" ] * N )
     for i in xrange(K):
         # if rowNames is provided, print the corresponding row name at the beginning of each line
         line = ""
         for j in xrange(extraColNum):
             col = str( extraCols[j][i] )
             line += col + colSep
-        line += "%.5f" %T[i,0]
-            
-        for j in xrange(1, N):
-            line += " %.5f" %T[i,j]
+        line += rowFormat %tuple( T[i].tolist() )
         FMAT.write("%s\n" %line)
 
     FMAT.close()
@@ -354,33 +359,49 @@ def load_matrix_from_text( filename, rowTypeName, colSep=" " ):
         for i in xrange(extraColNum):
             extraCols.append([])
         
-        M = np.zeros( (K, N), dtype=precision )
-
+        # the matrix values of all rows are joined and parsed in one go
+        matLines = []
         for line in FMAT:
+            lineno += 1
             line = line.strip()
             # end of file
             if not line:
-                if rowID != K:
-                    raise ValueError( lineno, "%d rows declared in header, but %d read" %( K, rowID ) )
                 break
 
-            row_extraCols = []
-            fields = line.split(colSep)
-            for i in xrange(extraColNum):
-                extraCols[i].append(fields[i])
-                
-            matFields = fields[extraColNum:]
-            # matrix values are always concatenated by " "
-            # if colSep is not " ", matrix values should take one column
-            if colSep != " ":
-                if len(matFields) > 1:
-                    raise ValueError( lineno, "%d columns of matrix values when colSep is not space" %( len(matFields) ) )
-                else:
-                    matFields = matFields[0].split(" ")
-                    
-            M[rowID] = np.array( [ float(x) for x in matFields ], dtype=precision )
+            if extraColNum > 0:
+                fields = line.split(colSep, extraColNum)
+                if len(fields) <= extraColNum:
+                    raise ValueError( lineno, "%d columns, fewer than %d extra columns and the matrix values" 
+                                                    %( len(fields), extraColNum + 1 ) )
+                for i in xrange(extraColNum):
+                    extraCols[i].append(fields[i])
+                # matrix values are always concatenated by " "
+                # if colSep is not " ", matrix values should take one column
+                matLine = fields[extraColNum]
+                if colSep != " " and colSep in matLine:
+                    raise ValueError( lineno, "%d columns of matrix values when colSep is not space" 
+                                                    %( len( matLine.split(colSep) ) ) )
+            else:
+                matLine = line
+            # a row of a wrong length would shift its values into the neighbouring rows
+            if len( matLine.split() ) != N:
+                raise ValueError( lineno, "%d values expected:\n%s" %( N, matLine ) )
+            matLines.append(matLine)
             rowID += 1
-                
+
+        if rowID != K:
+            raise ValueError( lineno, "%d rows declared in header, but %d read" %( K, rowID ) )
+
+        M = np.fromstring( " ".join(matLines), dtype=precision, sep=" " )
+        if M.size != K * N:
+            # all rows have N values. Find the first row with an unparsable value
+            for rowID, matLine in enumerate(matLines):
+                row = np.fromstring( matLine, dtype=precision, sep=" " )
+                if row.size != N:
+                    lineno = rowID + 2
+                    raise ValueError( lineno, "unparsable value:\n%s" %matLine )
+        M = M.reshape( (K, N) )
+
     except ValueError, e:
         if len( e.args ) == 2:
             warning( "Unknown line %d:\n%s\n" %( e.args[0], e.args[1] ) )
@@ -396,10 +417,129 @@ def load_matrix_from_text( filename, rowTypeName, colSep=" " ):
         return M
     else:
         return M, extraCols
+
+# save a matrix, its extra columns (e.g. the names and categories of docs) and the metadata (a dict)
+# into an uncompressed npz file, which can be loaded instantly by load_matrix_from_npz()
+def save_matrix_as_npz( filename, rowTypeName, T, *extraCols, **kwargs ):
+    print "Save %s matrix into '%s'" %(rowTypeName, filename)
+    meta = kwargs.get("meta", {})
+
+    K, N = T.shape
+    arrays = { 'T': T, 'extraColNum': len(extraCols), 'meta': json.dumps(meta) }
+    for j in xrange( len(extraCols) ):
+        arrays[ 'extraCol%d' %j ] = np.array( extraCols[j] )
+    np.savez( filename, **arrays )
+    print "%d rows of %s(s) (%d-d each) saved" %( K, rowTypeName, N )
+
+# returns the same as load_matrix_from_text(), except that the extra columns are numpy arrays.
+# if returnMeta, the metadata dict is appended to the returned values
+# with mmap=True, big matrices are memory-mapped (read-only)
+def load_matrix_from_npz( filename, rowTypeName, mmap=True, returnMeta=False ):
+    print "Load %s matrix from '%s'" %(rowTypeName, filename)
+    if mmap:
+        arrays = load_npz_mmap(filename)
+    else:
+        arrays = dict( np.load(filename) )
+
+    M = arrays['T']
+    K, N = M.shape
+    extraCols = [ arrays[ 'extraCol%d' %j ] for j in xrange( int( arrays['extraColNum'] ) ) ]
+    meta = json.loads( arrays['meta'].item() )
+    warning( "%dx%d %s matrix loaded from '%s'\n" %(K, N, rowTypeName, filename) )
+    if meta:
+        print "Metadata: %s" %( ", ".join( "%s=%s" %( key, meta[key] ) for key in sorted(meta) ) )
+
+    ret = [M]
+    if len(extraCols) > 0:
+        ret.append(extraCols)
+    if returnMeta:
+        ret.append(meta)
+    if len(ret) == 1:
+        return M
+    else:
+        return tuple(ret)
+
+# load a matrix saved by save_matrix_as_npz() if filename ends with ".npz", otherwise
+# one saved by save_matrix_as_text()
+def load_matrix( filename, rowTypeName, colSep=" " ):
+    if filename.endswith(".npz"):
+        return load_matrix_from_npz( filename, rowTypeName )
+    else:
+        return load_matrix_from_text( filename, rowTypeName, colSep )
         
+# the feature files are saved and loaded by featureFile.py
+from featureFile import save_features, load_npz_mmap, load_features
+
+# parse complete lines of an embedding text file at once. The numbers are parsed by numpy
+# returns the words and a len(lines) x N float32 matrix
+# if any line is malformed, returns the index of the first bad line in lines, instead of the matrix
+def parse_embedding_lines( lines, N ):
+    words = []
+    numStrs = []
+    for line in lines:
+        w, sep, nums = line.partition(' ')
+        words.append(w)
+        numStrs.append(nums)
+
+    # parsed as double then cast, the same as float(x)
+    V = np.fromstring( " ".join(numStrs), dtype=np.float64, sep=' ' )
+    if len(V) != len(lines) * N:
+        # find the line with a wrong number of fields, or with fields that are not numbers
+        for i, line in enumerate(lines):
+            fields = line.split()
+            if len(fields) != N + 1:
+                return words, i
+            try:
+                map( float, fields[1:] )
+            except ValueError:
+                return words, i
+        return words, 0
+    return words, V.reshape( len(lines), N ).astype(np.float32)
+
+# split a block of text into stripped lines, until the first empty line
+# returns the lines, and whether an empty line (the end of file) is met
+def split_embedding_lines(data):
+    lines = []
+    for line in data.split("\n"):
+        line = line.strip()
+        if not line:
+            return lines, True
+        lines.append(line)
+    return lines, False
+
+# parse the lines that start in the byte range [start, end) of an embedding text file.
+# start is after the header line
+# returns the words, their embeddings (or the index of the first bad line), the lines,
+# and whether an empty line is met
+def parse_embedding_range(args):
+    filename, start, end, N = args
+    FMAT = open(filename, "rb")
+    FMAT.seek(start - 1)
+    # start is in the middle of a line, which belongs to the previous range
+    isMidLine = ( FMAT.read(1) != "\n" )
+    data = FMAT.read( end - start )
+    # complete the last line
+    if data and data[-1] != "\n":
+        data += FMAT.readline()
+    FMAT.close()
+
+    if isMidLine:
+        data = data[ data.find("\n") + 1: ] if "\n" in data else ""
+    if data.endswith("\n"):
+        data = data[:-1]
+    if not data:
+        return [], None, [], False
+
+    lines, isBlank = split_embedding_lines(data)
+    words, V = parse_embedding_lines( lines, N )
+    return words, V, lines, isBlank
+
 # load top maxWordCount words, plus extraWords
-def load_embeddings( filename, maxWordCount=-1, extraWords={}, record_skipped=False ):
-    FMAT = open(filename)
+# the file is read in blocks of chunkBytes, and the numbers of each block are parsed at once.
+# processes: if > 1, the file is split into byte ranges parsed by worker processes
+def load_embeddings( filename, maxWordCount=-1, extraWords={}, record_skipped=False, processes=1,
+                     chunkBytes=1<<25 ):
+    FMAT = open(filename, "rb")
     warning( "Load embedding text file '%s'\n" %(filename) )
     
     V = []
@@ -408,6 +548,8 @@ def load_embeddings( filename, maxWordCount=-1, extraWords={}, record_skipped=Fa
 
     vocab = []
     precision = np.float32
+    line = ""
+    pool = None
 
     try:
         header = FMAT.readline()
@@ -435,44 +577,77 @@ def load_embeddings( filename, maxWordCount=-1, extraWords={}, record_skipped=Fa
         wid = 0
         orig_wid = 0
 
-        for line in FMAT:
-            lineno += 1
-            line = line.strip()
-            # end of file
-            if not line:
-                if orig_wid != vocab_size:
-                    raise ValueError( lineno, "%d words declared in header, but %d read" %( vocab_size, orig_wid ) )
-                break
+        # each item: the words of a block, their embeddings (None: not parsed yet), the lines,
+        # and whether the block ends with an empty line
+        if processes > 1:
+            fileSize = os.fstat( FMAT.fileno() ).st_size
+            headerLen = len(header)
+            rangeSize = ( fileSize - headerLen ) // processes + 1
+            ranges = [ ( filename, start, min( start + rangeSize, fileSize ), N ) 
+                            for start in xrange( headerLen, fileSize, rangeSize ) ]
+            pool = multiprocessing.Pool(processes)
+            blocks = pool.imap( parse_embedding_range, ranges )
+        else:
+            blocks = read_embedding_blocks( FMAT, chunkBytes )
+
+        isEnd = False
+        for words, blockV, lines, isBlank in blocks:
+            blockStart = lineno
+            # the first bad line of the block
+            if blockV is not None and not isinstance( blockV, np.ndarray ):
+                raise ValueError( blockStart + blockV + 1, lines[blockV] )
+
+            # indices of the interesting lines in the block
+            keptIndices = []
+            for i, w in enumerate(words):
+                lineno += 1
+                line = lines[i]
 
-            fields = line.split(' ')
-            # remove empty fields
-            fields = filter( lambda x: x, fields )
-            w = fields[0]
+                if w in extraWords:
+                    del extraWords[w]
+                    isInterested = True
+                elif orig_wid < maxWordCount:
+                    isInterested = True
+                elif record_skipped:
+                    isInterested = False
+                    skippedWords[w] = 1
+                else:
+                    isEnd = True
+                    break
 
-            if w in extraWords:
-                del extraWords[w]
-                isInterested = True
-            elif orig_wid < maxWordCount:
-                isInterested = True
-            elif record_skipped:
-                isInterested = False
-                skippedWords[w] = 1
+                orig_wid += 1
+                if isInterested:
+                    keptIndices.append(i)
+
+                if orig_wid > vocab_size:
+                    raise ValueError( "%d words declared in header, but more are read" %(vocab_size) )
+
+            if blockV is None:
+                # only the interesting lines are parsed
+                keptLines = [ lines[i] for i in keptIndices ]
+                keptWords, keptV = parse_embedding_lines( keptLines, N )
+                if not isinstance( keptV, np.ndarray ):
+                    badLine = keptLines[keptV]
+                    raise ValueError( blockStart + keptIndices[keptV] + 1, badLine )
             else:
-                break
-							
-            orig_wid += 1
+                keptWords = [ words[i] for i in keptIndices ]
+                keptV = blockV[keptIndices]
 
-            if isInterested:
-                V[wid] = np.array( [ float(x) for x in fields[1:] ], dtype=precision )
+            V[ wid : wid + len(keptWords) ] = keptV
+            for w in keptWords:
                 word2id[w] = wid
                 vocab.append(w)
                 wid += 1
 
-            if orig_wid % 1000 == 0:
-                warning( "\r%d    %d    %d    \r" %( orig_wid, wid, len(extraWords) ) )
-
-            if orig_wid > vocab_size:
-                raise ValueError( "%d words declared in header, but more are read" %(vocab_size) )
+            warning( "\r%d    %d    %d    \r" %( orig_wid, wid, len(extraWords) ) )
+            if isEnd:
+                break
+            # end of file
+            if isBlank:
+                lineno += 1
+                if orig_wid != vocab_size:
+                    raise ValueError( lineno, "%d words declared in header, but %d read" %( vocab_size, orig_wid ) )
+                break
 
     except ValueError, e:
         if len( e.args ) == 2:
@@ -482,63 +657,163 @@ def load_embeddings( filename, maxWordCount=-1, extraWords={}, record_skipped=Fa
             warning( "Source line %d - %s on File line %d:\n%s\n" %( tb.tb_lineno, e, lineno, line ) )
         exit(2)
 
+    finally:
+        # the workers may still be parsing the ranges after the last needed word, or after an error
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
     FMAT.close()
     warning( "\n%d embeddings read, %d kept\n" %(orig_wid, wid) )
 
-    #pdb.set_trace()
-
     if wid < len(V):
         V = V[:wid]
 
     # V: embeddings, vocab: array of words, word2id: dict of word to index in V
     return V, vocab, word2id, skippedWords
 
+# read an embedding text file (after the header) in blocks of complete lines.
+# yields the words, None (the embeddings are not parsed yet), the lines of each block,
+# and whether an empty line is met
+def read_embedding_blocks( FMAT, chunkBytes ):
+    pending = ""
+    while True:
+        data = FMAT.read(chunkBytes)
+        isLast = not data
+        data = pending + data
+        if not isLast:
+            cut = data.rfind("\n")
+            # no complete line yet
+            if cut < 0:
+                pending = data
+                continue
+            pending = data[ cut + 1: ]
+            data = data[:cut]
+        elif not data:
+            return
+
+        lines, isBlank = split_embedding_lines(data)
+        words = [ line.partition(' ')[0] for line in lines ]
+        yield words, None, lines, isBlank
+        if isLast or isBlank:
+            return
+
+# the first count nodes of the chain start, nxt[start], nxt[nxt[start]], ...
+# nxt: the next node of each node. The end of the chain points to itself.
+# the chain is followed by pointer doubling, in log2(count) vectorized steps
+def follow_chain( nxt, start, count ):
+    nodes = np.array( [start] )
+    jump = nxt
+    while len(nodes) < count:
+        # nodes: the first 2^k nodes. jump: nxt applied 2^k times
+        nodes = np.concatenate( [ nodes, jump[nodes] ] )
+        if len(nodes) < count:
+            jump = jump[jump]
+    return nodes[:count]
+
+# byte offsets of the spaces in buf[start:end], scanned in blocks of blockSize bytes
+def find_spaces( buf, start, end, blockSize=1<<26 ):
+    spaces = [ np.zeros( 0, dtype=np.int64 ) ]
+    for bstart in xrange( start, end, blockSize ):
+        bend = min( bstart + blockSize, end )
+        spaces.append( np.flatnonzero( buf[bstart:bend] == ord(' ') ) + bstart )
+    return np.concatenate(spaces)
+
 # borrowed from gensim.models.word2vec
 # load top maxWordCount words, plus extraWords
+# the file is memory-mapped. Each word ends at the first space after it, and its binary vector follows.
+# As the vectors may contain spaces, the word ends are found in a vectorized pass: the spaces of the file
+# are located with numpy, and the chain of word ends (the next one is the first space after the vector)
+# is followed by follow_chain(). The kept vectors are gathered at once from byte windows of the file
 def load_embeddings_bin( filename, maxWordCount=-1, extraWords={}, record_skipped=False ):
     print "Load embedding binary file '%s'" %(filename)
     word2id = {}
     skippedWords = {}
     vocab = []
-    #origWord2id = {}
-    #origVocab = []
     precision = np.float32
 
     with open(filename, "rb") as fin:
-        header = fin.readline()
-        vocab_size, N = map(int, header.split())
+        mm = mmap.mmap( fin.fileno(), 0, access=mmap.ACCESS_READ )
 
-        if maxWordCount > 0:
-            maxWordCount = min(maxWordCount, vocab_size)
-        else:
-            maxWordCount = vocab_size
+    headerEnd = mm.find("\n")
+    vocab_size, N = map( int, mm[:headerEnd].split() )
 
-        print "Will load embeddings of %d words" %maxWordCount,
-        if len(extraWords) > 0:
-            print "\b, plus %d extra words" %(len(extraWords))
-        else:
-            print
+    if maxWordCount > 0:
+        maxWordCount = min(maxWordCount, vocab_size)
+    else:
+        maxWordCount = vocab_size
 
-        # maxWordCount + len(extraWords) is the maximum num of words.
-        # V may contain extra rows that will be removed at the end
-        V = np.zeros( (maxWordCount + len(extraWords), N), dtype=precision )
+    print "Will load embeddings of %d words" %maxWordCount,
+    if len(extraWords) > 0:
+        print "\b, plus %d extra words" %(len(extraWords))
+    else:
+        print
 
-        full_binvec_len = np.dtype(precision).itemsize * N
+    full_binvec_len = np.dtype(precision).itemsize * N
+    fileSize = len(mm)
+    buf = np.frombuffer( mm, dtype=np.uint8 )
 
-        #pdb.set_trace()
+    # words after the top maxWordCount are only read for extraWords or record_skipped
+    if len(extraWords) > 0 or record_skipped:
+        needCount = vocab_size
+    else:
+        needCount = maxWordCount
+
+    # the spaces are scanned up to an estimated end of the needed words, which is extended if it falls short
+    spaces = np.zeros( 0, dtype=np.int64 )
+    scanned = headerEnd + 1
+    wordEnds = spaces
+    while len(wordEnds) < needCount and scanned < fileSize:
+        scanEnd = min( fileSize, max( 2 * scanned, headerEnd + 1 + needCount * ( full_binvec_len + 16 ) ) )
+        spaces = np.concatenate( [ spaces, find_spaces( buf, scanned, scanEnd ) ] )
+        scanned = scanEnd
+        if len(spaces) == 0:
+            continue
+        # nxt[i]: index of the word end after the vector behind spaces[i]. len(spaces): no more words
+        nxt = np.append( np.searchsorted( spaces, spaces + 1 + full_binvec_len ), len(spaces) )
+        wordEnds = follow_chain( nxt, 0, needCount )
+        wordEnds = spaces[ wordEnds[ wordEnds < len(spaces) ] ]
+
+    wordStarts = np.r_[ headerEnd + 1, wordEnds[:-1] + 1 + full_binvec_len ][ :len(wordEnds) ]
+    # the words and their ending spaces are gathered into one string, and split by the spaces
+    wordLens = wordEnds - wordStarts + 1
+    wordBytes = np.repeat( wordStarts - np.r_[ 0, np.cumsum(wordLens)[:-1] ], wordLens ) + np.arange( np.sum(wordLens) )
+    # ignore newlines in front of words (some binary files have newline, some don't)
+    words = buf[wordBytes].tobytes().replace("\n", "").split(" ")[:-1]
+    del wordBytes
+
+    if len(extraWords) == 0 and not record_skipped:
+        # the common case: all the words read are kept
+        vocab = words
+        # the first row of each word
+        word2id = dict( itertools.izip( reversed(words), xrange( len(words) - 1, -1, -1 ) ) )
+        noDupWords = ( len(word2id) == len(words) )
+        # a capitalized word is treated as the lowercased word, unless the lowercased word has been read
+        # (as a word, or as an earlier capitalized word)
+        lowered = set()
+        capWids = [ i for i, word in enumerate(words) if word[0].isupper() ]
+        for i in capWids:
+            word2 = words[i].lower()
+            if word2 not in lowered and word2id.get(word2, i) >= i:
+                lowered.add(word2)
+                if noDupWords:
+                    del word2id[ vocab[i] ]
+                    # a later word2 keeps its row, as the last row of a word read twice is kept below
+                    word2id.setdefault(word2, i)
+                vocab[i] = word2
+        if not noDupWords:
+            # a word read twice is mapped to its last row, as below
+            word2id = dict( itertools.izip( vocab, xrange( len(vocab) ) ) )
+        orig_wid = wid = len(vocab)
+        i = len(vocab) - 1
+        keptWordEnds = wordEnds
+    else:
+        # at most maxWordCount + len(extraWords) words are kept
+        keptWordEnds = []
         orig_wid = 0
         wid = 0
-        while True:
-            # mixed text and binary: read text first, then binary
-            word = []
-            while True:
-                ch = fin.read(1)
-                if ch == ' ':
-                    break
-                if ch != '\n':  # ignore newlines in front of words (some binary files have newline, some don't)
-                    word.append(ch)
-            word = b''.join(word)
-
+        i = -1
+        for i, word in enumerate(words):
             if word[0].isupper():
                 word2 = word.lower()
                 # if the lowercased word hasn't been read, treat the embedding as the lowercased word's
@@ -546,17 +821,14 @@ def load_embeddings_bin( filename, maxWordCount=-1, extraWords={}, record_skippe
                 if word2 not in word2id:
                     word = word2
 
-            #origWord2id[word] = orig_wid
-            #origVocab.append(word)
-
-            if w in extraWords:
-                del extraWords[w]
+            if word in extraWords:
+                del extraWords[word]
                 isInterested = True
             elif orig_wid < maxWordCount:
                 isInterested = True
             elif record_skipped:
                 isInterested = False
-                skippedWords[w] = 1
+                skippedWords[word] = 1
             else:
                 break
 
@@ -565,19 +837,27 @@ def load_embeddings_bin( filename, maxWordCount=-1, extraWords={}, record_skippe
             if isInterested:
                 word2id[word] = wid
                 vocab.append(word)
-                V[wid] = np.fromstring( fin.read(full_binvec_len), dtype=precision )
+                keptWordEnds.append( wordEnds[i] )
                 wid += 1
-            else:
-                fin.read(full_binvec_len)
 
-            if orig_wid % 1000 == 0:
+            if orig_wid % 100000 == 0:
                 print "\r%d    %d    %d    \r" %( orig_wid, wid, len(extraWords) ),
 
-            if orig_wid > vocab_size:
-                raise ValueError( "%d words declared in header, but more are read" %(vocab_size) )
+    # only the vector of the last word in the file can be incomplete
+    if i >= 0 and wordEnds[i] + 1 + full_binvec_len > fileSize:
+        raise ValueError( "File is truncated: %d words read, the last vector is incomplete" %(orig_wid) )
 
-    if wid < len(V):
-        V = V[:wid]
+    if wid > 0:
+        # row i of vecBytes: the full_binvec_len bytes starting at offset i. A view of the mapped file
+        vecBytes = np.lib.stride_tricks.as_strided( buf, shape=( fileSize - full_binvec_len + 1, full_binvec_len ), 
+                                                        strides=(1, 1) )
+        V = vecBytes[ np.array(keptWordEnds) + 1 ].view(precision)
+        del vecBytes
+    else:
+        V = np.zeros( (0, N), dtype=precision )
+
+    del buf
+    mm.close()
     print "\n%d embeddings read, %d embeddings kept" %(orig_wid, wid)
 
     # V: embeddings, vocab: array of words, word2id: dict of word to index in V
@@ -603,6 +883,102 @@ def load_embeddings_hyper(modelPath, vecType):
     print "Done."
     return model
     
+# md5 of a file, read in blocks
+def file_md5( filename, blockSize=1<<20 ):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+# the embedding store is a cache of an embedding file, which is fast to load and can be memory-mapped:
+# <storeTrunk>.V.npy:       the embedding matrix in float32, in the plain npy format
+# <storeTrunk>.vocab.txt:   the words, one per line, in the order of the rows of V
+# <storeTrunk>.header.json: shape and dtype of V, and the size, mtime and md5 of the source embedding file
+def save_embedding_store( storeTrunk, V, vocab, sourceFilename=None ):
+    V = np.asarray( V, dtype=np.float32 )
+    np.save( storeTrunk + ".V.npy", V )
+    VOCAB = open( storeTrunk + ".vocab.txt", "wb" )
+    for w in vocab:
+        VOCAB.write( "%s\n" %w )
+    VOCAB.close()
+
+    header = { 'shape': V.shape, 'dtype': str(V.dtype) }
+    if sourceFilename:
+        stat = os.stat(sourceFilename)
+        header['source'] = { 'filename': os.path.basename(sourceFilename), 'size': stat.st_size, 
+                             'mtime': int(stat.st_mtime), 'md5': file_md5(sourceFilename) }
+    # the header is written last. A store without a header is incomplete
+    HEADER = open( storeTrunk + ".header.json", "w" )
+    json.dump( header, HEADER, indent=2 )
+    HEADER.close()
+    print "Embedding store of %d words saved to '%s'" %( len(vocab), storeTrunk )
+
+# returns V, vocab, word2id, or None if the store doesn't exist or is outdated
+# sourceFilename: if given, the store is outdated if the file is different from the one it's made from
+# mmap: V is memory-mapped read-only, so that processes share the same copy in the page cache
+def load_embedding_store( storeTrunk, sourceFilename=None, mmap=True ):
+    headerFilename = storeTrunk + ".header.json"
+    if not os.path.isfile(headerFilename):
+        return None
+    header = json.load( open(headerFilename) )
+
+    if sourceFilename:
+        source = header.get('source')
+        stat = os.stat(sourceFilename)
+        if not source or source['size'] != stat.st_size:
+            return None
+        # the file is touched or copied. It's the same file if the content is the same.
+        # The header is never rewritten here, as other processes may be loading the store at the same time
+        if source['mtime'] != int(stat.st_mtime) and source['md5'] != file_md5(sourceFilename):
+            return None
+
+    if mmap:
+        V = np.load( storeTrunk + ".V.npy", mmap_mode='r' )
+    else:
+        V = np.load( storeTrunk + ".V.npy" )
+    if list(V.shape) != header['shape']:
+        return None
+
+    vocab = open( storeTrunk + ".vocab.txt", "rb" ).read().split("\n")[:-1]
+    word2id = dict( ( w, i ) for i, w in enumerate(vocab) )
+    return V, vocab, word2id
+
+# load embeddings through the embedding store, which is created on the first load of the embedding file.
+# different maxWordCount and extraWords have different stores
+# returns V, vocab, word2id, skippedWords as load_embeddings()
+def load_embeddings_cached( filename, maxWordCount=-1, extraWords={}, isBinary=False, mmap=True ):
+    storeTrunk = filename
+    if maxWordCount > 0:
+        storeTrunk += ".top%d" %maxWordCount
+    if len(extraWords) > 0:
+        storeTrunk += ".x" + hashlib.md5( " ".join( sorted(extraWords) ) ).hexdigest()[:8]
+
+    store = load_embedding_store( storeTrunk, filename, mmap )
+    if store:
+        V, vocab, word2id = store
+        print "%d embeddings loaded from store '%s'" %( len(vocab), storeTrunk )
+        # found extra words are removed from extraWords, as by load_embeddings()
+        for w in extraWords.keys():
+            if w in word2id:
+                del extraWords[w]
+        return V, vocab, word2id, {}
+
+    if isBinary:
+        V, vocab, word2id, skippedWords = load_embeddings_bin( filename, maxWordCount, extraWords )
+    else:
+        V, vocab, word2id, skippedWords = load_embeddings( filename, maxWordCount, extraWords )
+    # the store is only a cache. If it can't be written (e.g. the directory is read-only), 
+    # the embeddings are still returned. An incomplete store has no header, and is ignored
+    try:
+        save_embedding_store( storeTrunk, V, vocab, filename )
+    except (IOError, OSError) as e:
+        warning( "Embedding store '%s' not saved: %s\n" %( storeTrunk, e ) )
+    return V, vocab, word2id, skippedWords
+
 # load residuals
 # the dict word2id is to ensure the same word is mapped to the same id as in the embedding file
 # in other words, the embedding file and residual file had to be generated in the same batch
@@ -1708,46 +2084,125 @@ def isMemEnoughEigen(D, extraVarsRatio=5):
 
     return isEnough, installedMemGB, requiredMemGB
 
-def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1):
-    if remove_punc:
-        # ensure doc_u is in unicode
-        if not isinstance(doc, unicode):
-            encoding = remove_punc
-            doc_u = doc.decode(encoding, errors='ignore')
-        else:
-            doc_u = doc
-        # remove unicode punctuation marks, keep ascii punctuation marks
-        doc_u = doc_u.translate(unicode_punc_tbl)
-        if not isinstance(doc, unicode):
-            doc = doc_u.encode(encoding)
+# unicode_punc_tbl as a regex character class, which removes the punctuation marks faster than translate()
+def compileUnicodePuncRegex():
+    ranges = []
+    for i in sorted(unicode_punc_tbl):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
         else:
-            doc = doc_u
-            
-    if remove_url:
-        re_url = r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
-        doc = re.sub( re_url, "", doc )
-            
-    sentences = re.split( r"\s*[,;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+||", doc ) #"
-    wc = 0
-    wordsInSentences = []
-    
-    for sentence in sentences:
-        if sentence == "":
-            continue
+            ranges.append( [i, i] )
+    charClass = u"".join( re.escape( unichr(a) ) if a == b else u"%s-%s" %( re.escape( unichr(a) ), re.escape( unichr(b) ) )
+                                for a, b in ranges )
+    return re.compile( u"[" + charClass + u"]", re.UNICODE )
+
+# split documents into sentences of words. The patterns are compiled once, and 
+# reused for all documents. tokenize() gives the same results as the original extractSentenceWords()
+# decode_errors: how byte strings that aren't in the encoding remove_punc are decoded, as in str.decode()
+class SentenceTokenizer(object):
+    re_url = re.compile( r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)" )
+    re_sentSplit = re.compile( r"\s*[,;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+||" ) #"
+    re_wordSplit = re.compile( r"\s+\+|^\+|\+?[\-*\/&%=<>\[\]~\|\@\$]+\+?|\'\s+|\'s\s+|\'s$|\s+\'|^\'|\'$|\$|\\|\s+" )
+    re_alnum = re.compile( "[A-Za-z0-9]" )
+    re_nonAscii = re.compile( r"[^\x00-\x7f]" )
+    re_unicodePunc = None
+
+    def __init__(self, remove_url=True, remove_punc="utf-8", min_length=1, decode_errors='ignore'):
+        self.remove_url = remove_url
+        self.remove_punc = remove_punc
+        self.min_length = min_length
+        self.decode_errors = decode_errors
+        if remove_punc and SentenceTokenizer.re_unicodePunc is None:
+            SentenceTokenizer.re_unicodePunc = compileUnicodePuncRegex()
+
+    def tokenize(self, doc):
+        # unicode punctuation marks are all non-ascii. Skip the decoding of pure ascii docs
+        if self.remove_punc and self.re_nonAscii.search(doc):
+            # ensure doc_u is in unicode
+            if not isinstance(doc, unicode):
+                encoding = self.remove_punc
+                doc_u = doc.decode(encoding, self.decode_errors)
+            else:
+                doc_u = doc
+            # remove unicode punctuation marks, keep ascii punctuation marks
+            doc_u = self.re_unicodePunc.sub( u"", doc_u )
+            if not isinstance(doc, unicode):
+                doc = doc_u.encode(encoding)
+            else:
+                doc = doc_u
 
-        if not re.search( "[A-Za-z0-9]", sentence ):
-            continue
+        if self.remove_url:
+            doc = self.re_url.sub( "", doc )
+
+        wc = 0
+        wordsInSentences = []
+        min_length = self.min_length
+        re_alnum = self.re_alnum
+        re_wordSplit = self.re_wordSplit
+
+        for sentence in self.re_sentSplit.split(doc):
+            if not sentence or not re_alnum.search(sentence):
+                continue
+
+            words = [ w for w in re_wordSplit.split(sentence) if w ]
+
+            if len(words) >= min_length:
+                wordsInSentences.append(words)
+                wc += len(words)
+
+        return wordsInSentences, wc
 
-        words = re.split( r"\s+\+|^\+|\+?[\-*\/&%=<>\[\]~\|\@\$]+\+?|\'\s+|\'s\s+|\'s$|\s+\'|^\'|\'$|\$|\\|\s+", sentence )
+    # returns a list of ( wordsInSentences, wc ) of docs
+    # processes: if > 1, the docs are tokenized by a pool of worker processes, in chunks of chunkSize docs
+    def tokenizeDocs(self, docs, processes=1, chunkSize=200):
+        if processes <= 1:
+            return [ self.tokenize(doc) for doc in docs ]
 
-        words = filter( lambda w: w, words )
+        pool = multiprocessing.Pool( processes, initTokenizeWorker, 
+                                        ( self.remove_url, self.remove_punc, self.min_length, self.decode_errors ) )
+        try:
+            results = pool.map( tokenizeWorker, docs, chunkSize )
+            pool.close()
+        finally:
+            # after an error the workers are stopped. The pool is joined so that no worker is left behind
+            pool.terminate()
+            pool.join()
+        return results
 
-        if len(words) >= min_length:
-            wordsInSentences.append(words)
-            wc += len(words)
+# the tokenizer of a worker process of SentenceTokenizer.tokenizeDocs()
+workerTokenizer = None
 
-    #print "%d words extracted" %wc
-    return wordsInSentences, wc
+def initTokenizeWorker(remove_url, remove_punc, min_length, decode_errors):
+    global workerTokenizer
+    workerTokenizer = SentenceTokenizer(remove_url, remove_punc, min_length, decode_errors)
+
+def tokenizeWorker(doc):
+    return workerTokenizer.tokenize(doc)
+
+# tokenizers of different options, reused across calls
+sentenceTokenizers = {}
+
+def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1):
+    key = ( remove_url, remove_punc, min_length )
+    if key not in sentenceTokenizers:
+        sentenceTokenizers[key] = SentenceTokenizer(remove_url, remove_punc, min_length)
+    return sentenceTokenizers[key].tokenize(doc)
+
+# group ( wordsInSentences, doc_name ) pairs from docIter into mini-batches of batchSize docs
+# yields ( docs_wordsInSentences, docs_name )
+def docBatchIter( docIter, batchSize ):
+    docs_words = []
+    docs_name = []
+    for wordsInSentences, doc_name in docIter:
+        docs_words.append(wordsInSentences)
+        docs_name.append(doc_name)
+        if len(docs_words) == batchSize:
+            yield docs_words, docs_name
+            docs_words = []
+            docs_name = []
+            
+    if len(docs_words) > 0:
+        yield docs_words, docs_name
                             
 def randomsample( X, n ):
     """ random.sample of the rows of X
@@ -1756,6 +2211,25 @@ def randomsample( X, n ):
     sampleix = random.sample( xrange( X.shape[0] ), int(n) )
     return X[sampleix]
 
+def kmeansppSample( X, weights, n ):
+    """ k-means++ seeding: n rows of X, each drawn with a probability proportional to
+        its weight * (cosine distance to the nearest drawn row)^2
+        X: rows normalized to unit length
+    """
+    M = X.shape[0]
+    weights = np.asarray( weights, dtype=np.float64 )
+    sampleix = [ np.random.choice( M, p = weights / weights.sum() ) ]
+    minDist = np.maximum( 1 - np.dot( X, X[ sampleix[0] ] ), 0 )
+    for i in xrange( 1, int(n) ):
+        with np.errstate(under='ignore'):
+            prob = weights * minDist ** 2
+        # fewer distinct rows than n. Draw the rest by weights
+        if prob.sum() <= 0:
+            prob = weights
+        sampleix.append( np.random.choice( M, p = prob / prob.sum() ) )
+        minDist = np.minimum( minDist, np.maximum( 1 - np.dot( X, X[ sampleix[-1] ] ), 0 ) )
+    return X[sampleix]
+
 def relu(v, bias):
     v2 = np.copy(v)
     v2[ v < bias ] = 0
@@ -1776,8 +2250,9 @@ def avgpool(vs):
                                     
 class VecModel:
     def __init__(self, V, vocab, word2id, vecNormalize=True, precompute_gramian=False):
+        # V may be memory-mapped from an embedding store. It's never changed in place
         self.Vorig = V
-        self.Vnorm = np.array( [ normF(x) for x in self.Vorig ], dtype=np.float32 )
+        self.Vnorm = np.linalg.norm( self.Vorig, axis=1 ).astype(np.float32)
         for i, w in enumerate(vocab):
             if self.Vnorm[i] == 0:
                 print "WARN: %s norm is 0" %w